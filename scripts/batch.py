@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+""" batch run script for Spatial Interaction Model of Internal Migration: runs multiple configs, sharing data loading and model fitting """
+
+import glob
+import time
+import argparse
+from simim import batch
+from simim.utils import validate_config
+
+def main(filenames, processes):
+
+  configs = batch.load_configs(filenames)
+  for _, params in configs:
+    validate_config(params)
+
+  start_time = time.time()
+  try:
+    outputs = batch.run(configs, processes)
+  except RuntimeError as error:
+    print("RUN FAILED: ", error)
+    return
+
+  for filename in outputs:
+    print("%s -> %s" % (filename, outputs[filename]))
+  print("done. Exec time(s): ", time.time() - start_time)
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="spatial interaction model of internal migration (batch)")
+  parser.add_argument("configs", nargs="+", type=str, metavar="config-file", help="model configuration files (json), or glob patterns")
+  parser.add_argument("-n", "--processes", type=int, default=None, help="number of worker processes (defaults to the number of CPUs)")
+
+  args = parser.parse_args()
+
+  filenames = sorted(set(f for pattern in args.configs for f in (glob.glob(pattern) or [pattern])))
+  main(filenames, args.processes)
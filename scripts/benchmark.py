@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+""" benchmark script for Spatial Interaction Model of Internal Migration: times the model and projection code on local data """
+
+import sys
+import os
+import argparse
+from simim import benchmark
+
+def main(args):
+
+  suite = benchmark.benchmarks(args.dataset, args.scenario)
+  results = benchmark.run(suite, args.repeat, args.filter)
+  benchmark.append_history(args.history, results)
+  print("results appended to %s" % args.history)
+
+  if args.save_baseline:
+    benchmark.save_baseline(args.baseline, results)
+    print("baseline saved to %s" % args.baseline)
+    return 0
+
+  if not os.path.isfile(args.baseline):
+    print("no baseline (%s) to compare against, use --save-baseline to create one" % args.baseline)
+    return 0
+  comparison = benchmark.compare(results, benchmark.load_baseline(args.baseline), args.tolerance)
+  print(comparison.to_string(index=False))
+  regressions = comparison[comparison.STATUS == "slower"]
+  if args.check and len(regressions):
+    print("REGRESSIONS: %s" % ", ".join(regressions.BENCHMARK))
+    return 1
+  return 0
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="spatial interaction model of internal migration (benchmarks)")
+  parser.add_argument("-k", "--filter", type=str, default=None, help="only run benchmarks whose names contain this")
+  parser.add_argument("-r", "--repeat", type=int, default=3, help="repeats of each benchmark (the minimum time is compared)")
+  parser.add_argument("--dataset", type=str, default=benchmark.DATASET, help="OD dataset (default %s)" % benchmark.DATASET)
+  parser.add_argument("--scenario", type=str, default=benchmark.SCENARIO, help="scenario (default %s)" % benchmark.SCENARIO)
+  parser.add_argument("--history", type=str, default="benchmarks/history.jsonl", help="history file the results are appended to")
+  parser.add_argument("--baseline", type=str, default="benchmarks/baseline.json", help="baseline results to compare against")
+  parser.add_argument("--save-baseline", action="store_true", help="save the results as the baseline rather than comparing")
+  parser.add_argument("-t", "--tolerance", type=float, default=0.1, help="relative change in time reported as faster/slower (default 0.1)")
+  parser.add_argument("--check", action="store_true", help="exit with an error if any benchmark is slower than the baseline")
+
+  sys.exit(main(parser.parse_args()))
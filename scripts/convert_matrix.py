@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+""" converts OD matrices (long-format CSV, or distances between shapefile centroids) into the binary matrix store """
+
+import argparse
+import numpy as np
+import geopandas as gpd
+from simim import matrix_store
+
+def main(args):
+  dtype = np.float32 if args.float32 else np.float64
+  if args.source == "csv":
+    matrix_store.from_csv(args.input, args.column, args.output, dtype)
+  else:
+    matrix_store.from_shapefile(gpd.read_file(args.input), args.output, args.code_column, dtype)
+  matrix = matrix_store.open_matrix(args.output)
+  print("%s -> %s (%d zones, %s)" % (args.input, args.output, len(matrix), matrix.values.dtype))
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="convert OD matrices into the binary matrix store")
+  subparsers = parser.add_subparsers(dest="source")
+  csv = subparsers.add_parser("csv", help="long-format CSV with O_GEOGRAPHY_CODE, D_GEOGRAPHY_CODE and value columns")
+  csv.add_argument("input", type=str, help="CSV file")
+  csv.add_argument("column", type=str, help="value column, e.g. ACCESSIBILITY")
+  csv.add_argument("output", type=str, help="matrix store file")
+  shapefile = subparsers.add_parser("shapefile", help="distances (km) between the centroids (bng_e, bng_n) of a shapefile's zones")
+  shapefile.add_argument("input", type=str, help="shapefile")
+  shapefile.add_argument("output", type=str, help="matrix store file")
+  shapefile.add_argument("-c", "--code-column", type=str, default="lad16cd", help="zone code column (default lad16cd)")
+  for subparser in [csv, shapefile]:
+    subparser.add_argument("--float32", action="store_true", help="store single precision values (default double)")
+
+  args = parser.parse_args()
+  # (subparsers can only be required from Python 3.7)
+  if args.source is None:
+    parser.error("a source (csv or shapefile) is required")
+  main(args)
@@ -7,6 +7,7 @@ CMLAD refers to census-merged LAD codes for E&W
 """
 import numpy as np
 import pandas as pd
+import simim.geography as geography
 
 
 def update_lad_codes(df):
@@ -78,3 +79,8 @@ print(geog_lookup[geog_lookup.LAD.str.startswith("S")].head())
 filename="./data/gb_geog_lookup.csv.gz"
 geog_lookup.to_csv(filename, index=False, compression="gzip")
 print("written to " + filename)
+
+# and the compact (memory-mapped) hierarchy, see simim.geography
+filename = "./data/gb_geog_lookup.geo"
+geography.write_hierarchy(filename, geog_lookup)
+print("written to " + filename)
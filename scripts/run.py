@@ -31,6 +31,7 @@ def main(params):
     return
 
   data.write_output()
+  data.write_profile()
 
   # visualise
   year = params.get("end_year", data.snpp.max_year("en"))
@@ -0,0 +1,72 @@
+"""
+batch.py
+Runs multiple configs, fitting once per group of configs that differ only in their scenarios
+"""
+
+import os
+import copy
+import json
+import multiprocessing
+from collections import OrderedDict
+
+import simim.simim as simim
+
+# config settings that only affect the projection, not the input data or the model fit
+SCENARIO_PARAMS = ["scenario", "scenario_dir", "od_scenario", "migration_scale_factor", "output_dir", "odmatrix",
+                   "disaggregated_output", "graphics", "ensemble_draws", "ensemble_seed", "ensemble_quantiles", "profile"]
+
+# the shared (read-only) input data and fitted model of the group being run, inherited by the worker processes
+_prepared = None
+
+def load_configs(filenames):
+  """ Loads config files, returning a list of (filename, params) """
+  configs = []
+  for filename in filenames:
+    with open(filename) as config_file:
+      configs.append((filename, json.load(config_file)))
+  return configs
+
+def fit_key(params):
+  """ The config settings that determine the input data and model fit, as a string """
+  return json.dumps({ k: v for k, v in params.items() if k not in SCENARIO_PARAMS }, sort_keys=True)
+
+def group_configs(configs):
+  """ Groups (filename, params) by fit_key, preserving order """
+  groups = OrderedDict()
+  for filename, params in configs:
+    groups.setdefault(fit_key(params), []).append((filename, params))
+  return list(groups.values())
+
+def _run(params):
+  """ Projects one scenario in a worker process, from the state inherited from the parent, and writes its output """
+  input_data = _prepared[0]
+  input_data.configure_output(params)
+  simim.run_scenario(params, _prepared)
+  input_data.write_output()
+  input_data.write_profile()
+  return input_data.summary_output_file
+
+def run(configs, processes=None):
+  """ Runs each (filename, params) config in a forked worker, returning a dict of filename to summary output file """
+  global _prepared
+  context = multiprocessing.get_context("fork")
+  groups = group_configs(configs)
+  groups_params = [[simim._normalise_params(copy.deepcopy(params)) for _, params in group] for group in groups]
+  # check the years given in every config before any group is prepared (default years are checked by prepare)
+  for group_params in groups_params:
+    for params in group_params:
+      simim._check_years(simim._load_scenario(params), params.get("start_year"), params.get("end_year"))
+  outputs = {}
+  for group, group_params in zip(groups, groups_params):
+    print("Preparing %d config(s): %s" % (len(group), ", ".join(filename for filename, _ in group)), flush=True)
+    for params in group_params:
+      if not os.path.isdir(params["output_dir"]):
+        os.makedirs(params["output_dir"])
+    _prepared = simim.prepare(group_params[0], group_params)
+    try:
+      with context.Pool(processes, maxtasksperchild=1) as pool:
+        for (filename, _), output_file in zip(group, pool.map(_run, group_params, chunksize=1)):
+          outputs[filename] = output_file
+    finally:
+      _prepared = None
+  return outputs
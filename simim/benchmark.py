@@ -0,0 +1,231 @@
+"""
+benchmark.py
+Performance benchmarks of the model and projection, using only local data
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import subprocess
+import tempfile
+import contextlib
+import io
+import numpy as np
+import pandas as pd
+
+import simim.simim as simim
+import simim.models as models
+import simim.scenario as scenario
+import simim.data_apis as data_apis
+import simim.matrix_store as matrix_store
+from simim.utils import access_weighted_sum, calc_distances, get_named_values
+from simim.profiling import Profiler
+
+DATASET = "tests/data/testdata.csv.gz"
+SCENARIO = "data/scenarios/test.csv"
+# the local data is projected from here, at fixed annual growth rates
+BASE_YEAR = 2015
+GROWTH = { "PEOPLE": 1.005, "HOUSEHOLDS": 1.008, "JOBS": 1.01, "GVA": 1.02 }
+
+def load_dataset(filename=DATASET):
+  """ Builds a model dataset (as simim.prepare does) from the test dataset, returning (dataset, zonal values) """
+  data = pd.read_csv(filename)
+  zonal = data[data.O_GEOGRAPHY_CODE == data.D_GEOGRAPHY_CODE] \
+    .rename({"O_GEOGRAPHY_CODE": "GEOGRAPHY_CODE"}, axis=1)[["GEOGRAPHY_CODE", "PEOPLE", "HOUSEHOLDS", "JOBS"]] \
+    .sort_values("GEOGRAPHY_CODE").reset_index(drop=True)
+  zonal = zonal.astype({"PEOPLE": float, "HOUSEHOLDS": float, "JOBS": float})
+  zonal["GVA"] = zonal.JOBS * 0.04 + 10.0
+  dataset = data[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "MIGRATIONS", "DISTANCE"]].copy()
+  for factor in ["PEOPLE", "HOUSEHOLDS", "JOBS", "GVA"]:
+    dataset = simim._merge_factor(dataset, zonal, [factor])
+  dataset["ACCESSIBILITY"] = np.exp(-dataset.DISTANCE.values / 50.0)
+  dataset = simim._compute_derived_factors(dataset)
+  return dataset.sort_values(["D_GEOGRAPHY_CODE", "O_GEOGRAPHY_CODE"]).reset_index(drop=True), zonal
+
+class LocalData(data_apis.Instance):
+  """ Input data for the projection loop without any downloads: the test dataset's zonal values, grown at fixed rates """
+  def __init__(self, zonal):
+    self.profiler = Profiler()
+    self.zonal = zonal
+    self.output = None
+    years = np.arange(BASE_YEAR, data_apis.GVA_MAX_YEAR + 1)
+    economic_data = pd.DataFrame({"YEAR": np.repeat(years, len(zonal)), "GEOGRAPHY_CODE": np.tile(zonal.GEOGRAPHY_CODE.values, len(years))})
+    for name in ["JOBS", "GVA"]:
+      economic_data[name] = np.outer(GROWTH[name] ** (years - BASE_YEAR), zonal[name].values).ravel()
+    self.economic_baseline = data_apis.EconomicBaseline(economic_data, held={"GVA": data_apis.GVA_MAX_YEAR})
+
+  def __get(self, name, year, geogs):
+    data = self.zonal.loc[self.zonal.GEOGRAPHY_CODE.isin(geogs), ["GEOGRAPHY_CODE", name]].reset_index(drop=True)
+    data[name] *= GROWTH[name] ** (year - BASE_YEAR)
+    return data
+
+  def get_people(self, year, geogs):
+    return self.__get("PEOPLE", year, geogs)
+
+  def get_households(self, year, geogs):
+    return self.__get("HOUSEHOLDS", year, geogs)
+
+  def get_panel(self, start_year, end_year, geogs):
+    panel = data_apis.Panel(range(start_year, end_year + 1), geogs)
+    values = self.zonal.set_index("GEOGRAPHY_CODE").loc[geogs]
+    for name in GROWTH:
+      panel[name] = np.outer(GROWTH[name] ** (panel.years - BASE_YEAR), values[name].values)
+    return panel
+
+class Benchmark():
+  """ A named timing of func(state), where state = setup() is recreated (untimed) before every repeat """
+  def __init__(self, name, func, setup=None, number=1):
+    self.name = name
+    self.func = func
+    self.setup = setup or (lambda: None)
+    self.number = number
+
+  def run(self, repeat):
+    times = []
+    for _ in range(repeat):
+      state = self.setup()
+      # (the model and scenario code is verbose)
+      with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        self.func(state)
+        times.append((time.perf_counter() - start) / self.number)
+    return {"min": min(times), "median": float(np.median(times)), "mean": float(np.mean(times)), "repeat": repeat}
+
+# model specs: (emitters, attractors) by model type, as the configs in config/
+SPECS = {
+  "gravity": (["O_PEOPLE"], ["D_HOUSEHOLDS", "D_JOBS_ACCESSIBILITY", "D_GVA_EX_LONDON"]),
+  "production": (["O_GEOGRAPHY_CODE"], ["D_HOUSEHOLDS", "D_JOBS_ACCESSIBILITY", "D_GVA_EX_LONDON"]),
+  "attraction": (["O_PEOPLE"], ["D_GEOGRAPHY_CODE"]),
+  "doubly": (["O_GEOGRAPHY_CODE"], ["D_GEOGRAPHY_CODE"])
+}
+
+def benchmarks(dataset_file=DATASET, scenario_file=SCENARIO):
+  """ The benchmark suite, as a list of Benchmarks """
+  dataset, zonal = load_dataset(dataset_file)
+  fitted = {}
+
+  def fit(model_type, model_subtype, data=None):
+    emitters, attractors = SPECS[model_type]
+    return models.Model(model_type, model_subtype, dataset.copy() if data is None else data, "MIGRATIONS", emitters, attractors, "DISTANCE")
+
+  def model(model_type, model_subtype):
+    if (model_type, model_subtype) not in fitted:
+      with contextlib.redirect_stdout(io.StringIO()):
+        fitted[(model_type, model_subtype)] = fit(model_type, model_subtype)
+    return fitted[(model_type, model_subtype)]
+
+  suite = []
+  for model_type in models._valid_types:
+    for model_subtype in models._valid_subtypes:
+      suite.append(Benchmark("fit.%s.%s" % (model_type, model_subtype),
+                             lambda data, model_type=model_type, model_subtype=model_subtype: fit(model_type, model_subtype, data),
+                             lambda: dataset.copy()))
+  for model_type in models._valid_types:
+    for model_subtype in models._valid_subtypes:
+      evaluate = lambda m: m(get_named_values(m.dataset, m.xo_cols), get_named_values(m.dataset, m.xd_cols))
+      suite.append(Benchmark("call.%s.%s" % (model_type, model_subtype), evaluate,
+                             lambda model_type=model_type, model_subtype=model_subtype: model(model_type, model_subtype)))
+
+  def apply_scenario(state):
+    scenario_data, data = state
+    for year in scenario_data.timeline():
+      scenario_data.apply(data, year)
+  with contextlib.redirect_stdout(io.StringIO()):
+    scenario_data = scenario.Scenario(scenario_file, ["D_HOUSEHOLDS", "D_JOBS"])
+  suite.append(Benchmark("scenario.apply", apply_scenario, lambda: (scenario_data, dataset.copy())))
+  suite.append(Benchmark("access_weighted_sum", lambda data: access_weighted_sum(data, "JOBS", "ACCESSIBILITY"), lambda: dataset.copy()))
+
+  # synthetic centroids (in metres) for the test dataset's zones
+  rng = np.random.RandomState(0)
+  centroids = pd.DataFrame({"lad16cd": zonal.GEOGRAPHY_CODE.values,
+                            "bng_e": rng.uniform(100000, 650000, len(zonal)), "bng_n": rng.uniform(0, 1000000, len(zonal))})
+  suite.append(Benchmark("calc_distances", calc_distances, lambda: centroids))
+  def store_distances(filename):
+    matrix_store.from_shapefile(centroids, filename)
+    matrix_store.open_matrix(filename).to_dataframe("DISTANCE")
+    os.remove(filename)
+  suite.append(Benchmark("matrix_store.distances", store_distances, lambda: os.path.join(tempfile.gettempdir(), "simim_benchmark_%d.mat" % os.getpid())))
+
+  # a projection year step (scenario, evaluation, deltas and baseline update), for each engine: the mean of the first
+  # two scenario years (the second without a baseline update)
+  def project(state, engine):
+    params, m, input_data, scenario_data, year = state
+    input_data.init_output(year, year + 1, m.zones())
+    if engine == "dense":
+      simim._project_dense(params, m, input_data, scenario_data, year, year + 1, 0.08)
+    else:
+      movers = dataset[["MIGRATIONS", "O_GEOGRAPHY_CODE"]].groupby("O_GEOGRAPHY_CODE").sum()
+      movers = input_data.get_people(2011, zonal.GEOGRAPHY_CODE).set_index("GEOGRAPHY_CODE").join(movers)
+      movers["MIGRATION_RATE"] = movers["MIGRATIONS"] / movers["PEOPLE"]
+      simim._project(params, m, input_data, scenario_data, movers, zonal.GEOGRAPHY_CODE.values, year, year + 1,
+                     input_data.get_people(year, zonal.GEOGRAPHY_CODE), 0.08)
+  def project_setup():
+    emitters, attractors = SPECS["gravity"]
+    params = {"emitters": emitters, "attractors": attractors, "cost": "DISTANCE"}
+    m = model("gravity", "pow")
+    m.dataset = dataset.copy()
+    with contextlib.redirect_stdout(io.StringIO()):
+      scenario_data = scenario.Scenario(scenario_file, emitters + attractors)
+    return params, m, LocalData(zonal), scenario_data, scenario_data.timeline()[0]
+  for engine in ["pandas", "dense"]:
+    suite.append(Benchmark("project_year.%s" % engine, lambda state, engine=engine: project(state, engine), project_setup, number=2))
+  return suite
+
+def metadata():
+  """ The machine, software versions and (if in a git checkout) commit that the benchmarks were run on """
+  import scipy
+  try:
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+  except OSError:
+    commit = None
+  return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+          "host": socket.gethostname(),
+          "platform": platform.platform(),
+          "processor": platform.processor() or platform.machine(),
+          "cpus": os.cpu_count(),
+          "python": sys.version.split()[0],
+          "numpy": np.__version__,
+          "pandas": pd.__version__,
+          "scipy": scipy.__version__,
+          "commit": commit}
+
+def run(suite, repeat=3, pattern=None):
+  """ Runs the benchmarks whose names contain pattern (or all of them), returning {name: timings} """
+  results = {}
+  for benchmark in suite:
+    if pattern is None or pattern in benchmark.name:
+      results[benchmark.name] = benchmark.run(repeat)
+      print("%-28s %10.4fs" % (benchmark.name, results[benchmark.name]["min"]), flush=True)
+  return results
+
+def append_history(filename, results):
+  """ Appends a record of the results, with the machine metadata, to a JSONL history file """
+  if os.path.dirname(filename) and not os.path.isdir(os.path.dirname(filename)):
+    os.makedirs(os.path.dirname(filename))
+  with open(filename, "a") as fd:
+    fd.write(json.dumps({"metadata": metadata(), "results": results}) + "\n")
+
+def save_baseline(filename, results):
+  if os.path.dirname(filename) and not os.path.isdir(os.path.dirname(filename)):
+    os.makedirs(os.path.dirname(filename))
+  with open(filename, "w") as fd:
+    json.dump({"metadata": metadata(), "results": results}, fd, indent=2)
+
+def load_baseline(filename):
+  with open(filename) as fd:
+    return json.load(fd)
+
+def compare(results, baseline, tolerance=0.1):
+  """ Compares (minimum) times against a baseline, as the ratio to and status (faster/slower/same) of each """
+  rows = []
+  for name, timings in results.items():
+    if name not in baseline["results"]:
+      continue
+    ratio = timings["min"] / baseline["results"][name]["min"]
+    status = "slower" if ratio > 1.0 + tolerance else "faster" if ratio < 1.0 - tolerance else "same"
+    rows.append({"BENCHMARK": name, "BASELINE": baseline["results"][name]["min"], "CURRENT": timings["min"], "RATIO": ratio, "STATUS": status})
+  return pd.DataFrame(rows, columns=["BENCHMARK", "BASELINE", "CURRENT", "RATIO", "STATUS"])
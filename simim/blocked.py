@@ -0,0 +1,84 @@
+"""
+blocked.py
+Out-of-core evaluation of NxN matrices in blocks of origin rows, for large zone systems (e.g. MSOA)
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+class BlockedMatrix():
+  """ An NxN matrix (memory-mapped .npy file or array), processed block_size origin rows at a time in parallel """
+  def __init__(self, matrix, block_size=1024, threads=None):
+    self.filename = matrix if isinstance(matrix, str) else None
+    self.matrix = np.load(matrix, mmap_mode="r") if isinstance(matrix, str) else matrix
+    if self.matrix.ndim != 2 or self.matrix.shape[0] != self.matrix.shape[1]:
+      raise ValueError("%s is not a square matrix" % (self.filename or "matrix"))
+    self.block_size = block_size
+    self.threads = threads or os.cpu_count()
+
+  @property
+  def shape(self):
+    return self.matrix.shape
+
+  def __len__(self):
+    return self.matrix.shape[0]
+
+  def blocks(self):
+    """ The (start, stop) origin rows of each block """
+    return [(start, min(start + self.block_size, len(self))) for start in range(0, len(self), self.block_size)]
+
+  def map(self, func):
+    """ Returns [func(start, stop, tile) for each block of rows] in block order (func must not modify shared state) """
+    def run(block):
+      start, stop = block
+      return func(start, stop, self.matrix[start:stop])
+    with ThreadPoolExecutor(self.threads) as pool:
+      return list(pool.map(run, self.blocks()))
+
+  def sum(self, axis=None):
+    """ Row (axis=1) or column (axis=0) totals, or the overall total """
+    if axis == 1:
+      return np.concatenate(self.map(lambda start, stop, tile: tile.sum(axis=1)))
+    totals = np.sum(self.map(lambda start, stop, tile: tile.sum(axis=0)), axis=0)
+    return totals if axis == 0 else totals.sum()
+
+  def matvec(self, x):
+    """ A @ x, for a length-N vector or N x k matrix """
+    return np.concatenate(self.map(lambda start, stop, tile: tile @ x))
+
+  def rmatvec(self, x):
+    """ A^T @ x, for a length-N vector or N x k matrix """
+    return np.sum(self.map(lambda start, stop, tile: tile.T @ x[start:stop]), axis=0)
+
+  def __getitem__(self, key):
+    """ Supports [rows, :], [:, columns] (gathered block by block) and [origins, destinations] (cells) """
+    rows, columns = key
+    if isinstance(columns, slice) and columns == slice(None):
+      return np.asarray(self.matrix[rows])
+    if isinstance(rows, slice) and rows == slice(None):
+      return np.concatenate(self.map(lambda start, stop, tile: tile[:, columns]))
+    return np.asarray(self.matrix[rows, columns])
+
+def flow_totals(origin, destination, cost, cost_function=None):
+  """ Returns the (inflows, outflows) of origin[o] * f(cost[o,d]) * destination[d], with cost a BlockedMatrix """
+  def totals(start, stop, tile):
+    factors = np.asarray(tile) if cost_function is None else cost_function(np.asarray(tile))
+    return origin[start:stop] * (factors @ destination), origin[start:stop] @ factors
+  results = cost.map(totals)
+  outflows = np.concatenate([outflows for outflows, _ in results])
+  inflows = destination * np.sum([inflows for _, inflows in results], axis=0)
+  return inflows, outflows
+
+def save_blocked(filename, n, func, block_size=1024, threads=None, dtype=np.float64):
+  """ Writes an NxN matrix to a .npy file block by block, where func(start, stop) returns the block's rows """
+  tmpfile = filename + ".tmp.npy"
+  matrix = np.lib.format.open_memmap(tmpfile, mode="w+", dtype=dtype, shape=(n, n))
+  def run(start):
+    stop = min(start + block_size, n)
+    matrix[start:stop] = func(start, stop)
+  with ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+    list(pool.map(run, range(0, n, block_size)))
+  matrix.flush()
+  del matrix
+  os.replace(tmpfile, filename)
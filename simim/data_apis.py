@@ -6,6 +6,9 @@ import requests
 import zipfile
 import re
 import warnings
+import functools
+import threading
+from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
@@ -24,29 +27,269 @@ import ukpopulation.snhpdata as SNHPData
 import ukpopulation.utils as ukpoputils
 
 import simim.utils as utils
+import simim.matrix_store as matrix_store
+import simim.geography as geography
+from simim.profiling import Profiler, timed, nbytes, MB
+from simim.dense import ZoneIndex
+from simim.prefetch import Pipeline
+
+# 2011 census OD migrations by (census merged) LAD
+UK_CMLAD_CODES = "1132462081...1132462085,1132462127,1132462128,1132462356...1132462360,1132462086...1132462089,1132462129,1132462130,1132462145...1132462150,1132462229...1132462240,1132462337...1132462351,1132462090...1132462094,1132462269...1132462275,1132462352...1132462355,1132462368...1132462372,1132462095...1132462098,1132462151...1132462158,1132462241...1132462254,1132462262...1132462268,1132462276...1132462282,1132462099...1132462101,1132462131,1132462293...1132462300,1132462319...1132462323,1132462331...1132462336,1132462361...1132462367,1132462111...1132462114,1132462134,1132462135,1132462140...1132462144,1132462178...1132462189,1132462207...1132462216,1132462255...1132462261,1132462301...1132462307,1132462373...1132462404,1132462115...1132462126,1132462136...1132462139,1132462173...1132462177,1132462196...1132462206,1132462217...1132462228,1132462283...1132462287,1132462308...1132462318,1132462324...1132462330,1132462102,1132462103,1132462132,1132462133,1132462104...1132462110,1132462159...1132462172,1132462190...1132462195,1132462288...1132462292,1132462405...1132462484"
+OD_TABLE = "MM01CUK_ALL"
+OD_QUERY = {
+  "date": "latest",
+  "usual_residence": UK_CMLAD_CODES,
+  "address_one_year_ago": UK_CMLAD_CODES,
+  "age": 0,
+  "c_sex": 0,
+  "measures": 20100,
+  "select": "ADDRESS_ONE_YEAR_AGO_CODE,USUAL_RESIDENCE_CODE,OBS_VALUE"
+}
+
+# Cambridge Econometrics economic baseline (JOBS and GVA by LAD and year)
+ECONOMIC_BASELINE_FILE = "./data/arc/arc_economic_baseline_for_simim.csv"
+# GVA is held at its value in this year beyond it
+GVA_MAX_YEAR = 2050
+
+# GB ultra generalised clipped LAD boundaries/centroids
+# baseline accessibility, a long-format CSV or matrix store file
+ACCESSIBILITY_FILE = "./data/access_baseline_road_rail.csv"
+
+SHAPEFILE_URL = "https://opendata.arcgis.com/datasets/686603e943f948acaa13fb5d2b0f1275_4.zip?outSR=%7B%22wkid%22%3A27700%2C%22latestWkid%22%3A27700%7D"
+
+class Panel():
+  """ Input data for a contiguous range of years and a set of zones, as (years x zones) arrays """
+  def __init__(self, years, geogs):
+    self.years = np.array(years)
+    self.geogs = np.array(geogs)
+    self.data = {}
+
+  def __getitem__(self, name):
+    return self.data[name]
+
+  def __setitem__(self, name, values):
+    assert values.shape == (len(self.years), len(self.geogs))
+    self.data[name] = values
+
+  def __contains__(self, name):
+    return name in self.data
+
+  def __row(self, year):
+    if year < self.years[0] or year > self.years[-1]:
+      raise ValueError("year %d is outside the panel range %d-%d" % (year, self.years[0], self.years[-1]))
+    return year - self.years[0]
+
+  def get(self, name, year):
+    """ Returns the values for the given year (in zone order) """
+    return self.data[name][self.__row(year)]
+
+  def delta(self, name, year):
+    """ Returns the absolute change in values from the previous year """
+    return self.get(name, year) - self.get(name, year - 1)
+
+  def ratio(self, name, year):
+    """ Returns the relative change in values from the previous year """
+    return self.get(name, year) / self.get(name, year - 1)
+
+  def set(self, name, year, values):
+    """ Sets, in place, the values for the given year (in zone order) """
+    self.data[name][self.__row(year)] = values
+
+  def to_dataframe(self, names, years=None):
+    """ Returns the given values in long format (one row per year and zone), optionally only for the given years """
+    if years is None:
+      years = self.years
+    rows = [self.__row(year) for year in years]
+    data = pd.DataFrame({"GEOGRAPHY_CODE": np.tile(self.geogs, len(rows))})
+    for name in names:
+      data[name] = self.data[name][rows].ravel()
+    data["PROJECTED_YEAR_NAME"] = np.repeat(np.array(years), len(self.geogs))
+    return data
+
+def _pivot(data, years, geogs, value="OBS_VALUE"):
+  """ Pivots long-format data (GEOGRAPHY_CODE, PROJECTED_YEAR_NAME, value) into a (years x geogs) array """
+  data = data.pivot_table(index="PROJECTED_YEAR_NAME", columns="GEOGRAPHY_CODE", values=value, aggfunc="sum") \
+    .reindex(index=years, columns=geogs)
+  if data.isnull().values.any():
+    missing = data.index[data.isnull().all(axis=1)].values
+    if len(missing):
+      raise ValueError("%s data missing for years %s" % (value, str(missing)))
+    missing = data.columns[data.isnull().any(axis=0)].values
+    raise ValueError("%s data missing for geographies %s" % (value, str(missing)))
+  return data.values.astype(float)
+
+def _check_gva_year(year):
+  if year > GVA_MAX_YEAR:
+    print("using latest available (%d) GVA projection" % GVA_MAX_YEAR)
+
+def _extrapolate(data, data_years, years):
+  """ Returns rows of a (data_years x zones) array for years, extrapolating linearly beyond data_years """
+  years = np.asarray(years)
+  rows = np.clip(years - data_years[0], 0, len(data_years) - 1)
+  result = data[rows]
+  below = years < data_years[0]
+  above = years > data_years[-1]
+  result[below] += np.outer(data_years[0] - years[below], data[0] - data[1])
+  result[above] += np.outer(years[above] - data_years[-1], data[-1] - data[-2])
+  return result
+
+class EconomicBaseline():
+  """ Economic baseline data (JOBS and GVA) as (years x zones) arrays, held beyond the given years """
+  def __init__(self, data, names=("JOBS", "GVA"), held=None):
+    self.zones = ZoneIndex(data.GEOGRAPHY_CODE.unique())
+    self.years = np.arange(data.YEAR.min(), data.YEAR.max() + 1)
+    self.held = held or {}
+    data = data.rename({"YEAR": "PROJECTED_YEAR_NAME"}, axis=1)
+    self.data = { name: _pivot(data, self.years, self.zones.codes, name) for name in names }
+
+  @classmethod
+  def from_csv(cls, filename, held=None):
+    """ Loads a long-format CSV with YEAR, GEOGRAPHY_CODE and value columns """
+    return cls(pd.read_csv(filename), held=held)
+
+  def __rows(self, name, years):
+    years = np.asarray(years)
+    if name in self.held:
+      years = np.minimum(years, self.held[name])
+    if np.any(years < self.years[0]) or np.any(years > self.years[-1]):
+      raise ValueError("years %s are outside the economic data range %d-%d" % (str(years), self.years[0], self.years[-1]))
+    return years - self.years[0]
+
+  def __columns(self, geogs):
+    try:
+      return self.zones.index(geogs)
+    except KeyError as error:
+      raise ValueError("economic data missing for geography %s" % error)
+
+  def known(self, geogs):
+    """ Returns those of the given geographies that have data, in the same order """
+    return [geog for geog in geogs if geog in self.zones]
+
+  def values(self, name, years, geogs):
+    """ Returns a (years x geogs) array of values, in the order of geogs """
+    return self.data[name][np.ix_(self.__rows(name, years), self.__columns(geogs))]
+
+  def deltas(self, name, years, geogs):
+    """ Returns a (years x geogs) array of the absolute changes in values from the previous year """
+    values = self.data[name][:, self.__columns(geogs)]
+    return values[self.__rows(name, years)] - values[self.__rows(name, np.asarray(years) - 1)]
+
+class LRUCache():
+  """ Least-recently-used cache bounded by the total size in bytes of its values, with hit and miss statistics """
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    # (entries may be fetched and stored from several threads, see prefetch)
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, key):
+    """ Returns the cached value, or None """
+    with self.lock:
+      if key not in self.entries:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.entries.move_to_end(key)
+      return self.entries[key][0]
+
+  def put(self, key, value):
+    size = nbytes(value)
+    with self.lock:
+      if key in self.entries:
+        self.bytes -= self.entries.pop(key)[1]
+      # (a value larger than the budget is not cached)
+      if size > self.max_bytes:
+        return
+      while self.bytes + size > self.max_bytes:
+        _, (_, evicted_size) = self.entries.popitem(last=False)
+        self.bytes -= evicted_size
+        self.evictions += 1
+      self.entries[key] = (value, size)
+      self.bytes += size
+
+  def stats(self):
+    requests = self.hits + self.misses
+    return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / requests if requests else None,
+            "evictions": self.evictions, "entries": len(self.entries), "mb": self.bytes / MB, "max_mb": self.max_bytes / MB}
+
+def memoised(method):
+  """ Caches the results of an Instance data accessor method(self, year, geogs) in self.data_cache """
+  @functools.wraps(method)
+  def wrapper(self, year, geogs):
+    cache = getattr(self, "data_cache", None)
+    if cache is None:
+      return method(self, year, geogs)
+    key = (method.__name__, year, frozenset([geogs] if isinstance(geogs, str) else geogs))
+    data = cache.get(key)
+    if data is None:
+      data = method(self, year, geogs)
+      cache.put(key, data)
+    return data.copy()
+  return wrapper
 
 class Instance():
   def __init__(self, params):
 
+    # timing (and optionally memory) spans for the run, see profiling
+    self.profiler = Profiler(memory=params.get("profile_memory", False))
+    # results of the (ukpopulation) data accessors, by year and geographies
+    self.data_cache = LRUCache(params.get("data_cache_mb", 256) * MB)
+    self.profiler.counters["data_cache"] = self.data_cache.stats
+
     self.coverage = { "EW": ukpoputils.EW, "GB": ukpoputils.GB, "UK": ukpoputils.UK }.get(params["coverage"])
     if not self.coverage:
       raise RuntimeError("invalid coverage: %s" % params["coverage"])
 
     self.cache_dir = params["cache_dir"]
-    # initialise data sources
-    self.census_ew = Nomisweb.Nomisweb(self.cache_dir)
-    self.census_sc = NRScotland.NRScotland(self.cache_dir)
-    self.census_ni = NISRA.NISRA(self.cache_dir)
-    # population projections
-    self.mye = MYEData.MYEData(self.cache_dir)
-    self.snpp = SNPPData.SNPPData(self.cache_dir)
-    self.npp = NPPData.NPPData(self.cache_dir)
-    # households
     self.baseline = params["base_projection"]
 
     if not os.path.isdir(params["output_dir"]):
       raise ValueError("Output directory %s not found" % params["output_dir"])
 
+    self.configure_output(params)
+
+    # initialise the data sources (which may download and parse data) concurrently. Each ukpopulation/ukcensusapi object is
+    # constructed (and, later, queried) by a single stage at a time, as they are not thread-safe; they share only the
+    # cache directory, which is created first so that their checks for it don't race
+    if not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir, exist_ok=True)
+    self.prefetch_threads = params.get("prefetch_threads")
+    print("Using economic baseline data supplied by Cambridge Econometrics", flush=True)
+    sources = Pipeline("init", self.prefetch_threads, self.profiler)
+    sources.add("census_ew", lambda: Nomisweb.Nomisweb(self.cache_dir))
+    sources.add("census_sc", lambda: NRScotland.NRScotland(self.cache_dir))
+    sources.add("census_ni", lambda: NISRA.NISRA(self.cache_dir))
+    # population projections
+    sources.add("mye", lambda: MYEData.MYEData(self.cache_dir))
+    sources.add("snpp", lambda: SNPPData.SNPPData(self.cache_dir))
+    sources.add("npp", lambda: NPPData.NPPData(self.cache_dir))
+    # households
+    sources.add("snhp", lambda: SNHPData.SNHPData(self.cache_dir))
+    sources.add("economic_baseline", lambda: EconomicBaseline.from_csv(ECONOMIC_BASELINE_FILE, held={"GVA": GVA_MAX_YEAR}))
+    for name, source in sources.run().items():
+      setattr(self, name, source)
+
+    # holder for shapefile when requested
+    self.shapefile = None
+    self.shapefile_url = SHAPEFILE_URL
+
+    # OA-LSOA-MSOA-LAD-CMLAD lookup table (converted into the geography store on first use), see geography
+    self.lad_lookup_file = "./data/gb_geog_lookup.csv.gz"
+    self.__geography = None
+
+    # opened (from the matrix store) on first use
+    self.accessibility_file = params.get("accessibility_matrix", ACCESSIBILITY_FILE)
+    self.__accessibility = None
+
+  def configure_output(self, params):
+    """ Sets the output file names (which depend on the scenario) and resets the output data """
     self.disaggregated_output = params.get("disaggregated_output", False)
 
     # record od scenario in output filename
@@ -71,39 +314,29 @@ class Instance():
         scale
       ))
     self.custom_snpp_variant_name = "simim_%s" % os.path.basename(params["scenario"])[:-4]
-    self.custom_snpp_variant = pd.DataFrame()
-
-    self.snhp = SNHPData.SNHPData(self.cache_dir)
-
-    print("Using economic baseline data supplied by Cambridge Econometrics", flush=True)
-    self.economic_data = pd.read_csv('./data/arc/arc_economic_baseline_for_simim.csv')
-
-    # holder for shapefile when requested
-    self.shapefile = None
-
-    self.accessibility = pd.read_csv("./data/access_baseline_road_rail.csv")
-
+    # optional timing (and memory) report (JSON summary and JSONL spans)
+    self.profile_file = None
+    if params.get("profile") or params.get("profile_memory"):
+      self.profile_file = self.summary_output_file.replace("simim_", "profile_").replace(".csv", ".json")
+    # allocated by init_output
+    self.output = None
+    self.ensemble_quantiles = None
+    self.output_years = []
+    self.__custom_snpp_variant = None
+
+  @timed("fetch.od")
   def get_od(self):
 
     # get OD data
     # more up-to-date here (E&W by LAD, Scotland & NI by country)
     # https://www.ons.gov.uk/peoplepopulationandcommunity/populationandmigration/migrationwithintheuk/datasets/internalmigrationbyoriginanddestinationlocalauthoritiessexandsingleyearofagedetailedestimatesdataset
 
-    uk_cmlad_codes="1132462081...1132462085,1132462127,1132462128,1132462356...1132462360,1132462086...1132462089,1132462129,1132462130,1132462145...1132462150,1132462229...1132462240,1132462337...1132462351,1132462090...1132462094,1132462269...1132462275,1132462352...1132462355,1132462368...1132462372,1132462095...1132462098,1132462151...1132462158,1132462241...1132462254,1132462262...1132462268,1132462276...1132462282,1132462099...1132462101,1132462131,1132462293...1132462300,1132462319...1132462323,1132462331...1132462336,1132462361...1132462367,1132462111...1132462114,1132462134,1132462135,1132462140...1132462144,1132462178...1132462189,1132462207...1132462216,1132462255...1132462261,1132462301...1132462307,1132462373...1132462404,1132462115...1132462126,1132462136...1132462139,1132462173...1132462177,1132462196...1132462206,1132462217...1132462228,1132462283...1132462287,1132462308...1132462318,1132462324...1132462330,1132462102,1132462103,1132462132,1132462133,1132462104...1132462110,1132462159...1132462172,1132462190...1132462195,1132462288...1132462292,1132462405...1132462484"
-    table = "MM01CUK_ALL"
-    query_params = {
-      "date": "latest",
-      "usual_residence": uk_cmlad_codes,
-      "address_one_year_ago": uk_cmlad_codes,
-      "age": 0,
-      "c_sex": 0,
-      "measures": 20100,
-      "select": "ADDRESS_ONE_YEAR_AGO_CODE,USUAL_RESIDENCE_CODE,OBS_VALUE"
-    }
-    od = self.census_ew.get_data(table, query_params)
+    od = self.census_ew.get_data(OD_TABLE, OD_QUERY)
     #print(od_2011.USUAL_RESIDENCE_CODE.unique())
     return od
 
+  @timed("fetch.people")
+  @memoised
   def get_people(self, year, geogs):
 
     if isinstance(geogs, str):
@@ -128,6 +361,83 @@ class Instance():
 
     return alldata
 
+  @timed("fetch.panel")
+  def get_panel(self, start_year, end_year, geogs):
+    """Obtain PEOPLE, HOUSEHOLDS, JOBS and GVA for every year from start_year to end_year inclusive, in a single pass
+    Arguments
+    ---------
+    start_year : int
+    end_year : int
+    geogs : list
+    Returns
+    -------
+    Panel (years x geogs arrays, in the order of geogs)
+    """
+    years = list(range(start_year, end_year + 1))
+    panel = Panel(years, geogs)
+    panel["PEOPLE"] = self.__people_panel(years, geogs)
+    panel["HOUSEHOLDS"] = self.get_households_projection(years, geogs)
+
+    panel["JOBS"] = self.economic_baseline.values("JOBS", years, geogs)
+    _check_gva_year(end_year)
+    panel["GVA"] = self.economic_baseline.values("GVA", years, geogs)
+    return panel
+
+  def __people_panel(self, years, geogs):
+    """ As get_people, but for multiple years. Each data source is queried once for all the years it covers """
+    alldata = []
+    bycountry = ukpoputils.split_by_country(geogs)
+    for country in bycountry:
+      if not bycountry[country]: continue
+      min_year = self.snpp.min_year(country)
+      max_year = self.snpp.max_year(country)
+      mye_years = [year for year in years if year < min_year]
+      snpp_years = [year for year in years if min_year <= year <= max_year]
+      npp_years = [year for year in years if year > max_year]
+      if mye_years:
+        alldata.append(self.mye.aggregate(["GENDER", "C_AGE"], bycountry[country], mye_years))
+      if snpp_years:
+        alldata.append(self.snpp.aggregate(["GENDER", "C_AGE"], bycountry[country], snpp_years))
+      if npp_years:
+        alldata.append(self.snpp.extrapolagg(["GENDER", "C_AGE"], self.npp, bycountry[country], npp_years))
+    return _pivot(pd.concat(alldata, ignore_index=True, sort=False), years, geogs)
+
+  def __snhp_panels(self, geogs):
+    """ SNHP households for every year of each country's projection, as a (cached) Panel per country """
+    key = ("snhp", frozenset(geogs))
+    panels = self.data_cache.get(key)
+    if panels is None:
+      panels = {}
+      bycountry = ukpoputils.split_by_country(geogs)
+      for country in bycountry:
+        if not bycountry[country]: continue
+        years = list(range(self.snhp.min_year(country), self.snhp.max_year(country) + 1))
+        panels[country] = Panel(years, bycountry[country])
+        panels[country]["HOUSEHOLDS"] = _pivot(self.snhp.aggregate(bycountry[country], years), years, bycountry[country])
+      self.data_cache.put(key, panels)
+    return panels
+
+  @timed("fetch.households_projection")
+  def get_households_projection(self, years, geogs):
+    """Obtain households for multiple years. Years outside a country's SNHP range are linearly extrapolated (per zone)
+    from the two years at that end of the range
+    Arguments
+    ---------
+    years : list
+    geogs : list
+    Returns
+    -------
+    numpy.ndarray (years x geogs, in the order of geogs)
+    """
+    columns = pd.Index(geogs)
+    households = np.full((len(years), len(geogs)), np.nan)
+    for panel in self.__snhp_panels(geogs).values():
+      households[:, columns.get_indexer(panel.geogs)] = _extrapolate(panel["HOUSEHOLDS"], panel.years, years)
+    missing = np.isnan(households).any(axis=0)
+    if missing.any():
+      raise ValueError("HOUSEHOLDS data missing for geographies %s" % str(np.asarray(geogs)[missing]))
+    return households
+
   # this is 2011 census data
   def get_households2011(self, geogs):
 
@@ -161,6 +471,7 @@ class Instance():
     households.rename({"OBS_VALUE": "HOUSEHOLDS"}, axis=1, inplace=True)
     return households
 
+  @timed("fetch.households")
   def get_households(self, year, geogs):
     """Obtain actual and extrapolated household data for all other LADs
     Arguments
@@ -171,36 +482,10 @@ class Instance():
     -------
     pandas.DataFrame
     """
-
-    geogs = ukpoputils.split_by_country(geogs)
-
-    allsnhp = pd.DataFrame()
-
-    for country in geogs:
-      if not geogs[country]: continue
-      max_year = self.snhp.max_year(country)
-      min_year = self.snhp.min_year(country)
-
-      if year <= max_year:
-        if year <= min_year:
-          snhp = self.snhp.aggregate(geogs[country], min_year+1).merge(
-                      self.snhp.aggregate(geogs[country], min_year),
-                      left_on="GEOGRAPHY_CODE", right_on="GEOGRAPHY_CODE")
-          snhp["HOUSEHOLDS"] = snhp.OBS_VALUE_y + (snhp.OBS_VALUE_y - snhp.OBS_VALUE_x) * (min_year - year)
-          snhp["PROJECTED_YEAR_NAME"] = year
-          snhp.drop(["PROJECTED_YEAR_NAME_x", "OBS_VALUE_x", "PROJECTED_YEAR_NAME_y", "OBS_VALUE_y"], axis=1, inplace=True)
-        else:
-          snhp = self.snhp.aggregate(geogs[country], year).rename({"OBS_VALUE": "HOUSEHOLDS"}, axis=1)
-      else:
-        snhp = self.snhp.aggregate(geogs[country], max_year-1) \
-                        .merge(self.snhp.aggregate(geogs[country], max_year),left_on="GEOGRAPHY_CODE", right_on="GEOGRAPHY_CODE")
-        snhp["HOUSEHOLDS"] = snhp.OBS_VALUE_y + (snhp.OBS_VALUE_y - snhp.OBS_VALUE_x) * (year - max_year)
-        snhp["PROJECTED_YEAR_NAME"] = year
-        snhp.drop(["PROJECTED_YEAR_NAME_x", "OBS_VALUE_x", "PROJECTED_YEAR_NAME_y", "OBS_VALUE_y"], axis=1, inplace=True)
-
-      allsnhp = allsnhp.append(snhp, ignore_index=True, sort=False)
-
-    return allsnhp
+    geogs = [geogs] if isinstance(geogs, str) else list(geogs)
+    return pd.DataFrame({"GEOGRAPHY_CODE": geogs,
+                         "PROJECTED_YEAR_NAME": year,
+                         "HOUSEHOLDS": self.get_households_projection([year], geogs)[0]})
 
   # def get_jobs(self, year, geogs):
   #   """
@@ -234,17 +519,38 @@ class Instance():
   #   jobs.columns = jobs.columns.map("".join)
   #   return jobs.rename({"OBS_VALUEJobs density": "JOBS_PER_WORKING_AGE_PERSON", "OBS_VALUETotal jobs": "JOBS"}, axis=1)
 
+  @timed("fetch.jobs")
   def get_jobs(self, year, geogs):
-    return self.economic_data[(self.economic_data.YEAR == year) & (self.economic_data.GEOGRAPHY_CODE.isin(geogs))].drop("GVA", axis=1)
+    return self.__economic_data("JOBS", year, geogs)
 
+  @timed("fetch.gva")
   def get_gva(self, year, geogs):
-    if year > 2050:
-      print("using latest available (2050) GVA projection")
-      year = 2050
-    return self.economic_data[(self.economic_data.YEAR == year) & (self.economic_data.GEOGRAPHY_CODE.isin(geogs))].drop("JOBS", axis=1)
-
+    _check_gva_year(year)
+    return self.__economic_data("GVA", year, geogs)
+
+  @timed("fetch.economic_delta")
+  def get_economic_delta(self, name, year, geogs):
+    """ The change in JOBS or GVA from the previous year (as simim._get_delta), for the geographies that have data """
+    geogs = self.economic_baseline.known(geogs)
+    return pd.DataFrame({"GEOGRAPHY_CODE": geogs, name + "_DELTA": self.economic_baseline.deltas(name, [year], geogs)[0]})
+
+  def __economic_data(self, name, year, geogs):
+    geogs = self.economic_baseline.known(geogs)
+    return pd.DataFrame({"YEAR": year, "GEOGRAPHY_CODE": geogs, name: self.economic_baseline.values(name, [year], geogs)[0]})
+
+  @property
+  def accessibility(self):
+    """ The accessibility matrix_store.ZoneMatrix (a CSV is converted into the store in cache_dir on first use) """
+    if self.__accessibility is None:
+      self.__accessibility = matrix_store.open_cached(self.accessibility_file, "ACCESSIBILITY", self.cache_dir)
+    return self.__accessibility
+
+  @timed("fetch.accessibility")
   def get_accessibility(self, dataset):
-    od = self.accessibility
+    """ Accessibility of the OD pairs in the dataset (pairs not in the accessibility matrix are omitted) """
+    od = dataset[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE"]].drop_duplicates()
+    od["ACCESSIBILITY"] = self.accessibility.cells(od.O_GEOGRAPHY_CODE.values, od.D_GEOGRAPHY_CODE.values)
+    od = od[~np.isnan(od.ACCESSIBILITY.values)]
 
     # Dummy data option (requires dataset to be passed in)
     # use the same structure as migration data and accessibility of 1 for intra-LAD, 0 otherwise
@@ -253,13 +559,15 @@ class Instance():
     # od.loc[od.O_GEOGRAPHY_CODE == od.D_GEOGRAPHY_CODE, "ACCESSIBILITY"] = 1.0
     return od
 
+  @timed("fetch.shapefile")
   def get_shapefile(self, zip_url=None):
     """
     Gets and stores a shapefile from the given URL
     same shapefile can be subsequently retrieved by calling this function without the zip_url arg
-    Fails if no url is supplied and none has previously been specified
+    (if none has been loaded yet, e.g. when the OD data came from the cache, the default url is used)
     """
-    assert self.shapefile is not None or zip_url is not None
+    if self.shapefile is None and zip_url is None:
+      zip_url = self.shapefile_url
     if zip_url is not None:
       local_zipfile = os.path.join(self.cache_dir, utils.md5hash(zip_url) + ".zip")
       if not os.path.isfile(local_zipfile):
@@ -283,40 +591,97 @@ class Instance():
       self.shapefile = gpd.read_file(os.path.join(self.cache_dir, shapefile))
     return self.shapefile
 
+  @timed("fetch.distances")
+  def get_distances(self):
+    """ The matrix_store.ZoneMatrix of distances (km) between LAD centroids, computed from the shapefile into the store in cache_dir on first use """
+    filename = os.path.join(self.cache_dir, "DISTANCE_%s.mat" % utils.md5hash(self.shapefile_url))
+    if not os.path.isfile(filename):
+      matrix_store.from_shapefile(self.get_shapefile(self.shapefile_url), filename)
+    return matrix_store.open_matrix(filename)
+
+  @property
+  def geography(self):
+    """ The geography.Geography hierarchy (a CSV lookup is converted into the store in cache_dir on first use) """
+    if self.__geography is None:
+      self.__geography = geography.open_cached(self.lad_lookup_file, self.cache_dir)
+    return self.__geography
+
+  @timed("fetch.lad_lookup")
   def get_lad_lookup(self):
-    lookup = pd.read_csv("./data/gb_geog_lookup.csv.gz")
     # only need the CMLAD->LAD mapping
-    return lookup[["LAD_CM", "LAD"]].drop_duplicates().reset_index(drop=True)
+    return self.geography.lookup("LAD", "LAD_CM")[["LAD_CM", "LAD"]]
+
+  def init_output(self, start_year, end_year, geogs, quantiles=None):
+    """ Preallocates the (years x zones) output arrays (and ensemble quantiles) filled by append_output """
+    self.output = Panel(range(start_year, end_year + 1), geogs)
+    for name in ["PEOPLE_SNPP", "PEOPLE", "NET_DELTA"]:
+      self.output[name] = np.full((len(self.output.years), len(self.output.geogs)), np.nan)
+    self.ensemble_quantiles = quantiles
+    if quantiles is not None:
+      for name in self.ensemble_names():
+        self.output[name] = np.full((len(self.output.years), len(self.output.geogs)), np.nan)
+    self.output_years = []
+    self.__output_index = pd.Index(self.output.geogs)
+    self.__custom_snpp_variant = None
 
   def append_output(self, dataset, year):
-    localdataset = dataset.copy()
-    localdataset["PROJECTED_YEAR_NAME"] = year
-    self.custom_snpp_variant = self.custom_snpp_variant.append(localdataset, ignore_index=True, sort=False)
+    """ Stores the year's PEOPLE and PEOPLE_SNPP by zone (dataset has a GEOGRAPHY_CODE column) """
+    index = self.__output_index.get_indexer(dataset.GEOGRAPHY_CODE.values)
+    if (index < 0).any():
+      raise ValueError("output contains zones not passed to init_output")
+    for name in ["PEOPLE_SNPP", "PEOPLE"]:
+      self.output[name][year - self.output.years[0], index] = dataset[name].values
+    self.output.set("NET_DELTA", year, self.output.get("PEOPLE", year) - self.output.get("PEOPLE_SNPP", year))
+    if year not in self.output_years:
+      self.output_years.append(year)
+    self.__custom_snpp_variant = None
+
+  def ensemble_names(self):
+    """ The names of the ensemble quantile outputs, e.g. PEOPLE_P5 for the 5th percentile """
+    return ["PEOPLE_P%g" % (100 * q) for q in self.ensemble_quantiles]
+
+  def append_ensemble_output(self, people, year):
+    """ Stores the year's quantiles of population by zone over an ensemble, given as a (draws x zones) array in zone order """
+    for name, values in zip(self.ensemble_names(), np.quantile(people, self.ensemble_quantiles, axis=0)):
+      self.output.set(name, year, values)
+
+  @property
+  def custom_snpp_variant(self):
+    """ The output so far in long format, materialised (once) on demand """
+    if self.__custom_snpp_variant is None:
+      if self.output is None:
+        return pd.DataFrame()
+      self.__custom_snpp_variant = self.output.to_dataframe(["PEOPLE_SNPP", "PEOPLE"], sorted(self.output_years))
+    return self.__custom_snpp_variant
 
   def summarise_output(self, scenario):
-    horizon = self.custom_snpp_variant.PROJECTED_YEAR_NAME.unique().max()
+    horizon = max(self.output_years)
     scen_horizon = min(horizon, scenario.data.YEAR.max())
     print("Cumulative scenario at %d" % scen_horizon)
     print(scenario.data.groupby("GEOGRAPHY_CODE").sum().drop("YEAR", axis=1))
     print("Summary at horizon year: %d" % horizon)
     print("In-region population changes:")
-    inreg = self.custom_snpp_variant[(self.custom_snpp_variant.PROJECTED_YEAR_NAME == horizon)
-                                   & (self.custom_snpp_variant.GEOGRAPHY_CODE.isin(scenario.geographies()))]
+    horizon_output = self.output.to_dataframe(["PEOPLE_SNPP", "PEOPLE"], [horizon])
+    inreg = horizon_output[horizon_output.GEOGRAPHY_CODE.isin(scenario.geographies())]
     print("TOTAL: %.0f baseline vs %.0f scenario (increase of %.0f)"
       % (inreg.PEOPLE_SNPP.sum(), inreg.PEOPLE.sum(), inreg.PEOPLE.sum() - inreg.PEOPLE_SNPP.sum()))
     print(inreg)
 
     print("10 largest migration origins:")
-    self.custom_snpp_variant["net_delta"] = self.custom_snpp_variant.PEOPLE - self.custom_snpp_variant.PEOPLE_SNPP
-    print(self.custom_snpp_variant[self.custom_snpp_variant.PROJECTED_YEAR_NAME == horizon]
-                            .nsmallest(10, "net_delta").drop("net_delta", axis=1))
+    print(horizon_output.iloc[np.argsort(self.output.get("NET_DELTA", horizon), kind="stable")[:10]])
 
+  @timed("output.write")
   def write_output(self):
     # save the summary info
     print("writing summary custom SNPP variant data to %s" % self.summary_output_file)
-    self.custom_snpp_variant.drop(["PEOPLE_PREV", "PEOPLE_DELTA", "net_delta"], axis=1, inplace=True)
-    self.custom_snpp_variant["RELATIVE_DELTA"] = self.custom_snpp_variant.PEOPLE / self.custom_snpp_variant.PEOPLE_SNPP
-    self.custom_snpp_variant.to_csv(self.summary_output_file, index=False)
+    output = self.custom_snpp_variant
+    output["RELATIVE_DELTA"] = output.PEOPLE / output.PEOPLE_SNPP
+    output.to_csv(self.summary_output_file, index=False)
+
+    if self.ensemble_quantiles is not None:
+      ensemble_output_file = self.summary_output_file.replace("simim_", "ensemble_")
+      print("writing ensemble quantiles to %s" % ensemble_output_file)
+      self.output.to_dataframe(["PEOPLE"] + self.ensemble_names(), sorted(self.output_years)).to_csv(ensemble_output_file, index=False)
 
     # disaggregated (by age & gender) output is large and requires work to generate so not produced unless specifically requested in config
     if self.disaggregated_output:
@@ -348,8 +713,15 @@ class Instance():
       # leave RELATIVE_DELTA in data
       CustomSNPPData.register_custom_projection(self.custom_snpp_variant_name, alldata.drop(["PEOPLE_SNPP", "PEOPLE"], axis=1), self.cache_dir)
 
+  @timed("output.odmatrix")
   def write_odmatrix(self, odmatrix):
     output_file = self.summary_output_file.replace("simim_", "odmatrix_")
 
     print("writing OD matrix to %s" % output_file)
     odmatrix.to_csv(output_file, index=False)
+
+  def write_profile(self):
+    """ Writes the timing (and memory) report, if enabled (by the "profile" or "profile_memory" config settings) """
+    if self.profile_file is not None:
+      print("writing timing report to %s" % self.profile_file)
+      self.profiler.write(self.profile_file)
@@ -0,0 +1,191 @@
+"""
+dense.py
+Dense array representation of the model dataset: zonal factors as vectors and OD values as NxN arrays
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from simim.blocked import BlockedMatrix
+
+ORIGIN_PREFIX = "O_"
+DESTINATION_PREFIX = "D_"
+
+def _strip_prefix(colname):
+  if colname.startswith(ORIGIN_PREFIX) or colname.startswith(DESTINATION_PREFIX):
+    return colname[2:]
+  return colname
+
+class ZoneIndex():
+  """ Maps geography codes to integer zone indices (codes are sorted, to match the model ordering) """
+  def __init__(self, codes):
+    self.codes = np.array(sorted(set(codes)))
+    self.lookup = dict(zip(self.codes, range(len(self.codes))))
+
+  def __len__(self):
+    return len(self.codes)
+
+  def __contains__(self, code):
+    return code in self.lookup
+
+  def index(self, codes):
+    """ Returns the zone indices of the given codes, raises KeyError for unknown codes """
+    if isinstance(codes, str):
+      return self.lookup[codes]
+    return np.array([self.lookup[c] for c in codes], dtype=int)
+
+  def mask(self, predicate):
+    """ Returns a boolean mask of zones whose code satisfies the predicate """
+    return np.array([predicate(c) for c in self.codes], dtype=bool)
+
+class DenseDataset():
+  """ Zonal factors (O_X and D_X both map to X) as length-N vectors and OD values as NxN arrays """
+  def __init__(self, zones, o_index, d_index):
+    self.zones = zones
+    self.o_index = o_index
+    self.d_index = d_index
+    self.factors = {}
+    self.od = {}
+
+  @classmethod
+  def from_dataframe(cls, dataset, factors, od_cols):
+    """ Constructs from a long-format OD dataset. Zonal factors are taken from the D_ column, or the O_ column if there is no D_ column """
+    zones = ZoneIndex(np.union1d(dataset.O_GEOGRAPHY_CODE.unique(), dataset.D_GEOGRAPHY_CODE.unique()))
+    dense = cls(zones, zones.index(dataset.O_GEOGRAPHY_CODE.values), zones.index(dataset.D_GEOGRAPHY_CODE.values))
+    n = len(zones)
+    for factor in factors:
+      if DESTINATION_PREFIX + factor in dataset.columns.values:
+        dense.factors[factor] = np.zeros(n)
+        dense.factors[factor][dense.d_index] = dataset[DESTINATION_PREFIX + factor].values
+      else:
+        dense.factors[factor] = np.zeros(n)
+        dense.factors[factor][dense.o_index] = dataset[ORIGIN_PREFIX + factor].values
+    for col in od_cols:
+      dense.od[col] = np.zeros((n, n))
+      dense.od[col][dense.o_index, dense.d_index] = dataset[col].values
+    return dense
+
+  def __contains__(self, colname):
+    return colname in self.od or _strip_prefix(colname) in self.factors
+
+  def __getitem__(self, colname):
+    """ Returns the vector for a (prefixed or unprefixed) zonal factor, or the matrix for an OD value """
+    if colname in self.od:
+      return self.od[colname]
+    return self.factors[_strip_prefix(colname)]
+
+  def __setitem__(self, colname, values):
+    # (a zonal factor may be a draws x N array, for an ensemble)
+    if colname in self.od or (np.ndim(values) == 2 and _strip_prefix(colname) not in self.factors):
+      self.od[colname] = values
+    else:
+      self.factors[_strip_prefix(colname)] = values
+
+  def expand(self, colname):
+    """ Returns the values of a column in the row order of the long-format dataset """
+    if colname in self.od:
+      return self.od[colname][self.o_index, self.d_index]
+    # constrained models use the zone codes as the emitter/attractor
+    if colname == ORIGIN_PREFIX + "GEOGRAPHY_CODE":
+      return self.zones.codes[self.o_index]
+    if colname == DESTINATION_PREFIX + "GEOGRAPHY_CODE":
+      return self.zones.codes[self.d_index]
+    if colname.startswith(ORIGIN_PREFIX):
+      return self.factors[_strip_prefix(colname)][self.o_index]
+    return self.factors[_strip_prefix(colname)][self.d_index]
+
+  def get_zonal_values(self, colnames):
+    """ Returns zonal factor vector(s) in zone order, for factorised model evaluation """
+    if not isinstance(colnames, list):
+      if _strip_prefix(colnames) == "GEOGRAPHY_CODE":
+        return self.zones.codes
+      return self[colnames]
+    return [self.get_zonal_values(colname) for colname in colnames]
+
+  def get_named_values(self, colnames):
+    """ Equivalent to utils.get_named_values, for model evaluation """
+    if not isinstance(colnames, list):
+      return self.expand(colnames)
+    return [self.expand(colname) for colname in colnames]
+
+  def update_dataframe(self, dataset):
+    """ Writes the current values back into any matching columns of the long-format dataset (which must have the original row order) """
+    for col in dataset.columns.values:
+      if col in self.od or (col != _strip_prefix(col) and _strip_prefix(col) in self.factors):
+        dataset[col] = self.expand(col)
+    for col in self.od:
+      if col not in dataset.columns.values:
+        dataset[col] = self.expand(col)
+    return dataset
+
+  def zonal_dataframe(self, factors):
+    """ Returns the given zonal factors as a dataframe with a GEOGRAPHY_CODE column """
+    data = pd.DataFrame({"GEOGRAPHY_CODE": self.zones.codes})
+    for factor in factors:
+      data[factor] = self.factors[factor]
+    return data
+
+  def set_zonal(self, data, factor, column=None):
+    """ Sets a zonal factor from a dataframe with GEOGRAPHY_CODE and value columns (zones not present are unchanged) """
+    if column is None:
+      column = factor
+    if factor not in self.factors:
+      self.factors[factor] = np.zeros(len(self.zones))
+    self.factors[factor][self.zones.index(data.GEOGRAPHY_CODE.values)] = data[column].values
+
+  def zonal_values(self, data, column):
+    """ Returns a length-N vector of values from a dataframe with GEOGRAPHY_CODE and value columns """
+    values = np.zeros(len(self.zones))
+    values[self.zones.index(data.GEOGRAPHY_CODE.values)] = data[column].values
+    return values
+
+class AccessibilityOperator():
+  """ Access-weighted sums A^T x of zonal factors, with A dense, sparse (if thresholded) or blocked """
+  def __init__(self, access, threshold=None):
+    self.threshold = threshold
+    if isinstance(access, BlockedMatrix):
+      if threshold is not None:
+        raise ValueError("a threshold cannot be applied to a blocked accessibility matrix")
+      self.matrix = access
+    elif threshold is None:
+      self.matrix = np.array(access, dtype=float)
+    else:
+      self.matrix = csr_matrix(np.where(access >= threshold, access, 0.0))
+
+  def is_sparse(self):
+    return self.threshold is not None
+
+  def __call__(self, x):
+    """ Returns the access-weighted sum(s) of x, a length-N vector or N x k matrix """
+    if isinstance(self.matrix, BlockedMatrix):
+      return self.matrix.rmatvec(x)
+    return self.matrix.T @ x
+
+  def cells(self, o, d):
+    """ Returns the (thresholded) values of the given cells """
+    if self.is_sparse():
+      return np.asarray(self.matrix[o, d]).ravel()
+    return self.matrix[o, d]
+
+  def partial(self, zones, x):
+    """ Returns the access-weighted sums of x over the given origin zones only, i.e. A[zones]^T x[zones] """
+    return np.asarray(self.matrix[zones, :].T @ x[zones])
+
+  def update(self, o, d, values, x=None, sums=None):
+    """ Sets access[o,d] = values for the given (distinct) cells, updating the sums of x, if given, in place """
+    if isinstance(self.matrix, BlockedMatrix):
+      raise NotImplementedError("a blocked accessibility matrix cannot be updated")
+    values = np.asarray(values, dtype=float)
+    if self.is_sparse():
+      values = np.where(values >= self.threshold, values, 0.0)
+    change = values - self.cells(o, d)
+    if self.is_sparse():
+      self.matrix = (self.matrix + csr_matrix((change, (o, d)), shape=self.matrix.shape)).tocsr()
+      self.matrix.eliminate_zeros()
+    else:
+      np.add.at(self.matrix, (o, d), change)
+    if sums is not None:
+      x = np.asarray(x)
+      np.add.at(sums, d, change.reshape((-1,) + (1,) * (x.ndim - 1)) * x[o])
+      return sums
@@ -0,0 +1,140 @@
+"""
+geography.py
+Binary store for the geography hierarchy (OA -> LSOA -> MSOA -> LAD -> LAD_CM), memory-mapped read-only (see store)
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+import simim.store as store
+
+MAGIC = b"SIMIMGEO"
+VERSION = 1
+
+# finest first: census merged LADs (LAD_CM) are the coarsest level (in Scotland LAD_CM = LAD)
+LEVELS = ["OA", "LSOA", "MSOA", "LAD", "LAD_CM"]
+
+def write_hierarchy(filename, lookup, levels=LEVELS):
+  """ Writes the hierarchy from a lookup table with a column of codes per level, each with a single parent code """
+  lookup = lookup[levels].drop_duplicates()
+  arrays = {}
+  # from the top down, so that each level can be ordered by its parents' indices
+  positions = None
+  for i in reversed(range(len(levels))):
+    level = levels[i]
+    if i == len(levels) - 1:
+      codes = np.sort(lookup[level].unique().astype(str))
+      parents = None
+    else:
+      pairs = lookup[[level, levels[i + 1]]].drop_duplicates()
+      if pairs[level].duplicated().any():
+        raise ValueError("%s codes with more than one %s: %s" % (level, levels[i + 1], str(pairs[level][pairs[level].duplicated()].values[:10])))
+      codes = pairs[level].values.astype(str)
+      parents = positions.get_indexer(pairs[levels[i + 1]].values.astype(str))
+      order = np.lexsort((codes, parents))
+      codes = codes[order]
+      parents = parents[order]
+      arrays[level + ".parent"] = parents.astype(np.int32)
+      # offsets of the (contiguous) children of each zone in the level above
+      arrays[levels[i + 1] + ".children"] = np.searchsorted(parents, np.arange(len(positions) + 1)).astype(np.int32)
+    arrays[level + ".codes"] = codes.astype(bytes)
+    positions = pd.Index(codes)
+
+  # each level's codes and, other than at the top, parents (in the level above) by index, so that the children of any zone
+  # are a contiguous range, stored as offsets
+  offset = 0
+  entries = []
+  for name, array in arrays.items():
+    offset = store.align(offset, 64)
+    entries.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+    offset += array.nbytes
+  with store.create(filename, MAGIC, {"version": VERSION, "levels": list(levels), "arrays": entries}, offset) as (tmpfile, start):
+    with open(tmpfile, "r+b") as fd:
+      for entry in entries:
+        fd.seek(start + entry["offset"])
+        fd.write(arrays[entry["name"]].tobytes())
+
+def is_hierarchy_file(filename):
+  """ Whether the file is in the geography store format """
+  return store.is_store_file(filename, MAGIC)
+
+def open_hierarchy(filename):
+  """ Opens a geography hierarchy from the store, memory-mapped read-only """
+  header, start = store.read_header(filename, MAGIC, VERSION, "geography store")
+  arrays = { entry["name"]: store.map_array(filename, entry["dtype"], entry["shape"], start + entry["offset"]) for entry in header["arrays"] }
+  return Geography(header["levels"], arrays)
+
+def from_csv(csv_file, filename, levels=LEVELS):
+  """ Converts a lookup table CSV (e.g. data/gb_geog_lookup.csv.gz) with a column of codes per level to the store """
+  write_hierarchy(filename, pd.read_csv(csv_file, usecols=levels, dtype=str), levels)
+
+def open_cached(lookup_file, cache_dir, levels=LEVELS):
+  """ Opens a geography hierarchy given as either a store file or a lookup table CSV (see store.open_cached) """
+  return store.open_cached(lookup_file, MAGIC, open_hierarchy, cache_dir, "GEOGRAPHY", ".geo",
+                           lambda csv_file, filename: from_csv(csv_file, filename, levels))
+
+class Geography():
+  """ A hierarchy of zones, finest level first, referred to by their index within their level """
+  def __init__(self, levels, arrays):
+    self.levels = list(levels)
+    self.arrays = arrays
+    self.__codes = {}
+    self.__indexes = {}
+
+  def __check(self, level):
+    if level not in self.levels:
+      raise ValueError("unknown geography level %s (levels are %s)" % (level, self.levels))
+    return self.levels.index(level)
+
+  def size(self, level):
+    """ The number of zones at a level """
+    self.__check(level)
+    return len(self.arrays[level + ".codes"])
+
+  def codes(self, level):
+    """ The codes of the zones at a level, in index order """
+    self.__check(level)
+    if level not in self.__codes:
+      self.__codes[level] = self.arrays[level + ".codes"].astype(str)
+    return self.__codes[level]
+
+  def index(self, level, codes):
+    """ Returns the indices of the given codes (or of a single code) at a level, -1 for unknown codes """
+    if level not in self.__indexes:
+      self.__indexes[level] = pd.Index(self.codes(level))
+    if isinstance(codes, str):
+      return int(self.__indexes[level].get_indexer([codes])[0])
+    return self.__indexes[level].get_indexer(np.asarray(codes, dtype=str))
+
+  def parent(self, level, indices, to_level=None):
+    """ Returns the indices of the zones' ancestors at to_level (by default the level above) """
+    start = self.__check(level)
+    stop = start + 1 if to_level is None else self.__check(to_level)
+    if stop <= start:
+      raise ValueError("%s is not above %s" % (to_level, level))
+    for i in range(start, stop):
+      indices = self.arrays[self.levels[i] + ".parent"][indices]
+    return indices
+
+  def children(self, level, index):
+    """ Returns the indices (at the level below) of a zone's children """
+    if self.__check(level) == 0:
+      raise ValueError("%s is the lowest level" % level)
+    offsets = self.arrays[level + ".children"]
+    return np.arange(offsets[index], offsets[index + 1])
+
+  def lookup(self, level, to_level):
+    """ The codes of every zone at a level and of its ancestor at to_level, as a dataframe """
+    parents = self.parent(level, np.arange(self.size(level)), to_level)
+    return pd.DataFrame({level: self.codes(level), to_level: self.codes(to_level)[parents]})
+
+  def aggregation(self, level, to_level):
+    """ A sparse (to_level zones x level zones) matrix that sums values at a level into their ancestors at to_level """
+    n = self.size(level)
+    parents = self.parent(level, np.arange(n), to_level)
+    return csr_matrix((np.ones(n), (parents, np.arange(n))), shape=(self.size(to_level), n))
+
+  def aggregate(self, level, to_level, values):
+    """ Sums values (in index order at a level) into their ancestors at to_level """
+    return np.bincount(self.parent(level, np.arange(self.size(level)), to_level), weights=values, minlength=self.size(to_level))
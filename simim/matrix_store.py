@@ -0,0 +1,102 @@
+"""
+matrix_store.py
+Binary store for NxN OD matrices (e.g. DISTANCE, ACCESSIBILITY), memory-mapped read-only (see store)
+"""
+
+import numpy as np
+import pandas as pd
+
+import simim.store as store
+from simim.blocked import BlockedMatrix
+from simim.utils import distance_block
+
+MAGIC = b"SIMIMMAT"
+VERSION = 1
+
+def write_matrix(filename, zones, values, dtype=np.float64, block_size=1024):
+  """ Writes an NxN matrix (an array, or a function func(start, stop) returning blocks of rows) in zone order """
+  dtype = np.dtype(dtype)
+  if dtype not in (np.float32, np.float64):
+    raise ValueError("matrix store payloads must be float32 or float64, not %s" % dtype)
+  zones = [str(zone) for zone in zones]
+  n = len(zones)
+  with store.create(filename, MAGIC, {"version": VERSION, "dtype": dtype.str, "zones": zones}, n * n * dtype.itemsize) as (tmpfile, offset):
+    if n:
+      matrix = np.memmap(tmpfile, dtype=dtype, mode="r+", offset=offset, shape=(n, n))
+      for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        matrix[start:stop] = values(start, stop) if callable(values) else values[start:stop]
+      matrix.flush()
+      del matrix
+
+def is_matrix_file(filename):
+  """ Whether the file is in the matrix store format """
+  return store.is_store_file(filename, MAGIC)
+
+def open_matrix(filename):
+  """ Opens a matrix from the store, memory-mapped read-only, as a ZoneMatrix """
+  header, offset = store.read_header(filename, MAGIC, VERSION, "matrix store")
+  n = len(header["zones"])
+  return ZoneMatrix(header["zones"], store.map_array(filename, header["dtype"], (n, n), offset))
+
+class ZoneMatrix():
+  """ An NxN matrix of OD values, indexed [origin, destination] in the order of its (not necessarily sorted) zones """
+  def __init__(self, zones, values):
+    self.zones = np.array(zones, dtype=str)
+    self.values = values
+    self.__index = pd.Index(self.zones)
+
+  def __len__(self):
+    return len(self.zones)
+
+  def index(self, codes):
+    """ Returns the positions of the given zone codes in the matrix, -1 for unknown codes """
+    return self.__index.get_indexer(np.asarray(codes, dtype=str))
+
+  def cells(self, origins, destinations):
+    """ Returns the values of the given (origin code, destination code) pairs, NaN where a zone is not in the matrix """
+    o = self.index(origins)
+    d = self.index(destinations)
+    known = (o >= 0) & (d >= 0)
+    result = np.full(len(o), np.nan)
+    result[known] = self.values[o[known], d[known]]
+    return result
+
+  def reindex(self, codes):
+    """ Returns the NxN matrix in the order of the given zone codes (without copying if that is the stored order) """
+    index = self.index(codes)
+    if np.any(index < 0):
+      raise ValueError("zones not in matrix: %s" % str(np.asarray(codes)[index < 0]))
+    if np.array_equal(index, np.arange(len(self))):
+      return self.values
+    return self.values[np.ix_(index, index)]
+
+  def blocked(self, block_size=1024, threads=None):
+    """ The matrix as a blocked.BlockedMatrix, for out-of-core evaluation """
+    return BlockedMatrix(self.values, block_size, threads)
+
+  def to_dataframe(self, value_col):
+    """ The matrix in long format, with O_GEOGRAPHY_CODE, D_GEOGRAPHY_CODE and value columns """
+    n = len(self)
+    return pd.DataFrame({"O_GEOGRAPHY_CODE": np.repeat(self.zones, n),
+                         "D_GEOGRAPHY_CODE": np.tile(self.zones, n),
+                         value_col: np.asarray(self.values, dtype=float).ravel()})
+
+def from_csv(csv_file, value_col, filename, dtype=np.float64, fill=np.nan):
+  """ Converts a long-format CSV to the store, with zones sorted and missing pairs set to fill """
+  data = pd.read_csv(csv_file)
+  zones = np.union1d(data.O_GEOGRAPHY_CODE.unique(), data.D_GEOGRAPHY_CODE.unique())
+  values = np.full((len(zones), len(zones)), fill, dtype=dtype)
+  values[np.searchsorted(zones, data.O_GEOGRAPHY_CODE.values), np.searchsorted(zones, data.D_GEOGRAPHY_CODE.values)] = data[value_col].values
+  write_matrix(filename, zones, values, dtype)
+
+def from_shapefile(gdf, filename, code_col="lad16cd", dtype=np.float64, block_size=1024):
+  """ Writes the distances (in km) between the centroids (bng_e, bng_n, in m) of a shapefile's zones, in its order """
+  easting = gdf.bng_e.values.astype(float)
+  northing = gdf.bng_n.values.astype(float)
+  write_matrix(filename, gdf[code_col].values, lambda start, stop: distance_block(easting, northing, start, stop), dtype, block_size)
+
+def open_cached(csv_file, value_col, cache_dir, dtype=np.float64):
+  """ Opens a matrix given as either a store file or a long-format CSV (see store.open_cached) """
+  return store.open_cached(csv_file, MAGIC, open_matrix, cache_dir, "%s_%s" % (value_col, np.dtype(dtype).name), ".mat",
+                           lambda csv_file, filename: from_csv(csv_file, value_col, filename, dtype))
@@ -1,11 +1,17 @@
 """ models.py """
 
+import os
+import json
+import hashlib
 import numpy as np
+from scipy.optimize import brentq
+from scipy.stats import norm
 
-from spint import Gravity, Attraction, Production, Doubly
+from spint import Gravity, Attraction, Production
 
 _valid_types = ["gravity", "production", "attraction", "doubly"]
 _valid_subtypes = ["pow", "exp"]
+_valid_fitters = ["spint", "irls"]
 
 def validate(model_type, model_subtype, dataset, y_col, xo_cols, xd_cols, cost_col):
   if not model_type in _valid_types:
@@ -22,11 +28,355 @@ def validate(model_type, model_subtype, dataset, y_col, xo_cols, xd_cols, cost_c
   if not cost_col in dataset.columns.values:
     raise ValueError("cost function column specified to be %s but it's not in the dataset" % cost_col)
 
+class FactorisedFlows:
+  """ Model flows T[o,d] = origin[o] * cost[o,d] * destination[d], with cost the (cached) cost^beta matrix """
+  def __init__(self, origin, destination, cost):
+    self.origin = origin
+    self.destination = destination
+    self.cost = cost
+
+  def outflows(self):
+    """ Row totals (flows by origin) """
+    return self.origin * (self.cost @ self.destination)
+
+  def inflows(self):
+    """ Column totals (flows by destination) """
+    return self.destination * (self.origin @ self.cost)
+
+  def net(self):
+    return self.inflows() - self.outflows()
+
+  def matrix(self):
+    """ The full NxN OD matrix """
+    return self.origin[:, np.newaxis] * self.cost * self.destination[np.newaxis, :]
+
+  def __ratio(self, other):
+    return other.origin / self.origin, other.destination / self.destination
+
+  def changed_flows(self, other, observed):
+    """ Returns the change in (inflows, outflows) of observed * (other / self - 1) """
+    if other.cost is not self.cost:
+      changed = self.changed_matrix(other, observed)
+      return changed.sum(axis=0), changed.sum(axis=1)
+    ro, rd = self.__ratio(other)
+    inflows = rd * (ro @ observed) - observed.sum(axis=0)
+    outflows = ro * (observed @ rd) - observed.sum(axis=1)
+    return inflows, outflows
+
+  def changed_matrix(self, other, observed):
+    """ Returns the OD matrix observed * (other / self - 1) """
+    ro, rd = self.__ratio(other)
+    ratio = ro[:, np.newaxis] * rd[np.newaxis, :]
+    if other.cost is not self.cost:
+      ratio *= other.cost / self.cost
+    return observed * (ratio - 1.0)
+
+class Impact:
+  """ Closed-form change in flows under a scenario, as zonal multipliers and a cost ratio for changed OD cells """
+  def __init__(self, origin, destination, cost_cells=None):
+    self.origin = origin
+    self.destination = destination
+    # tuple of (origin indices, destination indices, cost multipliers)
+    self.cost_cells = cost_cells
+
+  def changed_flows(self, observed, observed_inflows=None, observed_outflows=None):
+    """ Returns the change in (inflows, outflows) of observed * (ratio - 1), in O(N * changed zones) given the totals """
+    if observed_inflows is None:
+      observed_inflows = observed.sum(axis=0)
+    if observed_outflows is None:
+      observed_outflows = observed.sum(axis=1)
+    n = len(observed_inflows)
+    co = np.flatnonzero((self.origin != 1.0).reshape(-1, n).any(axis=0))
+    cd = np.flatnonzero((self.destination != 1.0).reshape(-1, n).any(axis=0))
+    # (origin @ observed) and (observed @ destination), only summing over the changed zones
+    inflows = observed_inflows + (self.origin[..., co] - 1.0) @ observed[co, :]
+    outflows = observed_outflows + (self.destination[..., cd] - 1.0) @ observed[:, cd].T
+    inflows = self.destination * inflows - observed_inflows
+    outflows = self.origin * outflows - observed_outflows
+    if self.cost_cells is not None:
+      o, d, ratio = self.cost_cells
+      correction = observed[o, d] * self.origin[..., o] * self.destination[..., d] * (ratio - 1.0)
+      np.add.at(inflows, (Ellipsis, d), correction)
+      np.add.at(outflows, (Ellipsis, o), correction)
+    return inflows, outflows
+
+  def draw(self, i):
+    """ The impact for a single draw of an ensemble """
+    cost_cells = None
+    if self.cost_cells is not None:
+      o, d, ratio = self.cost_cells
+      cost_cells = (o, d, ratio[i])
+    return Impact(self.origin[i], self.destination[i], cost_cells)
+
+  def changed_matrix(self, observed):
+    """ Returns the OD matrix observed * (ratio - 1) (not for an ensemble) """
+    ratio = self.origin[:, np.newaxis] * self.destination[np.newaxis, :]
+    if self.cost_cells is not None:
+      o, d, cost_ratio = self.cost_cells
+      ratio[o, d] *= cost_ratio
+    return observed * (ratio - 1.0)
+
+class PoissonFit():
+  """ Results of fit_poisson, with the same attributes (and params layout) as the spint models """
+  def __init__(self, y, mu, params, iterations, fe_block, cross_block, schur_inverse, converged=True):
+    self.y = y.reshape((-1, 1))
+    self.yhat = mu
+    self.params = params
+    self.iterations = iterations
+    self.converged = converged
+    self.n = len(mu)
+    self.k = len(params)
+    # inverse Fisher information blocks, for the covariance (computed on demand)
+    self.__blocks = (fe_block, cross_block, schur_inverse)
+    self.__cov_params = None
+
+    # quasi-Poisson dispersion, and fit statistics as computed by spint
+    self.scale = np.sum((y - mu) ** 2 / mu) / (self.n - self.k)
+    self.deviance = _poisson_deviance(y, mu)
+    self.D2 = 1.0 - self.deviance / _poisson_deviance(y, np.full(self.n, np.mean(y)))
+    self.adj_D2 = 1.0 - (self.n - 1.0) / (self.n - self.k) * (1.0 - self.D2)
+    self.SRMSE = np.sqrt(np.sum((y - mu) ** 2) / self.n) / (np.sum(y) / self.n)
+    self.SSI = np.mean(2.0 * np.minimum(y, mu) / (y + mu))
+    # likelihood-based statistics are undefined for quasi-Poisson models
+    self.llf = self.llnull = self.AIC = self.pseudoR2 = self.adj_pseudoR2 = np.nan
+
+  @property
+  def cov_params(self):
+    if self.__cov_params is None:
+      fe_block, cross_block, schur_inverse = self.__blocks
+      if fe_block is None:
+        cov = schur_inverse
+      else:
+        # blockwise inverse of [[diag(A), B], [B', C]], with the Schur complement inverse S^-1 = (C - B' A^-1 B)^-1
+        scaled_cross = cross_block / fe_block[:, np.newaxis]
+        cov_fe = np.diag(1.0 / fe_block) + scaled_cross @ schur_inverse @ scaled_cross.T
+        cov_cross = -scaled_cross @ schur_inverse
+        # transform the fixed effects to the spint layout (k, effects relative to the first group)
+        cov_fe[1:] -= cov_fe[0]
+        cov_fe[:, 1:] -= cov_fe[:, :1]
+        cov_cross[1:] -= cov_cross[0]
+        cov = np.block([[cov_fe, cov_cross], [cov_cross.T, schur_inverse]])
+      self.__cov_params = self.scale * cov
+    return self.__cov_params
+
+  @property
+  def std_err(self):
+    return np.sqrt(np.diag(self.cov_params))
+
+  @property
+  def tvalues(self):
+    return self.params / self.std_err
+
+  @property
+  def pvalues(self):
+    return norm.sf(np.abs(self.tvalues)) * 2
+
+def _poisson_deviance(y, mu):
+  # y log(y/mu) is taken to be zero where y is zero
+  ylogy = np.where(y > 0, y * np.log(np.where(y > 0, y, 1.0) / mu), 0.0)
+  return 2.0 * np.sum(ylogy - (y - mu))
+
+def fit_poisson(y, X, groups=None, init=None, tol=1e-10, max_iter=100):
+  """ Fits a (quasi-)Poisson GLM, log E[y] = X @ b + fe[groups], by Newton's method, returning a PoissonFit """
+  y = np.asarray(y, dtype=float).ravel()
+  X = np.asarray(X, dtype=float)
+  p = X.shape[1]
+  if groups is not None:
+    groups = np.asarray(groups)
+    ngroups = groups.max() + 1
+    group_totals = np.bincount(groups, weights=y, minlength=ngroups)
+
+  def linear_predictor(b):
+    eta = X @ b
+    if groups is None:
+      return eta, None
+    # the fixed effects that match observed and fitted group totals (in a numerically safe way)
+    shift = np.full(ngroups, -np.inf)
+    np.maximum.at(shift, groups, eta)
+    fe = np.log(group_totals) - np.log(np.bincount(groups, weights=np.exp(eta - shift[groups]), minlength=ngroups)) - shift
+    return eta + fe[groups], fe
+
+  if init is not None:
+    b = np.array(init, dtype=float)
+  elif groups is None:
+    # least squares fit to log(y+1) is a reasonable starting point
+    b = np.linalg.lstsq(X, np.log(y + 1.0), rcond=None)[0]
+  else:
+    b = np.zeros(p)
+
+  def small(step):
+    return np.max(np.abs(step)) < tol * (1.0 + np.max(np.abs(b)))
+
+  eta, fe = linear_predictor(b)
+  loglik = np.sum(y * eta - np.exp(eta))
+  converged = False
+  for iterations in range(1, max_iter + 1):
+    mu = np.exp(eta)
+    score = X.T @ (y - mu)
+    hessian = X.T @ (X * mu[:, np.newaxis])
+    if groups is not None:
+      fe_block = np.bincount(groups, weights=mu, minlength=ngroups)
+      cross_block = np.column_stack([np.bincount(groups, weights=mu * X[:, j], minlength=ngroups) for j in range(p)])
+      hessian -= cross_block.T @ (cross_block / fe_block[:, np.newaxis])
+    newton_step = np.linalg.solve(hessian, score)
+    step = newton_step.copy()
+    # halve the step until the likelihood doesn't decrease
+    for _ in range(30):
+      eta_new, fe_new = linear_predictor(b + step)
+      loglik_new = np.sum(y * eta_new - np.exp(eta_new))
+      if loglik_new >= loglik - 1e-12 * abs(loglik):
+        break
+      step /= 2.0
+    else:
+      # no step improves the likelihood: stop at the current estimate, which is only the solution if the step was negligible
+      converged = small(newton_step)
+      if not converged:
+        print("WARNING: Poisson fit stopped after %d iterations: step halving failed to improve the likelihood" % iterations)
+      break
+    b += step
+    eta, fe, loglik = eta_new, fe_new, loglik_new
+    if small(step):
+      converged = True
+      break
+  else:
+    print("WARNING: Poisson fit not converged after %d iterations" % max_iter)
+
+  # the Fisher information at the solution
+  mu = np.exp(eta)
+  hessian = X.T @ (X * mu[:, np.newaxis])
+  fe_block = cross_block = None
+  if groups is None:
+    params = b
+  else:
+    fe_block = np.bincount(groups, weights=mu, minlength=ngroups)
+    cross_block = np.column_stack([np.bincount(groups, weights=mu * X[:, j], minlength=ngroups) for j in range(p)])
+    hessian -= cross_block.T @ (cross_block / fe_block[:, np.newaxis])
+    params = np.concatenate([fe[:1], fe[1:] - fe[0], b])
+  return PoissonFit(y, mu, params, iterations, fe_block, cross_block, np.linalg.inv(hessian), converged)
+
+def furness(cost, origin_totals, destination_totals, init=None, tol=1e-10, max_iter=1000):
+  """ Furness balancing of origin[o] * cost[o,d] * destination[d] to row and column totals, returning (o, d, iterations) """
+  destination = np.ones(len(destination_totals)) if init is None else np.array(init, dtype=float)
+  for iterations in range(1, max_iter + 1):
+    origin = origin_totals / (cost @ destination)
+    destination = destination_totals / (origin @ cost)
+    # columns now balance exactly, check the rows
+    if np.all(np.abs(origin * (cost @ destination) - origin_totals) <= tol * np.abs(origin_totals)):
+      break
+  else:
+    print("WARNING: balancing not converged after %d iterations" % max_iter)
+  return origin, destination, iterations
+
+def fit_doubly(y, origins, destinations, cost, init=None, tol=1e-10, max_iter=100):
+  """ Fits a doubly-constrained (quasi-)Poisson model by Furness balancing, returning a PoissonFit """
+  # params are [k, mu (N-1), alpha (N-1), beta]
+  y = np.asarray(y, dtype=float).ravel()
+  n = max(origins.max(), destinations.max()) + 1
+  observed = np.zeros((n, n))
+  observed[origins, destinations] = y
+  cost_term = np.zeros((n, n))
+  cost_term[origins, destinations] = cost
+  # cells not in the dataset have no flow
+  present = np.zeros((n, n), dtype=bool)
+  present[origins, destinations] = True
+  origin_totals = observed.sum(axis=1)
+  destination_totals = observed.sum(axis=0)
+  observed_cost = np.sum(observed * cost_term)
+  state = { "destination": None, "evaluations": 0 }
+
+  def balanced(beta):
+    # shifted so the largest cost factor is 1, to avoid under/overflow (the shift is absorbed by the factors)
+    exponent = beta * cost_term
+    shift = np.max(exponent[present])
+    factors = np.where(present, np.exp(np.where(present, exponent - shift, 0.0)), 0.0)
+    origin, destination, _ = furness(factors, origin_totals, destination_totals, state["destination"], tol, 100 * max_iter)
+    state["destination"] = destination
+    state["evaluations"] += 1
+    return origin, destination, factors, shift
+
+  def excess_cost(beta):
+    origin, destination, factors, _ = balanced(beta)
+    return np.sum(origin[:, np.newaxis] * factors * destination[np.newaxis, :] * cost_term) - observed_cost
+
+  # the modelled cost increases with beta: bracket the root, starting from (unless given) the cheap origin-constrained
+  # fit with the destination totals as the attractor, which is close, and solve
+  if init is None:
+    X = np.column_stack([np.log(destination_totals[destinations]), cost])
+    init = fit_poisson(y, X, origins, tol=1e-6).params[-1]
+  beta = float(init)
+  step = 0.05 / max(np.std(cost_term[present]), 1e-300)
+  lower, upper = beta, beta
+  if excess_cost(beta) > 0:
+    while excess_cost(lower) > 0:
+      upper, lower, step = lower, lower - step, 2.0 * step
+  else:
+    while excess_cost(upper) < 0:
+      lower, upper, step = upper, upper + step, 2.0 * step
+  if lower < upper:
+    beta = brentq(excess_cost, lower, upper, xtol=tol * max(1.0, abs(lower)), maxiter=max_iter)
+
+  origin, destination, factors, shift = balanced(beta)
+  flows = origin[:, np.newaxis] * factors * destination[np.newaxis, :]
+  # fixed effects in dummy coding relative to the first destination
+  fe = np.log(origin) + np.log(destination[0]) - shift
+  alpha = np.log(destination[1:]) - np.log(destination[0])
+  params = np.concatenate([fe[:1], fe[1:] - fe[0], alpha, [beta]])
+
+  # Fisher information with the origin effects eliminated: the other parameters are the destination dummies and beta
+  weighted_cost = flows * cost_term
+  fe_block = flows.sum(axis=1)
+  cross_block = np.column_stack([flows[:, 1:], weighted_cost.sum(axis=1)])
+  hessian = np.zeros((n, n))
+  hessian[np.arange(n - 1), np.arange(n - 1)] = flows.sum(axis=0)[1:]
+  hessian[:-1, -1] = hessian[-1, :-1] = weighted_cost.sum(axis=0)[1:]
+  hessian[-1, -1] = np.sum(weighted_cost * cost_term)
+  hessian -= cross_block.T @ (cross_block / fe_block[:, np.newaxis])
+  return PoissonFit(y, flows[origins, destinations], params, state["evaluations"], fe_block, cross_block, np.linalg.inv(hessian))
+
+def _zonal(values, index, n):
+  """ Zonal (length-n) vector from long-format values at the given zone indices """
+  values = np.asarray(values)
+  zonal = np.empty(n, dtype=values.dtype)
+  zonal[index] = values
+  return zonal
+
+# fitted values and fit statistics retained in the model store
+_stored_fit = ["params", "yhat", "y", "cov_params", "std_err", "tvalues", "pvalues", "deviance", "D2", "adj_D2",
+               "SRMSE", "SSI", "AIC", "llf", "pseudoR2", "adj_pseudoR2", "n", "k"]
+
+class StoredFit():
+  """ Stands in for a fitted spint model, with the fitted values and statistics restored from the model store """
+  def __init__(self, values):
+    for name in values:
+      setattr(self, name, values[name])
+
+def save_fit(impl, filename, dataset):
+  """ Saves a fitted model, with the O-D ordering of the (sorted) dataset it was fitted to """
+  values = { name: np.asarray(getattr(impl, name)) for name in _stored_fit }
+  values["O_GEOGRAPHY_CODE"] = np.asarray(dataset.O_GEOGRAPHY_CODE.values, dtype=str)
+  values["D_GEOGRAPHY_CODE"] = np.asarray(dataset.D_GEOGRAPHY_CODE.values, dtype=str)
+  tmpfile = filename + ".tmp.npz"
+  np.savez(tmpfile, **values)
+  os.replace(tmpfile, filename)
+
+def load_fit(filename, dataset):
+  """ Loads a stored model fit, or returns None if its O-D ordering doesn't match the dataset """
+  with np.load(filename) as values:
+    if not (np.array_equal(values["O_GEOGRAPHY_CODE"], np.asarray(dataset.O_GEOGRAPHY_CODE.values, dtype=str))
+            and np.array_equal(values["D_GEOGRAPHY_CODE"], np.asarray(dataset.D_GEOGRAPHY_CODE.values, dtype=str))):
+      return None
+    # 0-d arrays back to scalars
+    return StoredFit({ name: values[name][()] if values[name].ndim == 0 else values[name] for name in _stored_fit })
+
 class Model:
-  def __init__(self, model_type, model_subtype, dataset, y_col, xo_cols, xd_cols, cost_col):
+  def __init__(self, model_type, model_subtype, dataset, y_col, xo_cols, xd_cols, cost_col, store_dir=None, fitter="spint", init_params=None,
+               balancing_tolerance=1e-10):
     self.model_type = model_type
     self.model_subtype = model_subtype
     validate(self.model_type, self.model_subtype, dataset, y_col, xo_cols, xd_cols, cost_col)
+    if not fitter in _valid_fitters:
+      raise ValueError("invalid fitter %s (must be one of %s)" % (fitter, str(_valid_fitters)))
+    self.fitter = fitter
 
     # take a copy of the input dataset and ensure sorted by D then O
     # so that the ordering of mu, alpha is determined
@@ -42,39 +392,103 @@ class Model:
     self.num_attr = 1 if np.isscalar(self.xd_cols) else len(self.xd_cols)
     # for constrained models the above values need to be changed to num of unique O or D less 1
 
+    if self.model_type == "production":
+      assert(self.num_emit == 1)
+      self.num_emit = len(self.dataset[self.xo_cols[0]].unique()) - 1
+    if self.model_type == "attraction":
+      assert(self.num_attr == 1)
+      self.num_attr = len(self.dataset[self.xd_cols[0]].unique()) - 1
+    # the doubly-constrained model has origin and destination fixed effects, and the emitters and attractors (unless
+    # they are the zone codes) scale the origin and destination totals
+    if self.model_type == "doubly":
+      self.num_emit = len(self.dataset.O_GEOGRAPHY_CODE.unique()) - 1
+      self.num_attr = len(self.dataset.D_GEOGRAPHY_CODE.unique()) - 1
+
+    # reuse a previous fit to identical data if there is one in the store, otherwise fit and store it
+    self.impl = None
+    if store_dir is not None:
+      store_file = os.path.join(store_dir, "model_%s.npz" % self.fit_key())
+      if os.path.isfile(store_file):
+        print("using stored model fit: %s" % store_file)
+        self.impl = load_fit(store_file, self.dataset)
+    if self.impl is None:
+      if self.model_type == "doubly":
+        self.__fit_doubly(init_params)
+      elif self.fitter == "irls":
+        self.__fit_irls(init_params)
+      else:
+        self.__fit()
+      if store_dir is not None:
+        save_fit(self.impl, store_file, self.dataset)
+
+    # append the model-fitted flows to the dataframe, prefixed with "MODEL_"
+    self.dataset["MODEL_"+self.y_col] = self.impl.yhat
+    self.check_dataset()
+
+    if self.model_type == "doubly":
+      self.__init_balancing(balancing_tolerance)
+    else:
+      self.__init_design()
+
+  def __fit(self):
+    """ Fits the (quasi-)Poisson spint model """
     if self.model_type == "gravity":
       self.impl = Gravity(self.dataset[self.y_col].values,
                           self.dataset[self.xo_cols].values,
                           self.dataset[self.xd_cols].values,
                           self.dataset[self.cost_col].values, self.model_subtype, Quasi=True)
     elif self.model_type == "production":
-      assert(self.num_emit == 1)
-      self.num_emit = len(self.dataset[self.xo_cols[0]].unique()) - 1
       self.impl = Production(self.dataset[self.y_col].values,
                              self.dataset[self.xo_cols].values,
                              self.dataset[self.xd_cols].values,
                              self.dataset[self.cost_col].values, self.model_subtype, Quasi=True)
     elif self.model_type == "attraction":
-      assert(self.num_attr == 1)
-      self.num_attr = len(self.dataset[self.xd_cols[0]].unique()) - 1
       self.impl = Attraction(self.dataset[self.y_col].values,
                              self.dataset[self.xd_cols].values,
                              self.dataset[self.xo_cols].values,
                              self.dataset[self.cost_col].values, self.model_subtype, Quasi=True)
-    else: #model_type == "doubly":
-      assert(self.num_emit == 1)
-      self.num_emit = len(self.dataset[self.xo_cols[0]].unique()) - 1
-      assert(self.num_attr == 1)
-      self.num_attr = len(self.dataset[self.xd_cols[0]].unique()) - 1
-      raise NotImplementedError("Doubly constrained model is too constrained")
-      self.impl = Doubly(self.dataset[self.y_col].values,
-                         self.dataset[self.xo_cols].values,
-                         self.dataset[self.xd_cols].values,
-                         self.dataset[self.cost_col].values, self.model_subtype)
 
-    # append the model-fitted flows to the dataframe, prefixed with "MODEL_"
-    self.dataset["MODEL_"+self.y_col] = self.impl.yhat
-    self.check_dataset()
+  def __fit_irls(self, init_params=None):
+    """ Fits the quasi-Poisson model with fit_poisson, with origin or destination fixed effects eliminated """
+    if self.model_subtype == "pow":
+      cost = np.log(self.dataset[self.cost_col].values)
+    else:
+      cost = self.dataset[self.cost_col].values
+    groups = None
+    if self.model_type == "gravity":
+      X = np.column_stack([np.ones(len(self.dataset))] + [np.log(self.dataset[col].values) for col in self.xo_cols + self.xd_cols] + [cost])
+    elif self.model_type == "production":
+      X = np.column_stack([np.log(self.dataset[col].values) for col in self.xd_cols] + [cost])
+      groups = np.unique(self.dataset[self.xo_cols[0]].values, return_inverse=True)[1]
+    else: # attraction
+      X = np.column_stack([np.log(self.dataset[col].values) for col in self.xo_cols] + [cost])
+      groups = np.unique(self.dataset[self.xd_cols[0]].values, return_inverse=True)[1]
+    init = None if init_params is None else np.asarray(init_params)[-X.shape[1]:]
+    self.impl = fit_poisson(self.dataset[self.y_col].values, X.astype(float), groups, init)
+
+  def __fit_doubly(self, init_params=None):
+    """ Fits the doubly-constrained model with fit_doubly (spint's Doubly is impractical for all LADs) """
+    if self.model_subtype == "pow":
+      cost = np.log(self.dataset[self.cost_col].values)
+    else:
+      cost = self.dataset[self.cost_col].values
+    zones = self.zones()
+    self.impl = fit_doubly(self.dataset[self.y_col].values,
+                           np.searchsorted(zones, self.dataset.O_GEOGRAPHY_CODE.values),
+                           np.searchsorted(zones, self.dataset.D_GEOGRAPHY_CODE.values),
+                           cost, None if init_params is None else init_params[-1])
+
+  def fit_key(self):
+    """ Hash of the model specification and the data it is fitted to, which identifies the fit in the model store """
+    m = hashlib.md5()
+    spec = { "version": 1, "model_type": self.model_type, "model_subtype": self.model_subtype, "y_col": self.y_col,
+             "xo_cols": self.xo_cols, "xd_cols": self.xd_cols, "cost_col": self.cost_col, "fitter": self.fitter }
+    m.update(json.dumps(spec, sort_keys=True).encode("utf-8"))
+    for col in ["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", self.y_col] + self.xo_cols + self.xd_cols + [self.cost_col]:
+      values = self.dataset[col].values
+      dtype = float if values.dtype.kind in "biuf" else str
+      m.update(np.ascontiguousarray(np.asarray(values, dtype=dtype)).tobytes())
+    return m.hexdigest()
 
   # The params array structure, based on N emissiveness factors and M attractiveness factors:
   #
@@ -87,23 +501,34 @@ class Model:
   # for production/doubly, N is unique origins - 1
   # for attraction/doubly, M is unique dests - 1
 
-  def k(self):
-    return self.impl.params[0]
+  # The accessors below optionally take other params, e.g. a (draws x params) array from draw_params
 
-  def mu(self):
+  def k(self, params=None):
+    params = self.impl.params if params is None else params
+    return params[..., 0]
+
+  def mu(self, params=None):
+    params = self.impl.params if params is None else params
     if self.model_type == "attraction":
-      return self.impl.params[1+self.num_attr:1+self.num_attr+self.num_emit]
+      return params[..., 1+self.num_attr:1+self.num_attr+self.num_emit]
     else:
-      return self.impl.params[1:self.num_emit+1]
+      return params[..., 1:self.num_emit+1]
 
-  def alpha(self):
+  def alpha(self, params=None):
+    params = self.impl.params if params is None else params
     if self.model_type == "attraction":
-      return self.impl.params[1:self.num_attr+1]
+      return params[..., 1:self.num_attr+1]
     else:
-      return self.impl.params[1+self.num_emit:1+self.num_emit+self.num_attr]
+      return params[..., 1+self.num_emit:1+self.num_emit+self.num_attr]
+
+  def beta(self, params=None):
+    params = self.impl.params if params is None else params
+    return params[..., -1]
 
-  def beta(self):
-    return self.impl.params[-1]
+  def draw_params(self, draws, seed=None):
+    """ Draws (draws x params) parameter vectors from the fitted parameters' asymptotic normal distribution """
+    rng = np.random.RandomState(seed)
+    return rng.multivariate_normal(self.impl.params, self.impl.cov_params, size=draws)
 
   def __calc_xo_mu(self, xo):
     if not isinstance(xo, list):
@@ -111,10 +536,8 @@ class Model:
     mu = self.mu()
     assert len(mu) == self.num_emit
     assert len(xo) == self.num_emit
-    xo_mu = xo[0] ** mu[0]
-    for i in range(1,self.num_emit):
-      xo_mu = xo_mu * xo[i] ** mu[i]
-    return xo_mu
+    # evaluated in log space, i.e. exp(sum(mu * log(xo)))
+    return np.exp(np.log(np.column_stack(xo).astype(float)) @ mu)
 
   def __calc_xd_alpha(self, xd):
     if not isinstance(xd, list):
@@ -122,53 +545,228 @@ class Model:
     alpha = self.alpha()
     assert len(alpha) == self.num_attr
     assert len(xd) == self.num_attr
-    xd_alpha = xd[0] ** alpha[0]
-    for i in range(1,self.num_attr):
-      xd_alpha = xd_alpha * xd[i] ** alpha[i]
-    return xd_alpha
+    return np.exp(np.log(np.column_stack(xd).astype(float)) @ alpha)
+
+  def __init_design(self):
+    """ Caches the log-linear form of the model, ybar = exp(X @ params + offset) """
+    # NB ordering of the offset is only guaranteed if dataset is sorted by destination then origin code
+    n = len(self.dataset)
+    params = [self.k()]
+    self.design_cols = []
+    self.design_offset = 0.0
+    if self.model_type == "gravity" or self.model_type == "attraction":
+      self.design_cols += self.xo_cols
+      params += list(self.mu())
+    if self.model_type == "gravity" or self.model_type == "production":
+      self.design_cols += self.xd_cols
+      params += list(self.alpha())
+    if self.model_type == "production":
+      mu = np.append(0, self.mu())
+      self.design_offset = np.tile(mu, int(n/len(mu)))
+    elif self.model_type == "attraction":
+      alpha = np.append(0, self.alpha())
+      self.design_offset = np.repeat(alpha, int(n/len(alpha)))
+    self.design_cols.append(self.cost_col)
+    self.design_params = np.append(params, self.beta())
+    # column-major so that column updates are contiguous
+    self.design = np.empty((n, len(self.design_cols) + 1), order="F")
+    self.design[:, 0] = 1.0
+    # the raw values each column was computed from, to avoid recomputing unchanged columns
+    self.__design_values = [None] * len(self.design_cols)
+    self.update_design({col: self.dataset[col].values for col in self.design_cols})
+
+  def __init_balancing(self, tolerance):
+    """ Caches the observed totals, balancing factors and cost matrix of the doubly-constrained model """
+    zones = self.zones()
+    o_index = np.searchsorted(zones, self.dataset.O_GEOGRAPHY_CODE.values)
+    d_index = np.searchsorted(zones, self.dataset.D_GEOGRAPHY_CODE.values)
+    y = self.dataset[self.y_col].values
+    self.origin_totals = np.bincount(o_index, weights=y, minlength=len(zones))
+    self.destination_totals = np.bincount(d_index, weights=y, minlength=len(zones))
+    # zone codes as emitters/attractors leave the totals unscaled
+    self.__scaling_emitters = [i for i, col in enumerate(self.xo_cols) if not col.endswith("GEOGRAPHY_CODE")]
+    self.__scaling_attractors = [i for i, col in enumerate(self.xd_cols) if not col.endswith("GEOGRAPHY_CODE")]
+    self.__xo_totals = [_zonal(self.dataset[col].values, o_index, len(zones)) for col in self.xo_cols]
+    self.__xd_totals = [_zonal(self.dataset[col].values, d_index, len(zones)) for col in self.xd_cols]
+    self.balancing_tolerance = tolerance
+    self.balancing_iterations = 0
+    # the fitted destination effects are the balancing factors of the fitted flows
+    self.__balancing_factors = np.exp(np.append(0, self.alpha()))
+    self.__current_cost = None
+
+  def __balance(self, xo, xd, cost):
+    """ Doubly-constrained (factorised) flows for zonal emitters and attractors, warm-started from the previous ones """
+    if not isinstance(xo, list):
+      xo = [xo]
+    if not isinstance(xd, list):
+      xd = [xd]
+    origin_totals = self.origin_totals.copy()
+    for i in self.__scaling_emitters:
+      origin_totals *= xo[i] / self.__xo_totals[i]
+    destination_totals = self.destination_totals.copy()
+    for i in self.__scaling_attractors:
+      destination_totals *= xd[i] / self.__xd_totals[i]
+    destination_totals *= origin_totals.sum() / destination_totals.sum()
+    origin, destination, iterations = furness(cost, origin_totals, destination_totals, self.__balancing_factors, self.balancing_tolerance)
+    self.__balancing_factors = destination
+    self.balancing_iterations += iterations
+    return FactorisedFlows(origin, destination, cost)
+
+  def update_design(self, values):
+    """ Updates the cached design matrix columns given by values, a dict of column name to long-format values """
+    for col in values:
+      i = self.design_cols.index(col)
+      raw = np.asarray(values[col])
+      if self.__design_values[i] is not None and np.array_equal(raw, self.__design_values[i]):
+        continue
+      if col == self.cost_col and self.model_subtype == "exp":
+        self.design[:, i + 1] = raw
+      else:
+        np.log(raw, out=self.design[:, i + 1], casting="unsafe")
+      self.__design_values[i] = raw.copy()
+
+  def evaluate(self):
+    """ Evaluates the model from the cached design matrix: a single matrix-vector product """
+    if self.model_type == "doubly":
+      return self([self.dataset[col].values for col in self.xo_cols], [self.dataset[col].values for col in self.xd_cols])
+    return np.exp(self.design @ self.design_params + self.design_offset)
 
   def __call__(self, xo=None, xd=None):
-    if self.model_type == "gravity":
+    if self.model_type == "doubly":
+      # balanced flows, in the current (long-format) dataset order
+      zones = self.zones()
+      o_index = np.searchsorted(zones, self.dataset.O_GEOGRAPHY_CODE.values)
+      d_index = np.searchsorted(zones, self.dataset.D_GEOGRAPHY_CODE.values)
+      xo = [_zonal(x, o_index, len(zones)) for x in (xo if isinstance(xo, list) else [xo])]
+      xd = [_zonal(x, d_index, len(zones)) for x in (xd if isinstance(xd, list) else [xd])]
+      # OD pairs not in the dataset have no flow (as in fit_doubly)
+      cost = np.ones((len(zones), len(zones)))
+      cost[o_index, d_index] = self.dataset[self.cost_col].values
+      present = np.zeros(cost.shape, dtype=bool)
+      present[o_index, d_index] = True
+      flows = self.__balance(xo, xd, np.where(present, self.cost_matrix(cost), 0.0))
+      return flows.origin[o_index] * flows.cost[o_index, d_index] * flows.destination[d_index]
+    if self.model_type == "gravity" or self.model_type == "attraction":
       assert xo is not None
+      if not isinstance(xo, list):
+        xo = [xo]
+      assert len(xo) == self.num_emit
+      self.update_design(dict(zip(self.xo_cols, xo)))
+    if self.model_type == "gravity" or self.model_type == "production":
       assert xd is not None
-      xo_mu = self.__calc_xo_mu(xo)
-      xd_alpha = self.__calc_xd_alpha(xd)
+      if not isinstance(xd, list):
+        xd = [xd]
+      assert len(xd) == self.num_attr
+      self.update_design(dict(zip(self.xd_cols, xd)))
+    if self.model_type not in ["gravity", "production", "attraction"]:
+      raise NotImplementedError("%s evaluation not implemented" % self.model_type)
+    self.update_design({self.cost_col: self.dataset[self.cost_col].values})
+    return self.evaluate()
 
-      if self.model_subtype == "pow":
-        ybar = (np.exp(self.k()) * xo_mu * xd_alpha * self.dataset[self.cost_col] ** self.beta())
-      else:
-        ybar = (np.exp(self.k()) * xo_mu * xd_alpha * np.exp(self.dataset[self.cost_col] * self.beta()))
-      return ybar
+  def zones(self):
+    """ The (sorted) zone codes that index the factorised model vectors and matrices """
+    if not hasattr(self, "_zones"):
+      self._zones = np.unique(self.dataset.O_GEOGRAPHY_CODE.values)
+    return self._zones
+
+  def cost_matrix(self, cost=None):
+    """ Returns cost^beta (pow) or exp(beta * cost) (exp), by default (cached) for the model dataset cost """
+    if cost is None:
+      if not hasattr(self, "_cost_matrix"):
+        zones = self.zones()
+        o = np.searchsorted(zones, self.dataset.O_GEOGRAPHY_CODE.values)
+        d = np.searchsorted(zones, self.dataset.D_GEOGRAPHY_CODE.values)
+        cost = np.full((len(zones), len(zones)), np.nan)
+        cost[o, d] = self.dataset[self.cost_col].values
+        if np.isnan(cost).any():
+          raise ValueError("factorised evaluation requires a complete OD dataset")
+        self._cost_matrix = self.cost_matrix(cost)
+      return self._cost_matrix
+    if self.model_subtype == "pow":
+      return cost ** self.beta()
+    else:
+      return np.exp(cost * self.beta())
+
+  def factorised(self, xo=None, xd=None, cost=None):
+    """ Evaluates the model as FactorisedFlows, given emission and attraction factors as zonal vectors """
+    n = len(self.zones())
+    if self.model_type == "doubly":
+      return self.__balance(xo, xd, self.cost_matrix(cost))
+    if self.model_type == "gravity":
+      assert xo is not None
+      assert xd is not None
+      origin = np.exp(self.k()) * self.__calc_xo_mu(xo)
+      destination = self.__calc_xd_alpha(xd)
     elif self.model_type == "production":
-      #assert xo is None
       assert xd is not None
-      xd_alpha = self.__calc_xd_alpha(xd)
-      mu = np.append(0, self.mu())
-      mu = np.tile(mu, int(len(self.dataset)/len(mu)))
-      assert len(mu) == len(self.dataset)
-      # NB ordering is only guaranteed if dataset is sorted by origin then destination code
-      if self.model_subtype == "pow":
-        ybar = (np.exp(self.k()) * np.exp(mu) * xd_alpha * self.dataset[self.cost_col] ** self.beta())
-      else:
-        ybar = (np.exp(self.k()) * np.exp(mu) * xd_alpha * np.exp(self.dataset[self.cost_col] * self.beta()))
-      return ybar
+      origin = np.exp(self.k() + np.append(0, self.mu()))
+      destination = self.__calc_xd_alpha(xd)
     elif self.model_type == "attraction":
       assert xo is not None
-      #assert xd is None
-      xo_mu = self.__calc_xo_mu(xo)
-      alpha = np.append(0,self.alpha())
-      alpha = np.repeat(alpha, int(len(self.dataset)/len(alpha)))
-      assert len(alpha) == len(self.dataset)
-      # NB ordering is only guaranteed if dataset is sorted by origin then destination code
-      if self.model_subtype == "pow":
-        ybar = (np.exp(self.k()) * xo_mu * np.exp(alpha) * self.dataset[self.cost_col] ** self.beta())
-      else:
-        ybar = (np.exp(self.k()) * xo_mu * np.exp(alpha) * np.exp(self.dataset[self.cost_col] * self.beta()))
-      return ybar
+      origin = np.exp(self.k()) * self.__calc_xo_mu(xo)
+      destination = np.exp(np.append(0, self.alpha()))
     else:
       raise NotImplementedError("%s evaluation not implemented" % self.model_type)
+    assert len(origin) == n and len(destination) == n
+    return FactorisedFlows(np.asarray(origin, dtype=float), np.asarray(destination, dtype=float), self.cost_matrix(cost))
+
+  def __multiplier(self, x, x_scenario, elasticities):
+    """ prod((x'/x)^e) over factors, only evaluated for zones where a factor has changed """
+    if not isinstance(x, list):
+      x = [x]
+    if not isinstance(x_scenario, list):
+      x_scenario = [x_scenario]
+    n = np.shape(x[0])[-1]
+    # (a zero-stride dummy stands in for the elasticities' shape, as np.broadcast_shapes needs numpy 1.20)
+    multiplier = np.ones(np.broadcast(np.broadcast_to(0.0, np.shape(elasticities)[:-1] + (n,)), *(x + x_scenario)).shape)
+    for i, (before, after) in enumerate(zip(x, x_scenario)):
+      changed = np.flatnonzero((before != after).reshape(-1, n).any(axis=0))
+      multiplier[..., changed] *= (after[..., changed] / before[..., changed]) ** elasticities[..., i, np.newaxis]
+    return multiplier
+
+  def impact(self, xo=None, xo_scenario=None, xd=None, xd_scenario=None, cost_cells=None, params=None):
+    """ Computes the closed-form Impact of a scenario from the zonal factors (and OD costs) before and after it """
+    # cost_cells are (origin indices, destination indices, cost, scenario cost); the doubly-constrained model keeps track
+    # of cost changes, so successive calls must be for successive scenarios
+    n = len(self.zones())
+    if self.model_type == "doubly":
+      if params is not None:
+        raise NotImplementedError("ensemble evaluation not implemented for the doubly constrained model")
+      return self.__balanced_impact(xo, xo_scenario, xd, xd_scenario, cost_cells)
+    if self.model_type == "gravity" or self.model_type == "attraction":
+      origin = self.__multiplier(xo, xo_scenario, self.mu(params))
+    else:
+      origin = np.ones(n)
+    if self.model_type == "gravity" or self.model_type == "production":
+      destination = self.__multiplier(xd, xd_scenario, self.alpha(params))
+    else:
+      destination = np.ones(n)
+    if self.model_type not in ["gravity", "production", "attraction"]:
+      raise NotImplementedError("%s evaluation not implemented" % self.model_type)
+    # origin and destination multipliers have the same shape
+    origin, destination = np.broadcast_arrays(origin, destination)
+    if cost_cells is not None:
+      o, d, cost, cost_scenario = cost_cells
+      beta = np.asarray(self.beta(params))[..., np.newaxis]
+      if self.model_subtype == "pow":
+        cost_cells = (o, d, (cost_scenario / cost) ** beta)
+      else:
+        cost_cells = (o, d, np.exp((cost_scenario - cost) * beta))
+    return Impact(origin, destination, cost_cells)
+
+  def __balanced_impact(self, xo, xo_scenario, xd, xd_scenario, cost_cells):
+    if self.__current_cost is None:
+      self.__current_cost = self.cost_matrix().copy()
+    pre = self.__balance(xo, xd, self.__current_cost)
+    if cost_cells is not None:
+      o, d, cost, cost_scenario = cost_cells
+      self.__current_cost[o, d] = self.cost_matrix(cost_scenario)
+      cost_cells = (o, d, self.cost_matrix(cost_scenario) / self.cost_matrix(cost))
+    post = self.__balance(xo_scenario, xd_scenario, self.__current_cost)
+    return Impact(post.origin / pre.origin, post.destination / pre.destination, cost_cells)
 
   def check_dataset(self):
-    if len(self.dataset[self.dataset.isnull().any(axis=1)]) > 0:
+    # (column by column, rather than a full-size null mask of the dataset)
+    if any(self.dataset[col].isnull().values.any() for col in self.dataset.columns):
       self.dataset.to_csv("debug_dataset-check-fail.csv")
-    assert len(self.dataset[self.dataset.isnull().any(axis=1)]) == 0, "Missing/invalid values in model dataset, dumping to dataset.csv and aborting"
+      assert False, "Missing/invalid values in model dataset, dumping to dataset.csv and aborting"
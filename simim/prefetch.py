@@ -0,0 +1,63 @@
+"""
+prefetch.py
+Concurrent loading of input data, as stages with dependencies run on a thread pool
+"""
+
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from simim.profiling import span
+
+# (most stages wait on I/O, so this is not limited by the number of cores)
+DEFAULT_THREADS = 8
+
+class Pipeline():
+  """ Stages func(*results of the stages it runs after), each started as soon as those stages have completed """
+  def __init__(self, name, threads=None, profiler=None):
+    self.name = name
+    self.threads = threads or DEFAULT_THREADS
+    self.profiler = profiler
+    self.stages = OrderedDict()
+
+  def __len__(self):
+    return len(self.stages)
+
+  def add(self, stage, func, after=()):
+    """ Adds a stage, which depends on (and is passed the results of) the stages named in after """
+    if stage in self.stages:
+      raise ValueError("duplicate stage %s in %s" % (stage, self.name))
+    self.stages[stage] = (func, list(after))
+    return self
+
+  def __run_stage(self, stage, func, args):
+    with span(self.profiler, "%s.%s" % (self.name, stage)):
+      return func(*args)
+
+  def run(self):
+    """ Runs all the stages and returns their results by stage name, raising the first exception of any stage """
+    for stage, (_, after) in self.stages.items():
+      unknown = [name for name in after if name not in self.stages]
+      if unknown:
+        raise ValueError("stage %s in %s depends on unknown stages %s" % (stage, self.name, unknown))
+    results = {}
+    pending = OrderedDict(self.stages)
+    running = {}
+    # (threads can only be named from Python 3.6)
+    names = {"thread_name_prefix": self.name} if sys.version_info >= (3, 6) else {}
+    with ThreadPoolExecutor(min(self.threads, max(len(self.stages), 1)), **names) as pool:
+      while pending or running:
+        for stage in [stage for stage, (_, after) in pending.items() if all(name in results for name in after)]:
+          func, after = pending.pop(stage)
+          running[pool.submit(self.__run_stage, stage, func, [results[name] for name in after])] = stage
+        if not running:
+          raise ValueError("circular dependencies between stages %s in %s" % (list(pending), self.name))
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+          stage = running.pop(future)
+          if future.exception() is not None:
+            for other in running:
+              other.cancel()
+            raise future.exception()
+          results[stage] = future.result()
+    return results
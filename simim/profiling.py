@@ -0,0 +1,200 @@
+"""
+profiling.py
+Named (nested) timing spans and optional memory tracking, reported as JSON and JSONL
+"""
+
+import os
+import time
+import json
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+try:
+  import resource
+except ImportError:
+  resource = None
+
+MB = 1024.0 * 1024.0
+
+def rss():
+  """ The current resident set size of the process in bytes (on Linux, otherwise its peak so far), or None if unavailable """
+  try:
+    with open("/proc/self/statm") as fd:
+      return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    return peak_rss()
+
+def peak_rss():
+  """ The peak resident set size of the process so far in bytes, or None if unavailable """
+  if resource is None:
+    return None
+  # (kB on Linux)
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def nbytes(obj):
+  """ Memory footprint in bytes of a dataframe (including strings), array, data_apis.Panel, or dict/list of these """
+  if obj is None:
+    return 0
+  if isinstance(obj, pd.DataFrame):
+    return int(obj.memory_usage(deep=True).sum())
+  if isinstance(obj, pd.Series):
+    return int(obj.memory_usage(deep=True))
+  if isinstance(obj, np.ndarray):
+    return obj.nbytes
+  if isinstance(obj, dict):
+    return sum(nbytes(value) for value in obj.values())
+  if isinstance(obj, (list, tuple)):
+    return sum(nbytes(value) for value in obj)
+  if hasattr(obj, "data") and isinstance(obj.data, dict):
+    return nbytes(obj.data)
+  return 0
+
+class Profiler():
+  """ Records timing (and, if memory is set, RSS and traced allocation) spans, possibly from several threads """
+  def __init__(self, memory=False):
+    self.started = time.time()
+    self.events = []
+    self.samples = []
+    # named statistics included in the report, e.g. cache hit rates: values, or functions returning them
+    self.counters = {}
+    self.memory = memory
+    self.__start = time.perf_counter()
+    self.__local = threading.local()
+    self.__lock = threading.Lock()
+    if memory and not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  def __stack(self):
+    if not hasattr(self.__local, "stack"):
+      self.__local.stack = []
+    return self.__local.stack
+
+  @contextmanager
+  def span(self, name, rows=None, **attrs):
+    """ Times the enclosed block as a span called name. Extra attributes (e.g. year) are added to its record """
+    stack = self.__stack()
+    record = {"name": name, "parent": stack[-1]["name"] if stack else None, "depth": len(stack)}
+    record.update(attrs)
+    if rows is not None:
+      record["rows"] = rows
+    if self.memory:
+      # the enclosing span's peak so far is kept before the peak is reset for this span
+      if stack:
+        stack[-1]["_traced_peak"] = max(stack[-1].get("_traced_peak", 0), tracemalloc.get_traced_memory()[1])
+      # (before Python 3.9 the peak can't be reset, so is the peak since tracing started: an upper bound for the span's)
+      if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+      traced_start = tracemalloc.get_traced_memory()[0]
+      rss_start = rss()
+    stack.append(record)
+    start = time.perf_counter()
+    record["start"] = start - self.__start
+    try:
+      yield record
+    finally:
+      record["seconds"] = time.perf_counter() - start
+      stack.pop()
+      if self.memory:
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        traced_peak = max(record.pop("_traced_peak", 0), traced_peak)
+        if stack:
+          stack[-1]["_traced_peak"] = max(stack[-1].get("_traced_peak", 0), traced_peak)
+        record["traced_mb"] = traced / MB
+        record["traced_peak_mb"] = traced_peak / MB
+        # i.e. the largest transient allocation (e.g. copies) in the span
+        record["traced_transient_mb"] = (traced_peak - traced_start) / MB
+        rss_end = rss()
+        if rss_end is not None:
+          record["rss_mb"] = rss_end / MB
+          record["rss_delta_mb"] = (rss_end - rss_start) / MB
+          record["rss_peak_mb"] = peak_rss() / MB if resource is not None else None
+      with self.__lock:
+        self.events.append(record)
+
+  def sample_sizes(self, name, objects, **attrs):
+    """ Records the size (in MB) of each of a dict of named objects, with the current RSS """
+    record = {"sample": name, "start": time.perf_counter() - self.__start}
+    record.update(attrs)
+    for key, obj in objects.items():
+      record[key + "_mb"] = nbytes(obj) / MB
+    current = rss()
+    if current is not None:
+      record["rss_mb"] = current / MB
+    with self.__lock:
+      self.samples.append(record)
+    return record
+
+  def summary(self):
+    """ Total duration, call count and rows (and throughput) by span name, in order of first use, and the memory high-water marks """
+    spans = {}
+    for record in sorted(self.events, key=lambda record: record["start"]):
+      span = spans.setdefault(record["name"], {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "rows": 0})
+      span["count"] += 1
+      span["seconds"] += record["seconds"]
+      span["max_seconds"] = max(span["max_seconds"], record["seconds"])
+      span["rows"] += record.get("rows", 0)
+      if "traced_peak_mb" in record:
+        span["max_traced_peak_mb"] = max(span.get("max_traced_peak_mb", 0.0), record["traced_peak_mb"])
+        span["max_traced_transient_mb"] = max(span.get("max_traced_transient_mb", 0.0), record["traced_transient_mb"])
+      if "rss_mb" in record:
+        span["max_rss_mb"] = max(span.get("max_rss_mb", 0.0), record["rss_mb"])
+        span["max_rss_delta_mb"] = max(span.get("max_rss_delta_mb", -np.inf), record["rss_delta_mb"])
+    for span in spans.values():
+      span["mean_seconds"] = span["seconds"] / span["count"]
+      span["rows_per_second"] = span["rows"] / span["seconds"] if span["rows"] and span["seconds"] else None
+    return spans
+
+  def report(self):
+    report = {"started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+              "elapsed_seconds": time.perf_counter() - self.__start,
+              "spans": self.summary()}
+    if self.memory:
+      peak = peak_rss()
+      report["peak_rss_mb"] = None if peak is None else peak / MB
+      report["traced_peak_mb"] = max([record["traced_peak_mb"] for record in self.events if "traced_peak_mb" in record]
+                                     + [tracemalloc.get_traced_memory()[1] / MB if tracemalloc.is_tracing() else 0.0])
+    if self.counters:
+      report["counters"] = { name: counter() if callable(counter) else counter for name, counter in self.counters.items() }
+    if self.samples:
+      report["samples"] = self.samples
+    return report
+
+  def write(self, filename):
+    """ Writes the summary report to filename (JSON) and the span and size sample records to filename.jsonl """
+    with open(filename, "w") as fd:
+      json.dump(self.report(), fd, indent=2)
+    with open(filename.rsplit(".", 1)[0] + ".jsonl", "w") as fd:
+      for record in sorted(self.events + self.samples, key=lambda record: record["start"]):
+        fd.write(json.dumps(record) + "\n")
+
+  def print_summary(self):
+    print("%-24s %6s %10s %12s %10s" % ("span", "count", "seconds", "rows/s", "alloc(MB)"))
+    for name, span in self.summary().items():
+      print("%-24s %6d %10.3f %12s %10s" % (name, span["count"], span["seconds"],
+                                            "" if span["rows_per_second"] is None else "%.0f" % span["rows_per_second"],
+                                            "%.1f" % span["max_traced_transient_mb"] if "max_traced_transient_mb" in span else ""))
+
+@contextmanager
+def span(profiler, name, rows=None, **attrs):
+  """ As Profiler.span, but a no-op if profiler is None """
+  if profiler is None:
+    yield {}
+  else:
+    with profiler.span(name, rows, **attrs) as record:
+      yield record
+
+def timed(name):
+  """ Decorates a method so that its calls are recorded as spans of the object's profiler (if it has one) """
+  def decorator(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+      with span(getattr(self, "profiler", None), name) as record:
+        result = method(self, *args, **kwargs)
+        if isinstance(result, pd.DataFrame):
+          record["rows"] = len(result)
+        return result
+    return wrapper
+  return decorator
@@ -3,8 +3,11 @@ scenario.py
 Manages scenarios
 """
 
+import numpy as np
 import pandas as pd
 
+from simim.dense import ZoneIndex
+
 class Scenario():
   def __init__(self, filename, model_factors, od_filename=None):
     # zonal data (essential)
@@ -12,8 +15,8 @@ class Scenario():
 
     # od data (optional) used for transport accessibility
     #
-    # does not need to be the full n*n entries (380*380 for GB LADs), but the submatrix needs
-    # to be applied correctly to the overall travel cost matrix
+    # does not need to be the full n*n entries (380*380 for GB LADs): the values of the listed OD pairs
+    # replace those in the overall matrix, and other OD pairs are unchanged
     if od_filename is not None:
       self.od_data = pd.read_csv(od_filename)
     else:
@@ -39,6 +42,18 @@ class Scenario():
       if f not in self.data.columns and f not in self.od_data.columns
     ]
 
+    # index the scenario by year up front, so that the per-year lookups in the main loop are cheap
+    self.__timeline = sorted(self.data.YEAR.unique())
+    self.__od_timeline = sorted(self.od_data.YEAR.unique())
+    self.__geographies = sorted(self.data.GEOGRAPHY_CODE.unique())
+    self.__data_by_year = { year: data for year, data in self.data.groupby("YEAR") }
+    self.__od_data_by_year = { year: data for year, data in self.od_data.groupby("YEAR") }
+    # populated by compile
+    self.zones = None
+    self.rows = None
+    self.zone_deltas = {}
+    self.od_deltas = {}
+
     print("Model factors:", model_factors)
     print("Scenario zonal factors:", self.factors)
     print("Scenario OD factors:", self.od_factors)
@@ -64,13 +79,13 @@ class Scenario():
     self.current_time = None
 
   def timeline(self):
-    return sorted(self.data.YEAR.unique())
+    return self.__timeline
 
   def od_timeline(self):
-    return sorted(self.od_data.YEAR.unique())
+    return self.__od_timeline
 
   def geographies(self):
-    return sorted(self.data.GEOGRAPHY_CODE.unique())
+    return self.__geographies
 
   def od_geographies(self):
     return self.od_data[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE"]].drop_duplicates()
@@ -79,55 +94,149 @@ class Scenario():
     """Sets new scenario if there is data for the given year, otherwise empty data
     """
     self.current_time = year
-    self.current_scenario = self.data[self.data.YEAR==year]
-    self.current_od_scenario = self.od_data[self.od_data.YEAR == year]
+    self.current_scenario = self.__data_by_year.get(year, self.data.iloc[:0])
+    self.current_od_scenario = self.__od_data_by_year.get(year, self.od_data.iloc[:0])
+
+  def compile(self, zones, dataset=None):
+    """ Indexes each year's zonal and (sparse) OD changes by zone and, given a dataset, by its affected rows """
+    self.zones = zones
+    self.rows = None
+    self.zone_deltas = {}
+    for year, data in self.__data_by_year.items():
+      data = data[data.GEOGRAPHY_CODE.isin(zones.codes)]
+      index = zones.index(data.GEOGRAPHY_CODE.values)
+      # aggregate any repeated zones
+      changed, inverse = np.unique(index, return_inverse=True)
+      deltas = {}
+      for factor in self.factors:
+        deltas[factor] = np.bincount(inverse, weights=data[factor].values, minlength=len(changed))
+      self.zone_deltas[year] = (changed, deltas)
+    self.od_deltas = {}
+    for year, data in self.__od_data_by_year.items():
+      data = data[data.O_GEOGRAPHY_CODE.isin(zones.codes) & data.D_GEOGRAPHY_CODE.isin(zones.codes)] \
+        .drop_duplicates(["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE"], keep="last")
+      self.od_deltas[year] = (zones.index(data.O_GEOGRAPHY_CODE.values), zones.index(data.D_GEOGRAPHY_CODE.values),
+                              { factor: data[factor].values for factor in self.od_factors })
+    if dataset is not None:
+      self.__index_rows(dataset)
+
+  def __index_rows(self, dataset):
+    """ Indexes, for each year, the dataset rows whose origin or destination zone changes, and those of the listed OD pairs """
+    n = len(self.zones)
+    index = pd.Index(self.zones.codes)
+    o = index.get_indexer(dataset.O_GEOGRAPHY_CODE.values)
+    d = index.get_indexer(dataset.D_GEOGRAPHY_CODE.values)
+    # rows[year] is ((origin rows, their positions in the changed zones), (destination rows, positions), (OD rows, listed))
+    self.rows = {}
+    for year in set(self.zone_deltas) | set(self.od_deltas):
+      zone_rows = None
+      if year in self.zone_deltas:
+        position = np.full(n + 1, -1)
+        position[self.zone_deltas[year][0]] = np.arange(len(self.zone_deltas[year][0]))
+        o_rows = np.flatnonzero(position[o] >= 0)
+        d_rows = np.flatnonzero(position[d] >= 0)
+        zone_rows = ((o_rows, position[o[o_rows]]), (d_rows, position[d[d_rows]]))
+      od_rows = None
+      if year in self.od_deltas:
+        o_index, d_index, _ = self.od_deltas[year]
+        rows = pd.Index(o * n + d).get_indexer(o_index * n + d_index)
+        # (OD pairs not in the dataset are ignored)
+        od_rows = (rows[rows >= 0], rows >= 0)
+      self.rows[year] = (zone_rows, od_rows)
+    self.__rows_length = len(dataset)
+
+  def __rows_valid(self, dataset, year):
+    """ Checks (at the cost of the affected rows only) that the rows indexed for the year are those of the dataset """
+    if self.rows is None or self.__rows_length != len(dataset):
+      return False
+    zone_rows, od_rows = self.rows.get(year, (None, None))
+    codes = self.zones.codes
+    if zone_rows is not None:
+      (o_rows, o_position), (d_rows, d_position) = zone_rows
+      changed = self.zone_deltas[year][0]
+      if not (np.array_equal(dataset.O_GEOGRAPHY_CODE.values[o_rows], codes[changed[o_position]])
+              and np.array_equal(dataset.D_GEOGRAPHY_CODE.values[d_rows], codes[changed[d_position]])):
+        return False
+    if od_rows is not None:
+      rows, listed = od_rows
+      o_index, d_index, _ = self.od_deltas[year]
+      if not (np.array_equal(dataset.O_GEOGRAPHY_CODE.values[rows], codes[o_index[listed]])
+              and np.array_equal(dataset.D_GEOGRAPHY_CODE.values[rows], codes[d_index[listed]])):
+        return False
+    return True
+
+  def od_cells(self, year):
+    """ Returns the origin and destination zone indices of the OD pairs changed by the OD scenario in the given year """
+    if year not in self.od_deltas:
+      return np.array([], dtype=int), np.array([], dtype=int)
+    return self.od_deltas[year][0], self.od_deltas[year][1]
+
+  def __ensure_compiled(self, zones):
+    if self.zones is not zones and (self.zones is None or not np.array_equal(self.zones.codes, zones.codes)):
+      self.compile(zones)
 
   def apply(self, dataset, year):
-    """Apply scenario updates to the dataset
+    """Apply scenario updates to the (long-format) dataset, in place
 
     If there's no scenario for a year, reuse the most recent figures
     """
-    self.update(year)
+    self.current_time = year
+    # the affected rows are indexed once, and only they are updated
+    if not self.__rows_valid(dataset, year):
+      self.compile(ZoneIndex(np.union1d(dataset.O_GEOGRAPHY_CODE.unique(), dataset.D_GEOGRAPHY_CODE.unique())), dataset)
+    zone_rows, od_rows = self.rows.get(year, (None, None))
 
     # Zonal scenario
-    if self.current_scenario is None or len(self.current_scenario) == 0:
+    if zone_rows is None:
       print("No scenario changes for %d" % year)
     else:
       print("Updated scenario to %d" % year)
+      _, deltas = self.zone_deltas[year]
+      for factor in self.factors:
+        # apply to origins and destinations
+        for prefix, (rows, position) in zip(["O_", "D_"], zone_rows):
+          _update_rows(dataset, prefix + factor, rows, dataset[prefix + factor].values[rows] + deltas[factor][position])
 
-      # apply to origins ...
-      dataset = dataset.merge(
-        self.current_scenario, how="left", left_on="O_GEOGRAPHY_CODE", right_on="GEOGRAPHY_CODE"
-      ).drop(
-        ["GEOGRAPHY_CODE", "YEAR"], axis=1
-      ).fillna(0)
+    # OD scenario: the listed OD pairs are updated in place
+    if od_rows is None:
+      print("No OD scenario changes for %d" % year)
+    else:
+      print("Updated OD scenario to %d" % year)
+      _, _, values = self.od_deltas[year]
+      rows, listed = od_rows
+      for factor in self.od_factors:
+        _update_rows(dataset, factor, rows, values[factor][listed])
 
-      for factor in self.factors:
-        dataset["O_" + factor] += dataset[factor]
-      dataset.drop(self.factors, axis=1, inplace=True)
+    return dataset
 
-      # ... then destinations
-      dataset = dataset.merge(
-        self.current_scenario, how="left", left_on="D_GEOGRAPHY_CODE", right_on="GEOGRAPHY_CODE"
-      ).drop(
-        ["GEOGRAPHY_CODE", "YEAR"], axis=1
-      ).fillna(0)
+  def apply_dense(self, dense, year):
+    """Apply scenario updates in place to a dense.DenseDataset
+    """
+    self.current_time = year
+    self.__ensure_compiled(dense.zones)
 
+    # Zonal scenario: only the changed zones are touched (factors may be (draws x N) for an ensemble)
+    if year not in self.zone_deltas:
+      print("No scenario changes for %d" % year)
+    else:
+      print("Updated scenario to %d" % year)
+      changed, deltas = self.zone_deltas[year]
       for factor in self.factors:
-        dataset["D_" + factor] += dataset[factor]
-      dataset.drop(self.factors, axis=1, inplace=True)
+        dense[factor][..., changed] += deltas[factor]
 
-    # OD scenario
-    if self.current_od_scenario is None or len(self.current_od_scenario) == 0:
+    # OD scenario: only the listed OD pairs are touched
+    if year not in self.od_deltas:
       print("No OD scenario changes for %d" % year)
     else:
       print("Updated OD scenario to %d" % year)
-      # apply od scenario to the dataset
-      dataset.drop(self.od_factors, axis=1, inplace=True)
-      dataset = dataset.merge(
-        self.current_od_scenario, how="left", on=["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE"]
-      ).drop(
-        ["YEAR"], axis=1
-      ).fillna(0)
+      o_index, d_index, values = self.od_deltas[year]
+      for factor in self.od_factors:
+        dense[factor][o_index, d_index] = values[factor]
 
-    return dataset
+    return dense
+
+def _update_rows(dataset, column, rows, values):
+  """ Sets the values of a column of the dataset at the given row positions, in place (converting it to float if need be) """
+  if dataset[column].dtype != float:
+    dataset[column] = dataset[column].astype(float)
+  dataset.iloc[rows, dataset.columns.get_loc(column)] = values
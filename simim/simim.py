@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import json
 import numpy as np
 import pandas as pd
 import geopandas
@@ -11,7 +12,9 @@ import simim.models as models
 
 import ukpopulation.utils as ukpoputils
 
-from simim.utils import get_named_values, calc_distances, access_weighted_sum
+from simim.utils import get_named_values, access_weighted_sum, md5hash, md5file, save_dataframe, load_dataframe
+from simim.dense import DenseDataset, AccessibilityOperator
+from simim.prefetch import Pipeline
 
 ORIGIN_PREFIX = "O_"
 DESTINATION_PREFIX = "D_"
@@ -75,38 +78,245 @@ def _compute_derived_factors(dataset):
   # dataset.to_csv("debug_post-compute-derived-factors.csv")
   return dataset
 
-def simim(params):
-  # Differentiate between origin and destination values
-  # This allows use of e.g. derived values (e.g. population density) to be both an emitter and an attractor. Absolute values cannot (->singular matrix)
-  # enure arrays
-  if isinstance(params["emitters"], str):
-    params["emitters"] = [params["emitters"]]
-  if isinstance(params["attractors"], str):
-    params["attractors"] = [params["attractors"]]
-
-  params["emitters"] = [ORIGIN_PREFIX + e for e in params["emitters"]]
-  params["attractors"] = [DESTINATION_PREFIX + e for e in params["attractors"]]
+def _project(params, model, input_data, scenario_data, movers, geogs, start_year, end_year, baseline_snpp, migration_scale_factor):
+  """ The original (pandas) engine: the model dataset is a long-format OD dataframe, updated by merges """
+  profiler = input_data.profiler
+  for year in range(start_year, end_year + 1):
+    with profiler.span("year", rows=len(model.dataset), year=year):
+
+      # if scenario compute changed migrations
+      if year in scenario_data.timeline():
+        # compute pre-scenario model migrations
+        with profiler.span("year.evaluate", rows=len(model.dataset)):
+          emitter_values = get_named_values(model.dataset, params["emitters"])
+          attractor_values = get_named_values(model.dataset, params["attractors"])
+          model_migrations_pre_scenario = model(emitter_values, attractor_values)
+
+        # NOTE derived factors update here under scenario; previously derived values done with
+        # baseline updates below
+
+        # apply scenario and recompute derived factors
+        with profiler.span("year.scenario", rows=len(model.dataset)):
+          model.dataset = scenario_data.apply(model.dataset, year)
+          model.dataset = _compute_derived_factors(model.dataset)
+          model.check_dataset()
+
+        # re-evaluate model and record changes
+        with profiler.span("year.evaluate", rows=len(model.dataset)):
+          emitter_values = get_named_values(model.dataset, params["emitters"])
+          attractor_values = get_named_values(model.dataset, params["attractors"])
+          model_migrations_post_scenario = model(emitter_values, attractor_values)
+
+        # scale migrations according to observed value
+        model.dataset["CHANGED_MIGRATIONS"] = model.dataset["MIGRATIONS"] * (model_migrations_post_scenario / model_migrations_pre_scenario - 1.0)
+        # model.dataset.to_csv("debug_dataset-post-scenario-{}.csv".format(year))
+      else:
+        model.dataset["CHANGED_MIGRATIONS"] = 0
+
+      #ox = ox.append(model.dataset[(model.dataset.O_GEOGRAPHY_CODE == model.dataset.D_GEOGRAPHY_CODE) & (model.dataset.O_GEOGRAPHY_CODE == "E07000178")])
+
+      with profiler.span("year.deltas", rows=len(model.dataset)):
+        # compute migration inflows and outflow changes
+        delta = pd.DataFrame({"o_lad16cd": model.dataset.O_GEOGRAPHY_CODE,
+                              "d_lad16cd": model.dataset.D_GEOGRAPHY_CODE,
+                              "delta": model.dataset.CHANGED_MIGRATIONS})
+
+        # upscale delta by mover percentage at origin
+        delta = pd.merge(delta, movers, left_on="o_lad16cd", right_index=True)
+        # TODO reinstate if necessary
+        delta["delta"] /= migration_scale_factor
+        # delta["delta"] /= delta["MIGRATION_RATE"]
+        delta = delta.drop(["PEOPLE", "MIGRATIONS", "MIGRATION_RATE"], axis=1)
+
+        # remove in-LAD migrations and sum
+        o_delta = delta.groupby("d_lad16cd").sum().reset_index().rename({"d_lad16cd": "lad16cd", "delta": "o_delta"}, axis=1)
+        d_delta = delta.groupby("o_lad16cd").sum().reset_index().rename({"o_lad16cd": "lad16cd", "delta": "d_delta"}, axis=1)
+        delta = o_delta.merge(d_delta)
+        # compute net migration change
+        delta["net_delta"] = delta.o_delta - delta.d_delta
+
+        #print(delta[delta["lad16cd"].isin(scenario_data.geographies())])
+        print("Change in migrations to scenario region: %.0f" % delta[delta["lad16cd"].isin(scenario_data.geographies())]["net_delta"].sum())
+
+        # add to results and to model dataset
+        custom_snpp = baseline_snpp.merge(model.dataset[["O_GEOGRAPHY_CODE", "O_PEOPLE"]].drop_duplicates(), left_on="GEOGRAPHY_CODE", right_on="O_GEOGRAPHY_CODE") \
+          .rename({"PEOPLE": "PEOPLE_SNPP", "O_PEOPLE": "PEOPLE"}, axis=1)
+        custom_snpp = custom_snpp.drop(["O_GEOGRAPHY_CODE"], axis=1) \
+          .merge(delta, left_on="GEOGRAPHY_CODE", right_on="lad16cd").drop(["lad16cd", "o_delta", "d_delta"], axis=1)
+        custom_snpp["PEOPLE"] += custom_snpp["net_delta"]
+        custom_snpp.drop("net_delta", axis=1, inplace=True)
+
+        model.dataset = model.dataset.drop({"O_PEOPLE", "D_PEOPLE"}, axis=1) \
+          .merge(custom_snpp[["GEOGRAPHY_CODE", "PEOPLE"]].rename({"PEOPLE": "O_PEOPLE"}, axis=1), left_on="O_GEOGRAPHY_CODE", right_on="GEOGRAPHY_CODE") \
+          .merge(custom_snpp[["GEOGRAPHY_CODE", "PEOPLE"]].rename({"PEOPLE": "D_PEOPLE"}, axis=1), left_on="D_GEOGRAPHY_CODE", right_on="GEOGRAPHY_CODE") \
+          .drop({"GEOGRAPHY_CODE_x", "GEOGRAPHY_CODE_y"}, axis=1)
+
+        # TODO IDEA: merge emitters/attractors back on to custom_snpp for output/comparison as calculated
+
+        input_data.append_output(custom_snpp, year)
+
+      # now update baselines for following year, unless we are in the final year
+      if year < end_year:
+        with profiler.span("year.baseline", rows=len(model.dataset)):
+          # persist data from model but take relative SNPP change
+          baseline_snpp_prev = input_data.get_people(year, geogs).rename({"PEOPLE": "PEOPLE_PREV"},axis=1)
+          baseline_snpp = input_data.get_people(year+1, geogs)
+          baseline_snpp = baseline_snpp.merge(baseline_snpp_prev, on="GEOGRAPHY_CODE")
+          # relative delta
+          baseline_snpp["PEOPLE_DELTA"] = baseline_snpp["PEOPLE"] / baseline_snpp["PEOPLE_PREV"]
+          model.dataset = _merge_factor(model.dataset, baseline_snpp[["GEOGRAPHY_CODE", "PEOPLE_DELTA"]], ["PEOPLE_DELTA"])
+          model.dataset = _apply_delta(model.dataset, "PEOPLE", relative=True)
+
+          # absolute deltas
+          snhp = _get_delta(input_data.get_households, "HOUSEHOLDS", year+1, geogs)
+          model.dataset = _merge_factor(model.dataset, snhp, ["HOUSEHOLDS_DELTA"])
+          model.dataset = _apply_delta(model.dataset, "HOUSEHOLDS")
+
+          jobs = input_data.get_economic_delta("JOBS", year+1, geogs)
+          model.dataset = _merge_factor(model.dataset, jobs, ["JOBS_DELTA"])
+          model.dataset = _apply_delta(model.dataset, "JOBS")
+
+          gva = input_data.get_economic_delta("GVA", year+1, geogs)
+          model.dataset = _merge_factor(model.dataset, gva, ["GVA_DELTA"])
+          model.dataset = _apply_delta(model.dataset, "GVA")
+
+          # derived factors
+          model.dataset = _compute_derived_factors(model.dataset)
+
+    if profiler.memory:
+      profiler.sample_sizes("sizes", {"model_dataset": model.dataset, "output": input_data.output}, year=year)
+  return delta
+
+
+def _compute_derived_factors_dense(dense, london, access, jobs_accessibility=None):
+  """ As _compute_derived_factors, for a DenseDataset, unless jobs_accessibility is given """
+  # London's high GVA does not prevent migration so we artificially reduce it
+  dense["GVA_EX_LONDON"] = dense["GVA"].copy()
+  dense["GVA_EX_LONDON"][london] = min(dense["GVA"])
+
+  # D_JOBS_ACCESSIBILITY: access-to-jobs[d] = Sum over o { access[o,d] * jobs[o] }
+  dense["JOBS_ACCESSIBILITY"] = access(dense["JOBS"]) if jobs_accessibility is None else jobs_accessibility
+  return dense
+
+def _project_dense(params, model, input_data, scenario_data, start_year, end_year, migration_scale_factor, draws=None):
+  """ The dense engine, with zonal vectors and NxN arrays, optionally for an ensemble of parameter draws """
+  profiler = input_data.profiler
+  od_cols = list(dict.fromkeys(["MIGRATIONS", "ACCESSIBILITY", params["cost"]] + scenario_data.od_factors))
+  dense = DenseDataset.from_dataframe(model.dataset, ["PEOPLE", "HOUSEHOLDS", "JOBS", "GVA"], od_cols)
+  n = len(dense.zones)
+  london = dense.zones.mask(lambda code: code.startswith("E09"))
+  scenario_zones = dense.zones.index([g for g in scenario_data.geographies() if g in dense.zones])
+  scenario_data.compile(dense.zones)
+  # optionally sparse, ignoring accessibility values below the threshold
+  access = AccessibilityOperator(dense["ACCESSIBILITY"], params.get("accessibility_threshold"))
+  _compute_derived_factors_dense(dense, london, access)
+
+  # fetch the input data for the whole horizon up front
+  panel = input_data.get_panel(start_year, end_year, dense.zones.codes)
+  people_snpp = panel.get("PEOPLE", start_year)
+
+  # the model's factorised vectors and matrices are indexed in the same (sorted) zone order
+  assert np.array_equal(model.zones(), dense.zones.codes)
+  # observed migration totals don't change
+  migrations_in = dense["MIGRATIONS"].sum(axis=0)
+  migrations_out = dense["MIGRATIONS"].sum(axis=1)
+
+  # an ensemble is evaluated together with the fitted parameters, as the first row
+  ensemble = None
+  if draws is not None:
+    ensemble = np.vstack([model.impl.params, draws])
+    dense["PEOPLE"] = np.tile(dense["PEOPLE"], (len(ensemble), 1))
 
-  # optional OD scenario - for e.g. transport accessibility between pairs of zones
-  if "od_scenario" in params:
-    od_scenario_filename = os.path.join(params["scenario_dir"], params["od_scenario"])
+  for year in range(start_year, end_year + 1):
+    with profiler.span("year", rows=n * n, year=year):
+
+      # if scenario compute changed migrations
+      if year in scenario_data.timeline():
+        # record pre-scenario model factors
+        xo = [np.copy(x) for x in dense.get_zonal_values(params["emitters"])]
+        xd = [np.copy(x) for x in dense.get_zonal_values(params["attractors"])]
+        # and the OD values that the OD scenario (if any) will change
+        o, d = scenario_data.od_cells(year)
+        cost = dense[params["cost"]][o, d] if params["cost"] in scenario_data.od_factors else None
+        jobs = dense["JOBS"].copy()
+
+        # apply scenario, in place, and recompute derived factors
+        with profiler.span("year.scenario", rows=n):
+          scenario_data.apply_dense(dense, year)
+          # job accessibility is updated for the changed accessibility cells and jobs only, rather than recomputed
+          jobs_accessibility = dense["JOBS_ACCESSIBILITY"].copy()
+          if "ACCESSIBILITY" in scenario_data.od_factors:
+            access.update(o, d, dense["ACCESSIBILITY"][o, d], jobs, jobs_accessibility)
+          changed = np.flatnonzero(dense["JOBS"] != jobs)
+          if len(changed):
+            jobs_accessibility += access.partial(changed, dense["JOBS"] - jobs)
+          _compute_derived_factors_dense(dense, london, access, jobs_accessibility)
+          cost_cells = None
+          if cost is not None:
+            cost_cells = (o, d, cost, dense[params["cost"]][o, d])
+
+        # compute the impact on migrations in closed form from the changed factors and the model elasticities
+        with profiler.span("year.evaluate", rows=n * n):
+          impact = model.impact(xo, dense.get_zonal_values(params["emitters"]), xd, dense.get_zonal_values(params["attractors"]), cost_cells, ensemble)
+
+          # scale migrations according to observed value and compute migration inflows and outflow changes
+          o_delta, d_delta = impact.changed_flows(dense["MIGRATIONS"], migrations_in, migrations_out)
+          o_delta /= migration_scale_factor
+          d_delta /= migration_scale_factor
+      else:
+        impact = None
+        o_delta = np.zeros(dense["PEOPLE"].shape)
+        d_delta = np.zeros(dense["PEOPLE"].shape)
+
+      with profiler.span("year.deltas", rows=n):
+        # compute net migration change
+        net_delta = o_delta - d_delta
+
+        # add to results and to model dataset
+        dense["PEOPLE"] += net_delta
+        people = dense["PEOPLE"] if ensemble is None else dense["PEOPLE"][0]
+        print("Change in migrations to scenario region: %.0f" % (net_delta if ensemble is None else net_delta[0])[scenario_zones].sum())
+        custom_snpp = pd.DataFrame({"GEOGRAPHY_CODE": dense.zones.codes, "PEOPLE_SNPP": people_snpp, "PEOPLE": people.copy()})
+        input_data.append_output(custom_snpp, year)
+        if ensemble is not None:
+          input_data.append_ensemble_output(dense["PEOPLE"][1:], year)
+
+      # now update baselines for following year, unless we are in the final year
+      if year < end_year:
+        with profiler.span("year.baseline", rows=n):
+          # persist data from model but take relative SNPP change
+          people_snpp = panel.get("PEOPLE", year+1)
+          dense["PEOPLE"] *= panel.ratio("PEOPLE", year+1)
+
+          # absolute deltas
+          dense["HOUSEHOLDS"] += panel.delta("HOUSEHOLDS", year+1)
+          dense["JOBS"] += panel.delta("JOBS", year+1)
+          dense["GVA"] += panel.delta("GVA", year+1)
+
+          # derived factors
+          _compute_derived_factors_dense(dense, london, access)
+
+    if profiler.memory:
+      profiler.sample_sizes("sizes", {"model_dataset": model.dataset, "dense": [dense.factors, dense.od], "output": input_data.output}, year=year)
+
+  # the fitted-parameter projection of an ensemble
+  if ensemble is not None:
+    dense["PEOPLE"] = dense["PEOPLE"][0]
+    o_delta, d_delta, net_delta = o_delta[0], d_delta[0], net_delta[0]
+    if impact is not None:
+      impact = impact.draw(0)
+
+  # write the final state back to the model dataset (only now is the full OD matrix of changed migrations computed)
+  if impact is not None:
+    dense["CHANGED_MIGRATIONS"] = impact.changed_matrix(dense["MIGRATIONS"])
   else:
-    od_scenario_filename = None
-
-  scenario_data = scenario.Scenario(
-    os.path.join(params["scenario_dir"], params["scenario"]),
-    params["emitters"] + params["attractors"],
-    od_scenario_filename)
-
-  input_data = data_apis.Instance(params)
-
-  if params["base_projection"] != "ppp":
-    raise NotImplementedError("TODO variant projections...")
-
-  od_2011 = input_data.get_od()
+    dense["CHANGED_MIGRATIONS"] = np.zeros((n, n))
+  model.dataset = dense.update_dataframe(model.dataset)
 
-  lad_lookup = input_data.get_lad_lookup()
+  return pd.DataFrame({"lad16cd": dense.zones.codes, "o_delta": o_delta, "d_delta": d_delta, "net_delta": net_delta})
 
+def _get_base_od(input_data, od_2011, lad_lookup, shapefile, distances, cmpops):
+  """ Assembles the 2011 OD migration dataset by LAD, with distances and areas, from its inputs (see _add_base_od) """
   # only need the CMLAD->LAD mapping
   od_2011 = od_2011.merge(lad_lookup, how='left', left_on="ADDRESS_ONE_YEAR_AGO_CODE", right_on="LAD_CM") \
     .rename({"LAD": ORIGIN_PREFIX + "GEOGRAPHY_CODE"}, axis=1).drop(["LAD_CM"], axis=1)
@@ -122,10 +332,9 @@ def simim(params):
 
   # census merged LAD migrations are duplicated, so proportion them accoring to 2011 population ratios,
   # converting back to nearest integer (model requires int observations)
-  cmpops = input_data.get_people(2011, ["E09000001","E09000033"])
-  city_westminster_ratio = cmpops[cmpops.GEOGRAPHY_CODE == "E09000001"].PEOPLE.values[0] / cmpops.PEOPLE.sum()
-  cmpops = input_data.get_people(2011, ["E06000052", "E06000053"])
-  scilly_cornwall_ratio = cmpops[cmpops.GEOGRAPHY_CODE == "E06000053"].PEOPLE.values[0] / cmpops.PEOPLE.sum()
+  city_westminster, scilly_cornwall = cmpops
+  city_westminster_ratio = city_westminster[city_westminster.GEOGRAPHY_CODE == "E09000001"].PEOPLE.values[0] / city_westminster.PEOPLE.sum()
+  scilly_cornwall_ratio = scilly_cornwall[scilly_cornwall.GEOGRAPHY_CODE == "E06000053"].PEOPLE.values[0] / scilly_cornwall.PEOPLE.sum()
   # (adjustments for Westminster/City of London and Cornwall/Scilly Isles)
   od_2011.loc[od_2011.O_GEOGRAPHY_CODE == "E09000001", "MIGRATIONS"] *= city_westminster_ratio
   od_2011.loc[od_2011.O_GEOGRAPHY_CODE == "E09000033", "MIGRATIONS"] *= 1 - city_westminster_ratio
@@ -137,13 +346,8 @@ def simim(params):
   od_2011.loc[od_2011.D_GEOGRAPHY_CODE == "E06000052", "MIGRATIONS"] *= 1 - scilly_cornwall_ratio
   od_2011.MIGRATIONS = od_2011.MIGRATIONS.round().astype(int)
 
-  # get distances (url is GB ultra generalised clipped LAD boundaries/centroids)
-  url = "https://opendata.arcgis.com/datasets/686603e943f948acaa13fb5d2b0f1275_4.zip?outSR=%7B%22wkid%22%3A27700%2C%22latestWkid%22%3A27700%7D"
-
-  shapefile = input_data.get_shapefile(url)
-  dists = calc_distances(shapefile)
-  # merge dists with OD
-  od_2011 = od_2011.merge(dists, how="left", left_on=["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE"], right_on=["orig", "dest"]).drop(["orig", "dest"], axis=1)
+  # get distances (from GB ultra generalised clipped LAD boundaries/centroids)
+  od_2011["DISTANCE"] = distances.cells(od_2011.O_GEOGRAPHY_CODE.values, od_2011.D_GEOGRAPHY_CODE.values)
   # add areas (converting from square metres (not hectares!) to square km)
   od_2011 = od_2011.merge(shapefile[["lad16cd", "st_areasha"]], left_on="O_GEOGRAPHY_CODE", right_on="lad16cd").drop("lad16cd", axis=1).rename({"st_areasha": "O_AREA_KM2"}, axis=1)
   od_2011.loc[:,"O_AREA_KM2"] *= 1e-6
@@ -163,6 +367,97 @@ def simim(params):
           '95EE', '95PP', '95UU', '95WW', '95KK', '95JJ']
     od_2011 = od_2011[(~od_2011.O_GEOGRAPHY_CODE.isin(ni)) & (~od_2011.D_GEOGRAPHY_CODE.isin(ni))]
 
+  return od_2011
+
+def _base_od_key(input_data):
+  """ Hash of everything the base OD dataset depends on """
+  inputs = {
+    "version": 1,
+    "coverage": sorted(input_data.coverage),
+    "od_table": data_apis.OD_TABLE,
+    "od_query": data_apis.OD_QUERY,
+    "shapefile_url": input_data.shapefile_url,
+    "lad_lookup": md5file(input_data.lad_lookup_file)
+  }
+  return md5hash(json.dumps(inputs, sort_keys=True))
+
+def _add_base_od(inputs, input_data):
+  """ Adds stages to inputs that assemble (or load from cache_dir) the 2011 OD dataset, as stage od_2011 """
+  cache_file = os.path.join(input_data.cache_dir, "od2011_%s.npz" % _base_od_key(input_data))
+  if os.path.isfile(cache_file):
+    print("using cached data: %s" % cache_file)
+    return inputs.add("od_2011", lambda: load_dataframe(cache_file))
+
+  # distances are computed from the shapefile, the other inputs are independent. The stages share no state except
+  # the data cache (which is locked): in particular only cmpops queries ukpopulation, whose objects are not thread-safe
+  inputs.add("od", input_data.get_od)
+  inputs.add("lad_lookup", input_data.get_lad_lookup)
+  inputs.add("shapefile", lambda: input_data.get_shapefile(input_data.shapefile_url))
+  inputs.add("distances", lambda shapefile: input_data.get_distances(), after=["shapefile"])
+  # (2011 population of the census merged LADs)
+  inputs.add("cmpops", lambda: [input_data.get_people(2011, geogs) for geogs in [["E09000001","E09000033"], ["E06000052", "E06000053"]]])
+  def assemble(*args):
+    od_2011 = _get_base_od(input_data, *args)
+    save_dataframe(od_2011, cache_file)
+    return od_2011
+  return inputs.add("od_2011", assemble, after=["od", "lad_lookup", "shapefile", "distances", "cmpops"])
+
+def _normalise_params(params):
+  """ Ensures emitters and attractors are lists, and prefixes them to differentiate between origin and destination values """
+  # This allows use of e.g. derived values (e.g. population density) to be both an emitter and an attractor. Absolute values cannot (->singular matrix)
+  # enure arrays
+  if isinstance(params["emitters"], str):
+    params["emitters"] = [params["emitters"]]
+  if isinstance(params["attractors"], str):
+    params["attractors"] = [params["attractors"]]
+
+  params["emitters"] = [ORIGIN_PREFIX + e for e in params["emitters"]]
+  params["attractors"] = [DESTINATION_PREFIX + e for e in params["attractors"]]
+  return params
+
+def _load_scenario(params):
+  """ Loads the scenario given in params, with the optional OD scenario (e.g. transport accessibility between pairs of zones) """
+  if "od_scenario" in params:
+    od_scenario_filename = os.path.join(params["scenario_dir"], params["od_scenario"])
+  else:
+    od_scenario_filename = None
+
+  return scenario.Scenario(
+    os.path.join(params["scenario_dir"], params["scenario"]),
+    params["emitters"] + params["attractors"],
+    od_scenario_filename)
+
+def _check_years(scenario_data, start_year=None, end_year=None):
+  """ Checks that the model run covers the start of the scenario. Years that are None are not checked """
+  if start_year is not None and start_year > scenario_data.timeline()[0]:
+    raise RuntimeError("start year for model run cannot be after start year of scenario")
+  if end_year is not None and end_year < scenario_data.timeline()[0]:
+    raise RuntimeError("end year for model run cannot be before start year of scenario")
+
+def prepare(params, scenarios=None):
+  """ Loads the input data and fits the model for (normalised) params, checking the years of the scenarios first """
+  input_data = data_apis.Instance(params)
+
+  if params["base_projection"] != "ppp":
+    raise NotImplementedError("TODO variant projections...")
+
+  # use start year if defined in config, otherwise default to economics scenario start year
+  start_year = params.get("start_year", input_data.economic_baseline.years[0])
+  # use end year if defined in config, otherwise default to SNPP end year (up to 2039 due to Wales SNPP still being 2014-based)
+  end_year = params.get("end_year", input_data.snpp.max_year("en"))
+
+  for scenario_params in scenarios or [params]:
+    _check_years(_load_scenario(scenario_params), start_year, end_year)
+
+  # 2011 OD migrations by LAD with distances and areas, from the cache if possible
+  # (and the accessibility matrix, which is converted into the matrix store on first use, at the same time)
+  with input_data.profiler.span("preprocess.od") as span:
+    inputs = Pipeline("prefetch", input_data.prefetch_threads, input_data.profiler)
+    _add_base_od(inputs, input_data)
+    inputs.add("accessibility", lambda: input_data.accessibility)
+    od_2011 = inputs.run()["od_2011"]
+    span["rows"] = len(od_2011)
+
   geogs = od_2011.O_GEOGRAPHY_CODE.unique()
 
   # get no of people who moved (by origin) for each LAD - for later use as a scaling factor for migrations
@@ -176,56 +471,48 @@ def simim(params):
   # # ensure base dataset is sorted so that the mu/alphas for the constrained models are interpreted correctly
   # od_2011.sort_values(["D_GEOGRAPHY_CODE", "O_GEOGRAPHY_CODE"], inplace=True)
 
-  # use start year if defined in config, otherwise default to economics scenario start year
-  start_year = params.get("start_year", input_data.economic_data.YEAR.min())
-  if start_year > scenario_data.timeline()[0]:
-    raise RuntimeError("start year for model run cannot be after start year of scenario")
-  # use end year if defined in config, otherwise default to SNPP end year (up to 2039 due to Wales SNPP still being 2014-based)
-  end_year = params.get("end_year", input_data.snpp.max_year("en"))
-  if end_year < scenario_data.timeline()[0]:
-    raise RuntimeError("end year for model run cannot be before start year of scenario")
-
-  # assemble initial model
-  baseline_snpp = input_data.get_people(start_year, geogs)
-  snhp = input_data.get_households(start_year, geogs)
-
-  jobs = input_data.get_jobs(start_year, geogs)
-  gva = input_data.get_gva(start_year, geogs)
-
-  # Merge attractors and emitters *all at both origin AND destination*
-  dataset = _merge_factor(od_2011, baseline_snpp, ["PEOPLE"])
-  #print(dataset.head())
-  dataset = _merge_factor(dataset, snhp, ["HOUSEHOLDS"])
-  dataset = _merge_factor(dataset, jobs, ["JOBS"])
-  dataset = _merge_factor(dataset, gva, ["GVA"])
-
-  # add accessibility to dataset
-  dataset = dataset.merge(input_data.get_accessibility(dataset), on=["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE"])
-
-  # compute derived factors...
-  # - GVA ex-London
-  # - employment accessibility from accessibility and jobs
-  # - could include density-derived factors
-  dataset = _compute_derived_factors(dataset)
+  with input_data.profiler.span("preprocess.dataset") as span:
+    # assemble initial model
+    baseline_snpp = input_data.get_people(start_year, geogs)
+    snhp = input_data.get_households(start_year, geogs)
+
+    jobs = input_data.get_jobs(start_year, geogs)
+    gva = input_data.get_gva(start_year, geogs)
+
+    # Merge attractors and emitters *all at both origin AND destination*
+    dataset = _merge_factor(od_2011, baseline_snpp, ["PEOPLE"])
+    #print(dataset.head())
+    dataset = _merge_factor(dataset, snhp, ["HOUSEHOLDS"])
+    dataset = _merge_factor(dataset, jobs, ["JOBS"])
+    dataset = _merge_factor(dataset, gva, ["GVA"])
+
+    # add accessibility to dataset
+    dataset = dataset.merge(input_data.get_accessibility(dataset), on=["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE"])
+
+    # compute derived factors...
+    # - GVA ex-London
+    # - employment accessibility from accessibility and jobs
+    # - could include density-derived factors
+    dataset = _compute_derived_factors(dataset)
+    span["rows"] = len(dataset)
   # dataset.to_csv("debug_dataset-pre-model.csv")
 
   # constructor checks for no bad values in data
-  model = models.Model(params["model_type"],
-                       params["model_subtype"],
-                       dataset,
-                       params["observation"],
-                       params["emitters"],
-                       params["attractors"],
-                       params["cost"])
+  # the fit is reused from the model store (in cache_dir) if the spec and data are unchanged, unless "refit" is set
+  with input_data.profiler.span("fit", rows=len(dataset)):
+    model = models.Model(params["model_type"],
+                         params["model_subtype"],
+                         dataset,
+                         params["observation"],
+                         params["emitters"],
+                         params["attractors"],
+                         params["cost"],
+                         store_dir=None if params.get("refit", False) else params["cache_dir"],
+                         fitter=params.get("fitter", "spint"),
+                         balancing_tolerance=params.get("balancing_tolerance", 1e-10))
   # dataset is now sunk into model, delete the original
   del dataset
 
-  # scale migrations by dividing by this factor - assumes model naturally represents this
-  # percentage of actual migrations
-  migration_scale_factor = 0.08
-  if "migration_scale_factor" in params:
-    migration_scale_factor = params["migration_scale_factor"]
-
   emitter_values = get_named_values(model.dataset, params["emitters"])
   attractor_values = get_named_values(model.dataset, params["attractors"])
   # check recalculation matches the fitted values
@@ -246,106 +533,50 @@ def simim(params):
     print("alpha =", *model.alpha())
   print("beta = %f" % model.beta())
 
-  # main loop
-  for year in range(start_year, end_year + 1):
+  return input_data, model, movers, geogs, start_year, end_year, baseline_snpp
 
-    # if scenario compute changed migrations
-    if year in scenario_data.timeline():
-      # compute pre-scenario model migrations
-      emitter_values = get_named_values(model.dataset, params["emitters"])
-      attractor_values = get_named_values(model.dataset, params["attractors"])
-      model_migrations_pre_scenario = model(emitter_values, attractor_values)
-
-      # NOTE derived factors update here under scenario; previously derived values done with
-      # baseline updates below
-
-      # apply scenario and recompute derived factors
-      model.dataset = scenario_data.apply(model.dataset, year)
-      model.dataset = _compute_derived_factors(model.dataset)
-      model.check_dataset()
-
-      # re-evaluate model and record changes
-      emitter_values = get_named_values(model.dataset, params["emitters"])
-      attractor_values = get_named_values(model.dataset, params["attractors"])
-      model_migrations_post_scenario = model(emitter_values, attractor_values)
-
-      # scale migrations according to observed value
-      model.dataset["CHANGED_MIGRATIONS"] = model.dataset["MIGRATIONS"] * (model_migrations_post_scenario / model_migrations_pre_scenario - 1.0)
-      # model.dataset.to_csv("debug_dataset-post-scenario-{}.csv".format(year))
+def run_scenario(params, prepared):
+  """ Projects the scenario in params from the (unmodified) output of prepare """
+  input_data, model, movers, geogs, start_year, end_year, baseline_snpp = prepared
+
+  with input_data.profiler.span("scenario.load"):
+    scenario_data = _load_scenario(params)
+  _check_years(scenario_data, start_year, end_year)
+
+  # scale migrations by dividing by this factor - assumes model naturally represents this
+  # percentage of actual migrations
+  migration_scale_factor = 0.08
+  if "migration_scale_factor" in params:
+    migration_scale_factor = params["migration_scale_factor"]
+
+  # optional ensemble of projections from parameters drawn from the fitted distribution (dense engine only)
+  engine = params.get("engine", "pandas")
+  draws = None
+  if params.get("ensemble_draws"):
+    if engine != "dense":
+      raise ValueError("ensemble projections require the dense engine")
+    draws = model.draw_params(params["ensemble_draws"], params.get("ensemble_seed", 0))
+
+  # results are stored in place, by year and zone
+  input_data.init_output(start_year, end_year, model.zones(), None if draws is None else params.get("ensemble_quantiles", [0.05, 0.5, 0.95]))
+
+  # main loop
+  with input_data.profiler.span("project", engine=engine):
+    if engine == "dense":
+      delta = _project_dense(params, model, input_data, scenario_data, start_year, end_year, migration_scale_factor, draws)
+    elif engine == "pandas":
+      delta = _project(params, model, input_data, scenario_data, movers, geogs, start_year, end_year, baseline_snpp, migration_scale_factor)
     else:
-      model.dataset["CHANGED_MIGRATIONS"] = 0
-
-    #ox = ox.append(model.dataset[(model.dataset.O_GEOGRAPHY_CODE == model.dataset.D_GEOGRAPHY_CODE) & (model.dataset.O_GEOGRAPHY_CODE == "E07000178")])
-
-    # compute migration inflows and outflow changes
-    delta = pd.DataFrame({"o_lad16cd": model.dataset.O_GEOGRAPHY_CODE,
-                          "d_lad16cd": model.dataset.D_GEOGRAPHY_CODE,
-                          "delta": model.dataset.CHANGED_MIGRATIONS})
-
-    # upscale delta by mover percentage at origin
-    delta = pd.merge(delta, movers, left_on="o_lad16cd", right_index=True)
-    # TODO reinstate if necessary
-    delta["delta"] /= migration_scale_factor
-    # delta["delta"] /= delta["MIGRATION_RATE"]
-    delta = delta.drop(["PEOPLE", "MIGRATIONS", "MIGRATION_RATE"], axis=1)
-
-    # remove in-LAD migrations and sum
-    o_delta = delta.groupby("d_lad16cd").sum().reset_index().rename({"d_lad16cd": "lad16cd", "delta": "o_delta"}, axis=1)
-    d_delta = delta.groupby("o_lad16cd").sum().reset_index().rename({"o_lad16cd": "lad16cd", "delta": "d_delta"}, axis=1)
-    delta = o_delta.merge(d_delta)
-    # compute net migration change
-    delta["net_delta"] = delta.o_delta - delta.d_delta
-
-    #print(delta[delta["lad16cd"].isin(scenario_data.geographies())])
-    print("Change in migrations to scenario region: %.0f" % delta[delta["lad16cd"].isin(scenario_data.geographies())]["net_delta"].sum())
-
-    # add to results and to model dataset
-    custom_snpp = baseline_snpp.merge(model.dataset[["O_GEOGRAPHY_CODE", "O_PEOPLE"]].drop_duplicates(), left_on="GEOGRAPHY_CODE", right_on="O_GEOGRAPHY_CODE") \
-      .rename({"PEOPLE": "PEOPLE_SNPP", "O_PEOPLE": "PEOPLE"}, axis=1)
-    custom_snpp = custom_snpp.drop(["O_GEOGRAPHY_CODE"], axis=1) \
-      .merge(delta, left_on="GEOGRAPHY_CODE", right_on="lad16cd").drop(["lad16cd", "o_delta", "d_delta"], axis=1)
-    custom_snpp["PEOPLE"] += custom_snpp["net_delta"]
-    custom_snpp.drop("net_delta", axis=1, inplace=True)
-
-    model.dataset = model.dataset.drop({"O_PEOPLE", "D_PEOPLE"}, axis=1) \
-      .merge(custom_snpp[["GEOGRAPHY_CODE", "PEOPLE"]].rename({"PEOPLE": "O_PEOPLE"}, axis=1), left_on="O_GEOGRAPHY_CODE", right_on="GEOGRAPHY_CODE") \
-      .merge(custom_snpp[["GEOGRAPHY_CODE", "PEOPLE"]].rename({"PEOPLE": "D_PEOPLE"}, axis=1), left_on="D_GEOGRAPHY_CODE", right_on="GEOGRAPHY_CODE") \
-      .drop({"GEOGRAPHY_CODE_x", "GEOGRAPHY_CODE_y"}, axis=1)
-
-    # TODO IDEA: merge emitters/attractors back on to custom_snpp for output/comparison as calculated
-
-    input_data.append_output(custom_snpp, year)
-
-    # now update baselines for following year, unless we are in the final year
-    if year < end_year:
-      # persist data from model but take relative SNPP change
-      baseline_snpp_prev = input_data.get_people(year, geogs).rename({"PEOPLE": "PEOPLE_PREV"},axis=1)
-      baseline_snpp = input_data.get_people(year+1, geogs)
-      baseline_snpp = baseline_snpp.merge(baseline_snpp_prev, on="GEOGRAPHY_CODE")
-      # relative delta
-      baseline_snpp["PEOPLE_DELTA"] = baseline_snpp["PEOPLE"] / baseline_snpp["PEOPLE_PREV"]
-      model.dataset = _merge_factor(model.dataset, baseline_snpp[["GEOGRAPHY_CODE", "PEOPLE_DELTA"]], ["PEOPLE_DELTA"])
-      model.dataset = _apply_delta(model.dataset, "PEOPLE", relative=True)
-
-      # absolute deltas
-      snhp = _get_delta(input_data.get_households, "HOUSEHOLDS", year+1, geogs)
-      model.dataset = _merge_factor(model.dataset, snhp, ["HOUSEHOLDS_DELTA"])
-      model.dataset = _apply_delta(model.dataset, "HOUSEHOLDS")
-
-      jobs = _get_delta(input_data.get_jobs, "JOBS", year+1, geogs)
-      model.dataset = _merge_factor(model.dataset, jobs, ["JOBS_DELTA"])
-      model.dataset = _apply_delta(model.dataset, "JOBS")
-
-      gva = _get_delta(input_data.get_gva, "GVA", year+1, geogs)
-      model.dataset = _merge_factor(model.dataset, gva, ["GVA_DELTA"])
-      model.dataset = _apply_delta(model.dataset, "GVA")
-
-      # derived factors
-      model.dataset = _compute_derived_factors(model.dataset)
-
-  input_data.summarise_output(scenario_data)
+      raise ValueError("invalid engine %s (must be one of dense, pandas)" % engine)
+
+  with input_data.profiler.span("output.summarise"):
+    input_data.summarise_output(scenario_data)
 
   if "odmatrix" in params and params["odmatrix"] is True:
     input_data.write_odmatrix(model.dataset[["O_GEOGRAPHY_CODE","D_GEOGRAPHY_CODE","O_PEOPLE","D_PEOPLE","MIGRATIONS","CHANGED_MIGRATIONS"]])
 
   return model, input_data, delta
+
+def simim(params):
+  params = _normalise_params(params)
+  return run_scenario(params, prepare(params))
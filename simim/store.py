@@ -0,0 +1,63 @@
+"""
+store.py
+File layout shared by the matrix and geography stores: magic, JSON header and page-aligned arrays
+"""
+
+import os
+import json
+from contextlib import contextmanager
+import numpy as np
+
+from simim.utils import md5file
+
+# payload offsets are aligned to the page size
+ALIGNMENT = 4096
+
+def align(offset, alignment=ALIGNMENT):
+  return -(-offset // alignment) * alignment
+
+def is_store_file(filename, magic):
+  """ Whether the file starts with the given magic string """
+  with open(filename, "rb") as fd:
+    return fd.read(len(magic)) == magic
+
+@contextmanager
+def create(filename, magic, header, payload_size):
+  """ Writes the magic string and header, yielding the (temporary) file to write the payload to and the payload offset """
+  header = json.dumps(header).encode("utf-8")
+  offset = align(len(magic) + 8 + len(header))
+  tmpfile = filename + ".tmp"
+  with open(tmpfile, "wb") as fd:
+    fd.write(magic)
+    fd.write(np.uint64(len(header)).tobytes())
+    fd.write(header)
+    fd.truncate(offset + payload_size)
+  yield tmpfile, offset
+  os.replace(tmpfile, filename)
+
+def read_header(filename, magic, version, kind):
+  """ Reads and checks the header of a store file, returning it and the payload offset """
+  with open(filename, "rb") as fd:
+    if fd.read(len(magic)) != magic:
+      raise ValueError("%s is not a %s file" % (filename, kind))
+    header_size = int(np.frombuffer(fd.read(8), dtype=np.uint64)[0])
+    header = json.loads(fd.read(header_size).decode("utf-8"))
+  if header["version"] != version:
+    raise ValueError("%s: unsupported %s version %s" % (filename, kind, header["version"]))
+  return header, align(len(magic) + 8 + header_size)
+
+def map_array(filename, dtype, shape, offset):
+  """ Memory-maps an array of the payload read-only (numpy can't map empty arrays) """
+  if np.prod(shape):
+    return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=tuple(shape))
+  return np.zeros(shape, dtype=dtype)
+
+def open_cached(source, magic, open_func, cache_dir, prefix, extension, convert_func):
+  """ Opens source if it is a store file, otherwise its conversion (cached in cache_dir by a hash of source) """
+  if is_store_file(source, magic):
+    return open_func(source)
+  filename = os.path.join(cache_dir, "%s_%s%s" % (prefix, md5file(source), extension))
+  if not os.path.isfile(filename):
+    print("converting %s to %s" % (source, filename))
+    convert_func(source, filename)
+  return open_func(filename)
@@ -8,11 +8,48 @@ import json
 from scipy.stats.stats import pearsonr
 from scipy.spatial.distance import squareform, pdist
 
+from simim.blocked import save_blocked
+
 def md5hash(string):
   m = hashlib.md5()
   m.update(string.encode('utf-8'))
   return m.hexdigest()
 
+def md5file(filename):
+  """ md5 hash of a file's contents """
+  m = hashlib.md5()
+  with open(filename, "rb") as fd:
+    for chunk in iter(lambda: fd.read(1 << 20), b""):
+      m.update(chunk)
+  return m.hexdigest()
+
+def save_dataframe(data, filename):
+  """ Saves a dataframe as an uncompressed .npz archive, with string columns as categories plus codes """
+  arrays = { "__columns__": np.array(data.columns.values, dtype=str) }
+  for i, col in enumerate(data.columns.values):
+    values = data[col].values
+    if values.dtype.kind in "biuf":
+      arrays["v%d" % i] = values
+    else:
+      categories, codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+      arrays["c%d" % i] = categories
+      arrays["v%d" % i] = codes.astype(np.int32)
+  # write to a temporary file first so an interrupted run doesn't leave a corrupt cache
+  tmpfile = filename + ".tmp.npz"
+  np.savez(tmpfile, **arrays)
+  os.replace(tmpfile, filename)
+
+def load_dataframe(filename):
+  """ Loads a dataframe saved by save_dataframe """
+  with np.load(filename) as arrays:
+    data = {}
+    for i, col in enumerate(arrays["__columns__"]):
+      if "c%d" % i in arrays:
+        data[col] = arrays["c%d" % i][arrays["v%d" % i]].astype(object)
+      else:
+        data[col] = arrays["v%d" % i]
+  return pd.DataFrame(data)
+
 def get_named_values(dataset, colnames, prefix=""):
   """ Returns a list of Series from dataset, optionally prefixed when modified original values are needed"""
   if not isinstance(colnames, list):
@@ -38,20 +75,25 @@ def calc_distances(gdf):
   dists.DISTANCE = dists.DISTANCE / 1000.0
   return dists
 
+def distance_block(easting, northing, start, stop):
+  """ Rows start:stop of the matrix of distances (in km) between points with the given eastings and northings (in m) """
+  return np.hypot(easting[start:stop, np.newaxis] - easting, northing[start:stop, np.newaxis] - northing) / 1000.0
+
+def calc_distance_matrix(easting, northing, filename, block_size=1024):
+  """ Writes the distances (in km) between points (in m) to a .npy file block by block """
+  easting = np.asarray(easting, dtype=float)
+  northing = np.asarray(northing, dtype=float)
+  save_blocked(filename, len(easting), lambda start, stop: distance_block(easting, northing, start, stop), block_size)
+
 def access_weighted_sum(dataset, colname, access_colname):
   # (travel) access-weighted sum of factor at destination
   # access-to-x[d] = Sum over o { access[o,d] * x[o] }
   new_colname = "D_{}_{}".format(colname, access_colname)
 
-  # access to x[o] for each o,d
-  dataset[new_colname] = dataset["O_" + colname] * dataset[access_colname]
-  # sum over o - grouping by d
-  wsum = dataset[["D_GEOGRAPHY_CODE", new_colname]].groupby("D_GEOGRAPHY_CODE").sum().reset_index()
-
-  # merge back
-  dataset = dataset.merge(wsum, on="D_GEOGRAPHY_CODE") \
-    .drop(new_colname + "_x", axis=1) \
-    .rename({new_colname + "_y": new_colname}, axis=1)
+  # sum of access to x[o] over o for each d, then broadcast back to the OD pairs (no grouping or merging)
+  d_index, _ = pd.factorize(dataset["D_GEOGRAPHY_CODE"])
+  wsum = np.bincount(d_index, weights=dataset["O_" + colname].values * dataset[access_colname].values)
+  dataset[new_colname] = wsum[d_index]
 
   return dataset
 
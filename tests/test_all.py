@@ -3,12 +3,28 @@
 # Disable "Line too long"
 # pylint: disable=C0301
 
+import os
+import json
+import tempfile
+import threading
+import tracemalloc
 import numpy as np
 import pandas as pd
 from unittest import TestCase
 
-from simim.utils import r2, rmse
+from simim.utils import r2, rmse, save_dataframe, load_dataframe, calc_distance_matrix
+import simim.simim as simim
 import simim.models as models
+import simim.batch as batch
+import simim.blocked as blocked
+import simim.matrix_store as matrix_store
+import simim.geography as geography
+import simim.profiling as profiling
+import simim.benchmark as benchmark
+import simim.prefetch as prefetch
+from simim.dense import ZoneIndex, DenseDataset, AccessibilityOperator
+from simim.data_apis import Panel, Instance, EconomicBaseline, LRUCache, memoised
+from simim.scenario import Scenario
 
 # test methods only run if prefixed with "test"
 class Test(TestCase):
@@ -148,5 +164,789 @@ class Test(TestCase):
       Test.dataset.loc[Test.dataset.D_GEOGRAPHY_CODE == "E07000178", "P_CHANGED"] = Test.dataset.loc[Test.dataset.D_GEOGRAPHY_CODE == "E07000178", "HOUSEHOLDS"] + 300000 
       self.assertTrue(rmse(attraction(xo=Test.dataset.P_CHANGED.values), attraction.impl.yhat) > 1.0)
 
+  def test_dense(self):
+    dataset = Test.dataset.rename({"PEOPLE": "O_PEOPLE", "HOUSEHOLDS": "D_HOUSEHOLDS"}, axis=1)
+    dense = DenseDataset.from_dataframe(dataset, ["PEOPLE", "HOUSEHOLDS"], ["MIGRATIONS", "DISTANCE"])
+    self.assertEqual(len(dense.zones), 378)
+    self.assertEqual(dense["MIGRATIONS"].shape, (378, 378))
+    self.assertEqual(dense["O_PEOPLE"].shape, (378,))
+    # round trip to the long format
+    self.assertTrue(np.array_equal(dense.expand("O_PEOPLE"), dataset.O_PEOPLE.values))
+    self.assertTrue(np.array_equal(dense.expand("D_HOUSEHOLDS"), dataset.D_HOUSEHOLDS.values))
+    self.assertTrue(np.array_equal(dense.expand("MIGRATIONS"), dataset.MIGRATIONS.values))
+    self.assertTrue(np.array_equal(dense.expand("O_GEOGRAPHY_CODE"), dataset.O_GEOGRAPHY_CODE.values))
+    # origin and destination values of a zonal factor are the same vector
+    self.assertTrue(np.array_equal(dense.expand("D_PEOPLE"), dense["PEOPLE"][dense.d_index]))
+    o = dense.zones.index("E07000178")
+    self.assertEqual(dense["MIGRATIONS"][o, o],
+      dataset[(dataset.O_GEOGRAPHY_CODE == "E07000178") & (dataset.D_GEOGRAPHY_CODE == "E07000178")].MIGRATIONS.values[0])
+    # outflows are row sums, inflows column sums
+    self.assertTrue(np.allclose(dense["MIGRATIONS"].sum(axis=1), dataset.groupby("O_GEOGRAPHY_CODE").MIGRATIONS.sum().values))
+    self.assertTrue(np.allclose(dense["MIGRATIONS"].sum(axis=0), dataset.groupby("D_GEOGRAPHY_CODE").MIGRATIONS.sum().values))
+
+    zones = ZoneIndex(["b", "a", "c", "a"])
+    self.assertEqual(len(zones), 3)
+    self.assertTrue(np.array_equal(zones.index(["c", "a"]), [2, 0]))
+    self.assertTrue("b" in zones)
+    self.assertFalse("d" in zones)
+
+  def test_engines(self):
+    # the pandas and dense engines project the same population, over years with and without zonal and OD scenario changes
+    dataset, zonal = benchmark.load_dataset()
+    start_year, end_year = 2019, 2025
+    with tempfile.TemporaryDirectory() as tmpdir:
+      od_file = os.path.join(tmpdir, "od_scenario.csv")
+      pd.DataFrame({"O_GEOGRAPHY_CODE": ["E07000008", "E06000042", "E07000178", "E07000008"],
+                    "D_GEOGRAPHY_CODE": ["E06000042", "E07000008", "E07000008", "E07000178"],
+                    "YEAR": [2020, 2020, 2022, 2022],
+                    "DISTANCE": [30.0, 30.0, 40.0, 40.0], "ACCESSIBILITY": [1.5, 1.5, 1.2, 1.2]}).to_csv(od_file, index=False)
+      for model_type in ["gravity", "production"]:
+        emitters, attractors = benchmark.SPECS[model_type]
+        params = {"emitters": emitters, "attractors": attractors, "cost": "DISTANCE"}
+        people = {}
+        for engine in ["pandas", "dense"]:
+          model = models.Model(model_type, "pow", dataset.copy(), "MIGRATIONS", emitters, attractors, "DISTANCE")
+          scenario = Scenario("data/scenarios/test.csv", emitters + attractors, od_file)
+          input_data = benchmark.LocalData(zonal)
+          input_data.init_output(start_year, end_year, zonal.GEOGRAPHY_CODE.values)
+          if engine == "dense":
+            simim._project_dense(params, model, input_data, scenario, start_year, end_year, 0.08)
+          else:
+            movers = dataset[["MIGRATIONS", "O_GEOGRAPHY_CODE"]].groupby("O_GEOGRAPHY_CODE").sum()
+            movers = input_data.get_people(2011, zonal.GEOGRAPHY_CODE).set_index("GEOGRAPHY_CODE").join(movers)
+            movers["MIGRATION_RATE"] = movers["MIGRATIONS"] / movers["PEOPLE"]
+            simim._project(params, model, input_data, scenario, movers, zonal.GEOGRAPHY_CODE.values, start_year, end_year,
+                           input_data.get_people(start_year, zonal.GEOGRAPHY_CODE), 0.08)
+          people[engine] = input_data.output["PEOPLE"]
+        self.assertFalse(np.isnan(people["dense"]).any())
+        # the scenarios change the population
+        self.assertGreater(np.abs(people["dense"] - input_data.output["PEOPLE_SNPP"]).max(), 1.0)
+        self.assertTrue(np.allclose(people["pandas"], people["dense"]))
+
+  def test_factorised(self):
+    dataset = Test.dataset.rename({"PEOPLE": "O_PEOPLE", "HOUSEHOLDS": "D_HOUSEHOLDS"}, axis=1)
+    dense = DenseDataset.from_dataframe(dataset, ["PEOPLE", "HOUSEHOLDS"], ["MIGRATIONS"])
+    for model_type, xo, xd in [("gravity", "PEOPLE", "HOUSEHOLDS"), ("production", "O_GEOGRAPHY_CODE", "HOUSEHOLDS"), ("attraction", "PEOPLE", "D_GEOGRAPHY_CODE")]:
+      for model_subtype in ["pow", "exp"]:
+        model = models.Model(model_type, model_subtype, Test.dataset, "MIGRATIONS", xo, xd, "DISTANCE")
+        self.assertTrue(np.array_equal(model.zones(), dense.zones.codes))
+        flows = model.factorised(dense["PEOPLE"], dense["HOUSEHOLDS"])
+        # full matrix matches the fitted values
+        odmatrix = flows.matrix()
+        self.assertTrue(rmse(odmatrix[dense.o_index, dense.d_index], model.impl.yhat) < 1e-8)
+        # totals via matrix-vector products
+        self.assertTrue(np.allclose(flows.outflows(), odmatrix.sum(axis=1)))
+        self.assertTrue(np.allclose(flows.inflows(), odmatrix.sum(axis=0)))
+        self.assertTrue(np.allclose(flows.net(), odmatrix.sum(axis=0) - odmatrix.sum(axis=1)))
+
+    model = models.Model("gravity", "pow", Test.dataset, "MIGRATIONS", "PEOPLE", "HOUSEHOLDS", "DISTANCE")
+    pre = model.factorised(dense["PEOPLE"], dense["HOUSEHOLDS"])
+    households = dense["HOUSEHOLDS"].copy()
+    households[dense.zones.index("E07000178")] += 30000
+    post = model.factorised(dense["PEOPLE"], households)
+    changed = pre.changed_matrix(post, dense["MIGRATIONS"])
+    self.assertTrue(np.allclose(changed, dense["MIGRATIONS"] * (post.matrix() / pre.matrix() - 1.0)))
+    inflows, outflows = pre.changed_flows(post, dense["MIGRATIONS"])
+    self.assertTrue(np.allclose(inflows, changed.sum(axis=0)))
+    self.assertTrue(np.allclose(outflows, changed.sum(axis=1)))
+    # only inflows to the changed zone are affected
+    self.assertTrue(inflows[dense.zones.index("E07000178")] > 0.0)
+    self.assertTrue(np.allclose(np.delete(inflows, dense.zones.index("E07000178")), 0.0))
+    self.assertAlmostEqual(inflows.sum(), outflows.sum())
+
+  def test_design(self):
+    for model_subtype in ["pow", "exp"]:
+      gravity = models.Model("gravity", model_subtype, Test.dataset, "MIGRATIONS", "PEOPLE", ["HOUSEHOLDS", "JOBS"], "DISTANCE")
+      # one column per factor plus constant and cost
+      self.assertEqual(gravity.design.shape, (len(Test.dataset), 5))
+      self.assertTrue(rmse(gravity.evaluate(), gravity.impl.yhat) < 1e-10)
+      # update a single column in place
+      households = gravity.dataset.HOUSEHOLDS.values.copy()
+      households[gravity.dataset.D_GEOGRAPHY_CODE == "E07000178"] += 300000
+      gravity.update_design({"HOUSEHOLDS": households})
+      changed = gravity.evaluate()
+      self.assertTrue(rmse(changed, gravity.impl.yhat) > 1.0)
+      self.assertTrue(np.allclose(changed, gravity(gravity.dataset.PEOPLE.values, [households, gravity.dataset.JOBS.values])))
+      gravity.update_design({"HOUSEHOLDS": gravity.dataset.HOUSEHOLDS.values})
+      self.assertTrue(rmse(gravity.evaluate(), gravity.impl.yhat) < 1e-10)
+
+    production = models.Model("production", "pow", Test.dataset, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE")
+    self.assertEqual(production.design.shape, (len(Test.dataset), 3))
+    self.assertTrue(rmse(production.evaluate(), production.impl.yhat) < 1e-10)
+
+  def test_impact(self):
+    dataset = Test.dataset.rename({"PEOPLE": "O_PEOPLE", "HOUSEHOLDS": "D_HOUSEHOLDS", "JOBS": "D_JOBS"}, axis=1)
+    dense = DenseDataset.from_dataframe(dataset, ["PEOPLE", "HOUSEHOLDS", "JOBS"], ["MIGRATIONS", "DISTANCE"])
+    changed_zones = dense.zones.index(["E07000178", "E07000008", "E06000042"])
+    households = dense["HOUSEHOLDS"].copy()
+    households[changed_zones] += 10000
+    jobs = dense["JOBS"].copy()
+    jobs[changed_zones] += 5000
+    people = dense["PEOPLE"].copy()
+    people[changed_zones] += 20000
+    for model_type, xo in [("gravity", "PEOPLE"), ("production", "O_GEOGRAPHY_CODE")]:
+      for model_subtype in ["pow", "exp"]:
+        model = models.Model(model_type, model_subtype, Test.dataset, "MIGRATIONS", xo, ["HOUSEHOLDS", "JOBS"], "DISTANCE")
+        pre = model.factorised(dense["PEOPLE"], [dense["HOUSEHOLDS"], dense["JOBS"]])
+        post = model.factorised(people, [households, jobs])
+        impact = model.impact(dense["PEOPLE"], people, [dense["HOUSEHOLDS"], dense["JOBS"]], [households, jobs])
+        # only the changed zones have multipliers
+        self.assertEqual(np.count_nonzero(impact.destination != 1.0), 3)
+        self.assertTrue(np.allclose(impact.changed_matrix(dense["MIGRATIONS"]), pre.changed_matrix(post, dense["MIGRATIONS"])))
+        expected = pre.changed_flows(post, dense["MIGRATIONS"])
+        actual = impact.changed_flows(dense["MIGRATIONS"])
+        self.assertTrue(np.allclose(actual[0], expected[0]))
+        self.assertTrue(np.allclose(actual[1], expected[1]))
+
+        # change to the cost of some OD pairs
+        cost = dense["DISTANCE"].copy()
+        o, d = np.meshgrid(changed_zones, changed_zones, indexing="ij")
+        o, d = o.flatten(), d.flatten()
+        cost[o, d] *= 0.5
+        post = model.factorised(people, [households, jobs], cost)
+        impact = model.impact(dense["PEOPLE"], people, [dense["HOUSEHOLDS"], dense["JOBS"]], [households, jobs], (o, d, dense["DISTANCE"][o, d], cost[o, d]))
+        self.assertTrue(np.allclose(impact.changed_matrix(dense["MIGRATIONS"]), pre.changed_matrix(post, dense["MIGRATIONS"])))
+        expected = pre.changed_flows(post, dense["MIGRATIONS"])
+        actual = impact.changed_flows(dense["MIGRATIONS"])
+        self.assertTrue(np.allclose(actual[0], expected[0]))
+        self.assertTrue(np.allclose(actual[1], expected[1]))
+
+  def test_panel(self):
+    panel = Panel(range(2015, 2021), ["E07000008", "E07000178"])
+    panel["PEOPLE"] = np.array([[100.0, 200.0], [110.0, 190.0], [121.0, 180.0], [130.0, 170.0], [140.0, 160.0], [150.0, 150.0]])
+    self.assertTrue("PEOPLE" in panel)
+    self.assertTrue(np.array_equal(panel.get("PEOPLE", 2017), [121.0, 180.0]))
+    self.assertTrue(np.array_equal(panel.delta("PEOPLE", 2016), [10.0, -10.0]))
+    self.assertTrue(np.allclose(panel.ratio("PEOPLE", 2017), [1.1, 180.0 / 190.0]))
+    self.assertRaises(ValueError, panel.get, "PEOPLE", 2021)
+    self.assertRaises(ValueError, panel.delta, "PEOPLE", 2015)
+
+  def test_households_projection(self):
+    class SNHP():
+      def __init__(self):
+        self.calls = 0
+      def min_year(self, country):
+        return 2014 if country == "en" else 2016
+      def max_year(self, country):
+        return 2039 if country == "en" else 2041
+      def aggregate(self, geogs, years):
+        self.calls += 1
+        return pd.DataFrame({"GEOGRAPHY_CODE": np.repeat(geogs, len(years)), "PROJECTED_YEAR_NAME": np.tile(years, len(geogs)),
+                             "OBS_VALUE": np.tile(np.array(years) * 10.0, len(geogs)) + np.repeat(np.arange(len(geogs)) * 1000.0, len(years))})
+    # avoid initialising the data sources
+    source = Instance.__new__(Instance)
+    source.data_cache = LRUCache(1 << 20)
+    source.snhp = SNHP()
+    geogs = ["W06000001", "E07000008", "E07000178"]
+    households = source.get_households_projection(range(2010, 2046), geogs)
+    self.assertEqual(source.snhp.calls, 2)
+    self.assertEqual(households.shape, (36, 3))
+    # linear in the data range and extrapolated linearly outside it
+    self.assertTrue(np.allclose(households[:, 1], np.arange(2010, 2046) * 10.0))
+    self.assertTrue(np.allclose(households[:, 2], np.arange(2010, 2046) * 10.0 + 1000.0))
+    self.assertTrue(np.allclose(households[:, 0], np.arange(2010, 2046) * 10.0))
+    # any year, for the same geographies in any order, is served from the cache
+    households = source.get_households(2050, ["E07000178", "W06000001", "E07000008"])
+    self.assertEqual(source.snhp.calls, 2)
+    self.assertEqual(list(households.GEOGRAPHY_CODE), ["E07000178", "W06000001", "E07000008"])
+    self.assertTrue(np.allclose(households.HOUSEHOLDS, [21500.0, 20500.0, 20500.0]))
+    # geographies not in any country's projection
+    self.assertRaises(ValueError, source.get_households_projection, [2020], geogs + ["X00000001"])
+
+  def test_economic_baseline(self):
+    years = np.arange(2015, 2021)
+    geogs = ["E07000178", "E07000008"]
+    data = pd.DataFrame({"YEAR": np.repeat(years, 2), "GEOGRAPHY_CODE": np.tile(geogs, len(years)),
+                         "JOBS": np.repeat(years - 2000, 2) * np.tile([1.0, 2.0], len(years)), "GVA": np.repeat(years * 1.0, 2)})
+    # avoid initialising the data sources
+    source = Instance.__new__(Instance)
+    source.economic_baseline = EconomicBaseline(data.sample(frac=1.0, random_state=0), held={"GVA": 2018})
+    self.assertTrue(np.array_equal(source.economic_baseline.zones.codes, sorted(geogs)))
+    self.assertTrue(np.array_equal(source.economic_baseline.values("JOBS", [2016, 2017], geogs), [[16.0, 32.0], [17.0, 34.0]]))
+    self.assertTrue(np.array_equal(source.economic_baseline.deltas("JOBS", years[1:], geogs), np.outer(np.ones(5), [1.0, 2.0])))
+    # held beyond 2018
+    self.assertTrue(np.array_equal(source.economic_baseline.deltas("GVA", [2018, 2019, 2020], ["E07000008"]).ravel(), [1.0, 0.0, 0.0]))
+    self.assertTrue(np.array_equal(source.economic_baseline.values("GVA", [2020, 2025], ["E07000008"]).ravel(), [2018.0, 2018.0]))
+    self.assertRaises(ValueError, source.economic_baseline.values, "JOBS", [2021], geogs)
+    self.assertRaises(ValueError, source.economic_baseline.deltas, "JOBS", [2015], geogs)
+    self.assertRaises(ValueError, source.economic_baseline.values, "JOBS", [2016], ["E09000001"])
+    # as the original table, unknown geographies are omitted
+    jobs = source.get_jobs(2017, ["E07000008", "E09000001", "E07000178"])
+    self.assertEqual(list(jobs.GEOGRAPHY_CODE), ["E07000008", "E07000178"])
+    self.assertTrue(np.array_equal(jobs.JOBS, [34.0, 17.0]))
+    delta = source.get_economic_delta("JOBS", 2017, geogs)
+    self.assertEqual(list(delta.columns), ["GEOGRAPHY_CODE", "JOBS_DELTA"])
+    self.assertTrue(np.array_equal(delta.JOBS_DELTA, [1.0, 2.0]))
+
+  def test_output(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      # avoid initialising the data sources
+      output = Instance.__new__(Instance)
+      output.configure_output({ "output_dir": tmpdir, "model_type": "gravity", "base_projection": "ppp", "scenario": "test.csv", "attractors": ["D_HOUSEHOLDS"] })
+      output.init_output(2015, 2020, ["E07000008", "E07000178"])
+      for year in range(2015, 2018):
+        # zones in any order
+        output.append_output(pd.DataFrame({"GEOGRAPHY_CODE": ["E07000178", "E07000008"], "PEOPLE_SNPP": [100.0, 200.0], "PEOPLE": [100.0 + year - 2015, 200.0]}), year)
+      self.assertTrue(np.array_equal(output.output.get("NET_DELTA", 2017), [0.0, 2.0]))
+      result = output.custom_snpp_variant
+      self.assertEqual(list(result.columns.values), ["GEOGRAPHY_CODE", "PEOPLE_SNPP", "PEOPLE", "PROJECTED_YEAR_NAME"])
+      self.assertEqual(list(result.PROJECTED_YEAR_NAME.unique()), [2015, 2016, 2017])
+      self.assertEqual(result[(result.GEOGRAPHY_CODE == "E07000178") & (result.PROJECTED_YEAR_NAME == 2016)].PEOPLE.values[0], 101.0)
+      output.write_output()
+      written = pd.read_csv(output.summary_output_file)
+      self.assertEqual(len(written), 6)
+      self.assertTrue(np.allclose(written.RELATIVE_DELTA, written.PEOPLE / written.PEOPLE_SNPP))
+      self.assertRaises(ValueError, output.append_output, pd.DataFrame({"GEOGRAPHY_CODE": ["E09000001"], "PEOPLE_SNPP": [1.0], "PEOPLE": [1.0]}), 2018)
+
+  def test_scenario(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      filename = os.path.join(tmpdir, "scenario.csv")
+      pd.DataFrame({"GEOGRAPHY_CODE": ["E07000178", "E07000178", "E07000008", "E07000008", "X00000000"],
+                    "YEAR": [2020, 2020, 2020, 2021, 2020],
+                    "HOUSEHOLDS": [10.0, 5.0, 20.0, 30.0, 1.0]}).to_csv(filename, index=False)
+      od_filename = os.path.join(tmpdir, "od_scenario.csv")
+      pd.DataFrame({"O_GEOGRAPHY_CODE": ["E07000178", "E07000008"], "D_GEOGRAPHY_CODE": ["E07000008", "E07000178"],
+                    "YEAR": [2020, 2020], "DISTANCE": [50.0, 50.0]}).to_csv(od_filename, index=False)
+      scenario = Scenario(filename, "HOUSEHOLDS", od_filename)
+    self.assertEqual(scenario.timeline(), [2020, 2021])
+
+    dataset = Test.dataset.rename({"HOUSEHOLDS": "D_HOUSEHOLDS"}, axis=1)
+    dense = DenseDataset.from_dataframe(dataset, ["HOUSEHOLDS"], ["DISTANCE"])
+    dataset["O_HOUSEHOLDS"] = dense.expand("O_HOUSEHOLDS")
+    households = dense["HOUSEHOLDS"].copy()
+    distance = dense["DISTANCE"].copy()
+    scenario.apply_dense(dense, 2020)
+    changed = dense.zones.index(["E07000008", "E07000178"])
+    # repeated zones are summed, unknown zones ignored
+    self.assertTrue(np.array_equal(scenario.zone_deltas[2020][0], np.sort(changed)))
+    self.assertTrue(np.array_equal(dense["HOUSEHOLDS"][changed] - households[changed], [20.0, 15.0]))
+    self.assertEqual(np.count_nonzero(dense["HOUSEHOLDS"] - households), 2)
+    scenario.apply_dense(dense, 2019)
+    self.assertEqual(np.count_nonzero(dense["HOUSEHOLDS"] - households), 2)
+    # only the listed OD pairs are changed
+    o, d = scenario.od_cells(2020)
+    self.assertTrue(np.array_equal(dense["DISTANCE"][o, d], [50.0, 50.0]))
+    self.assertEqual(np.count_nonzero(dense["DISTANCE"] - distance), 2)
+
+    # long-format dataset gets the same changes at origin and destination
+    dataset = scenario.apply(dataset, 2020)
+    self.assertTrue(np.array_equal(dataset.O_HOUSEHOLDS.values, dense.expand("O_HOUSEHOLDS")))
+    self.assertTrue(np.array_equal(dataset.D_HOUSEHOLDS.values, dense.expand("D_HOUSEHOLDS")))
+    self.assertTrue(np.array_equal(dataset.DISTANCE.values, dense.expand("DISTANCE")))
+    # the affected rows are indexed once, and re-indexed if the rows change
+    rows = scenario.rows
+    again = scenario.apply(dataset.copy(), 2020)
+    self.assertIs(scenario.rows, rows)
+    shuffled = scenario.apply(dataset.sample(frac=1.0, random_state=1), 2020)
+    self.assertIsNot(scenario.rows, rows)
+    self.assertTrue(np.array_equal(shuffled.loc[again.index].O_HOUSEHOLDS.values, again.O_HOUSEHOLDS.values))
+
+  def test_accessibility(self):
+    dataset = Test.dataset.rename({"PEOPLE": "O_PEOPLE", "JOBS": "D_JOBS"}, axis=1)
+    dense = DenseDataset.from_dataframe(dataset, ["PEOPLE", "JOBS"], ["DISTANCE"])
+    access_matrix = np.exp(-dense["DISTANCE"] / 50.0)
+    access = AccessibilityOperator(access_matrix)
+    expected = np.array([np.sum(access_matrix[:, d] * dense["JOBS"]) for d in range(len(dense.zones))])
+    self.assertTrue(np.allclose(access(dense["JOBS"]), expected))
+    # several factors at once
+    both = access(np.column_stack([dense["JOBS"], dense["PEOPLE"]]))
+    self.assertTrue(np.allclose(both[:, 0], expected))
+    self.assertTrue(np.allclose(both[:, 1], dense["PEOPLE"] @ access_matrix))
+
+    # sparse, thresholded
+    sparse = AccessibilityOperator(access_matrix, threshold=0.01)
+    self.assertTrue(np.allclose(sparse(dense["JOBS"]), dense["JOBS"] @ np.where(access_matrix >= 0.01, access_matrix, 0.0)))
+
+    # incremental update of a few cells
+    o = dense.zones.index(["E07000178", "E07000008", "E06000042"])
+    d = dense.zones.index(["E07000008", "E06000042", "E07000178"])
+    sums = access(dense["JOBS"])
+    sparse_sums = sparse(dense["JOBS"])
+    access.update(o, d, [0.9, 0.8, 0.7], dense["JOBS"], sums)
+    sparse.update(o, d, [0.9, 0.8, 0.005], dense["JOBS"], sparse_sums)
+    access_matrix[o, d] = [0.9, 0.8, 0.7]
+    self.assertTrue(np.allclose(sums, dense["JOBS"] @ access_matrix))
+    self.assertTrue(np.allclose(access(dense["JOBS"]), sums))
+    access_matrix[o[2], d[2]] = 0.0
+    self.assertTrue(np.allclose(sparse_sums, dense["JOBS"] @ np.where(access_matrix >= 0.01, access_matrix, 0.0)))
+    self.assertTrue(np.allclose(sparse(dense["JOBS"]), sparse_sums))
+    # and of the sums for a few changed zones
+    jobs = dense["JOBS"].copy()
+    jobs[o] += 1000.0
+    sums += access.partial(o, jobs - dense["JOBS"])
+    sparse_sums += sparse.partial(o, jobs - dense["JOBS"])
+    self.assertTrue(np.allclose(sums, access(jobs)))
+    self.assertTrue(np.allclose(sparse_sums, sparse(jobs)))
+
+  def test_dataframe_cache(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      filename = os.path.join(tmpdir, "od.npz")
+      save_dataframe(self.dataset, filename)
+      data = load_dataframe(filename)
+    self.assertEqual(list(data.columns.values), list(self.dataset.columns.values))
+    for col in data.columns.values:
+      self.assertTrue(np.array_equal(data[col].values, self.dataset[col].values))
+
+  def test_model_store(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fitted = models.Model("production", "pow", Test.dataset, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE", store_dir=tmpdir)
+      self.assertTrue(os.path.isfile(os.path.join(tmpdir, "model_%s.npz" % fitted.fit_key())))
+      stored = models.Model("production", "pow", Test.dataset, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE", store_dir=tmpdir)
+      self.assertTrue(isinstance(stored.impl, models.StoredFit))
+      self.assertTrue(np.array_equal(stored.impl.params, fitted.impl.params))
+      self.assertTrue(np.array_equal(stored.impl.yhat, fitted.impl.yhat))
+      self.assertEqual(stored.impl.SRMSE, fitted.impl.SRMSE)
+      self.assertTrue(np.array_equal(stored.mu(), fitted.mu()))
+      self.assertTrue(rmse(stored.evaluate(), fitted.impl.yhat) < 1e-10)
+      # different data => different key
+      dataset = Test.dataset.copy()
+      dataset.HOUSEHOLDS *= 1.01
+      other = models.Model("production", "pow", dataset, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE", store_dir=tmpdir)
+      self.assertNotEqual(other.fit_key(), fitted.fit_key())
+      self.assertFalse(isinstance(other.impl, models.StoredFit))
+
+  def test_irls(self):
+    for model_type, xo_cols, xd_cols in [("gravity", "PEOPLE", ["HOUSEHOLDS", "JOBS"]),
+                                         ("production", "O_GEOGRAPHY_CODE", "HOUSEHOLDS"),
+                                         ("attraction", "PEOPLE", "D_GEOGRAPHY_CODE")]:
+      spint_fit = models.Model(model_type, "pow", Test.dataset, "MIGRATIONS", xo_cols, xd_cols, "DISTANCE")
+      irls_fit = models.Model(model_type, "pow", Test.dataset, "MIGRATIONS", xo_cols, xd_cols, "DISTANCE", fitter="irls")
+      # elasticities (the fixed effects are less well converged by spint)
+      self.assertTrue(np.allclose(irls_fit.impl.params[-2:], spint_fit.impl.params[-2:], atol=1e-4))
+      self.assertTrue(np.allclose(irls_fit.impl.params, spint_fit.impl.params, atol=1e-2))
+      self.assertTrue(np.allclose(irls_fit.impl.std_err[-2:], spint_fit.impl.std_err[-2:], rtol=1e-3))
+      self.assertAlmostEqual(irls_fit.impl.SRMSE, spint_fit.impl.SRMSE, 4)
+      self.assertAlmostEqual(irls_fit.impl.D2, spint_fit.impl.D2, 5)
+      # spint converges to a looser tolerance
+      self.assertTrue(irls_fit.impl.deviance <= models._poisson_deviance(Test.dataset.MIGRATIONS.values, spint_fit.impl.yhat) * (1 + 1e-12))
+      self.assertTrue(rmse(irls_fit.evaluate(), irls_fit.impl.yhat) < 1e-6)
+    self.assertNotEqual(irls_fit.fit_key(), spint_fit.fit_key())
+
+    # warm start on perturbed data
+    dataset = Test.dataset.copy()
+    dataset.HOUSEHOLDS *= np.linspace(0.99, 1.01, len(dataset))
+    cold = models.Model("production", "exp", dataset, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE", fitter="irls")
+    base = models.Model("production", "exp", Test.dataset, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE", fitter="irls")
+    warm = models.Model("production", "exp", dataset, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE", fitter="irls", init_params=base.impl.params)
+    self.assertTrue(warm.impl.iterations < cold.impl.iterations)
+    self.assertTrue(np.allclose(warm.impl.params, cold.impl.params, atol=1e-8))
+    self.assertTrue(cold.impl.converged)
+    # not converged within the iteration limit
+    X = np.column_stack([np.log(dataset.HOUSEHOLDS.values), dataset.DISTANCE.values])
+    groups = np.unique(dataset.O_GEOGRAPHY_CODE.values, return_inverse=True)[1]
+    self.assertFalse(models.fit_poisson(dataset.MIGRATIONS.values, X, groups, max_iter=1).converged)
+
+    self.assertRaises(ValueError, models.Model, "gravity", "pow", Test.dataset, "MIGRATIONS", "PEOPLE", "HOUSEHOLDS", "DISTANCE", fitter="newton")
+
+  def test_doubly(self):
+    dataset = Test.dataset.rename({"PEOPLE": "O_PEOPLE", "HOUSEHOLDS": "D_HOUSEHOLDS"}, axis=1)
+    dense = DenseDataset.from_dataframe(dataset, ["PEOPLE", "HOUSEHOLDS"], ["MIGRATIONS", "DISTANCE"])
+    observed = dense["MIGRATIONS"]
+    for model_subtype in ["exp", "pow"]:
+      model = models.Model("doubly", model_subtype, Test.dataset, "MIGRATIONS", "PEOPLE", "HOUSEHOLDS", "DISTANCE")
+      self.assertEqual(len(model.mu()), len(dense.zones) - 1)
+      self.assertEqual(len(model.alpha()), len(dense.zones) - 1)
+      # fitted flows preserve the observed origin and destination totals
+      fitted = np.zeros(observed.shape)
+      fitted[dense.o_index, dense.d_index] = model.impl.yhat
+      self.assertTrue(np.allclose(fitted.sum(axis=1), observed.sum(axis=1)))
+      self.assertTrue(np.allclose(fitted.sum(axis=0), observed.sum(axis=0)))
+      self.assertTrue(np.allclose(model.evaluate(), model.impl.yhat))
+      flows = model.factorised(dense["PEOPLE"], dense["HOUSEHOLDS"])
+      self.assertTrue(np.allclose(flows.matrix(), fitted))
+
+    # OD pairs not in the dataset have no flow
+    partial = Test.dataset[Test.dataset.O_GEOGRAPHY_CODE != Test.dataset.D_GEOGRAPHY_CODE]
+    absent = models.Model("doubly", "pow", partial, "MIGRATIONS", "PEOPLE", "HOUSEHOLDS", "DISTANCE")
+    self.assertTrue(np.allclose(absent.evaluate(), absent.impl.yhat))
+    self.assertTrue(np.allclose(absent.evaluate().sum(), partial.MIGRATIONS.sum()))
+
+    # beta (and its standard error) matches spint's (much slower) fit
+    self.assertAlmostEqual(model.beta(), -1.3293, 4)
+    self.assertAlmostEqual(model.impl.std_err[-1], 0.000976, 5)
+
+    # totals scale with the emitters and attractors, and are rebalanced
+    people = dense["PEOPLE"].copy()
+    people[dense.zones.index("E07000178")] *= 1.1
+    households = dense["HOUSEHOLDS"].copy()
+    households[dense.zones.index("E07000008")] *= 1.2
+    post = model.factorised(people, households)
+    self.assertTrue(np.allclose(post.outflows(), model.origin_totals * people / dense["PEOPLE"]))
+    self.assertAlmostEqual(post.inflows().sum(), post.outflows().sum())
+    # warm-started from the previous balancing
+    iterations = model.balancing_iterations
+    model.factorised(people, households)
+    self.assertEqual(model.balancing_iterations, iterations + 1)
+
+    # scenario impact, with a change in cost
+    changed_zones = dense.zones.index(["E07000178", "E07000008", "E06000042"])
+    o, d = [x.flatten() for x in np.meshgrid(changed_zones, changed_zones, indexing="ij")]
+    cost = dense["DISTANCE"].copy()
+    cost[o, d] *= 0.5
+    pre = model.factorised(dense["PEOPLE"], dense["HOUSEHOLDS"])
+    post = model.factorised(people, households, cost)
+    impact = model.impact(dense["PEOPLE"], people, dense["HOUSEHOLDS"], households, (o, d, dense["DISTANCE"][o, d], cost[o, d]))
+    # (to within the balancing tolerance)
+    self.assertTrue(np.allclose(impact.changed_matrix(observed), pre.changed_matrix(post, observed), atol=1e-4))
+    inflows, outflows = impact.changed_flows(observed)
+    self.assertAlmostEqual(inflows.sum(), outflows.sum(), 6)
+
+  def test_ensemble(self):
+    dataset = Test.dataset.rename({"PEOPLE": "O_PEOPLE", "HOUSEHOLDS": "D_HOUSEHOLDS", "JOBS": "D_JOBS"}, axis=1)
+    dense = DenseDataset.from_dataframe(dataset, ["PEOPLE", "HOUSEHOLDS", "JOBS"], ["MIGRATIONS", "DISTANCE"])
+    model = models.Model("gravity", "pow", Test.dataset, "MIGRATIONS", "PEOPLE", ["HOUSEHOLDS", "JOBS"], "DISTANCE")
+    draws = model.draw_params(1000, 1)
+    self.assertEqual(draws.shape, (1000, len(model.impl.params)))
+    self.assertTrue(np.array_equal(draws, model.draw_params(1000, 1)))
+    self.assertTrue(np.allclose(draws.mean(axis=0), model.impl.params, atol=4 * model.impl.std_err / np.sqrt(1000)))
+    self.assertEqual(model.alpha(draws).shape, (1000, 2))
+
+    # batched impact matches the impact of each draw
+    draws = draws[:5]
+    changed_zones = dense.zones.index(["E07000178", "E07000008"])
+    households = dense["HOUSEHOLDS"].copy()
+    households[changed_zones] += 10000
+    # population may differ between draws
+    people = np.tile(dense["PEOPLE"], (len(draws), 1))
+    people[:, changed_zones[0]] += np.arange(len(draws))
+    people_scenario = people.copy()
+    people_scenario[:, changed_zones] *= 1.01
+    o, d = changed_zones, changed_zones[::-1]
+    cost_cells = (o, d, dense["DISTANCE"][o, d], 0.5 * dense["DISTANCE"][o, d])
+    impact = model.impact(people, people_scenario, [dense["HOUSEHOLDS"], dense["JOBS"]], [households, dense["JOBS"]], cost_cells, draws)
+    self.assertEqual(impact.origin.shape, (len(draws), len(dense.zones)))
+    inflows, outflows = impact.changed_flows(dense["MIGRATIONS"])
+    for i in range(len(draws)):
+      single = model.impact(people[i], people_scenario[i], [dense["HOUSEHOLDS"], dense["JOBS"]], [households, dense["JOBS"]], cost_cells, draws[i])
+      expected = single.changed_flows(dense["MIGRATIONS"])
+      self.assertTrue(np.allclose(inflows[i], expected[0]))
+      self.assertTrue(np.allclose(outflows[i], expected[1]))
+      self.assertTrue(np.allclose(impact.draw(i).changed_matrix(dense["MIGRATIONS"]), single.changed_matrix(dense["MIGRATIONS"])))
+
+    # quantile output
+    with tempfile.TemporaryDirectory() as tmpdir:
+      output = Instance.__new__(Instance)
+      output.configure_output({ "output_dir": tmpdir, "model_type": "gravity", "base_projection": "ppp", "scenario": "test.csv", "attractors": ["D_HOUSEHOLDS"] })
+      output.init_output(2015, 2016, ["E07000008", "E07000178"], [0.1, 0.5, 0.9])
+      self.assertEqual(output.ensemble_names(), ["PEOPLE_P10", "PEOPLE_P50", "PEOPLE_P90"])
+      for year in [2015, 2016]:
+        output.append_output(pd.DataFrame({"GEOGRAPHY_CODE": ["E07000008", "E07000178"], "PEOPLE_SNPP": [100.0, 200.0], "PEOPLE": [100.0, 200.0]}), year)
+        output.append_ensemble_output(np.column_stack([np.arange(101.0), 200.0 + np.arange(101.0)]), year)
+      self.assertTrue(np.allclose(output.output.get("PEOPLE_P10", 2016), [10.0, 210.0]))
+      self.assertTrue(np.allclose(output.output.get("PEOPLE_P50", 2016), [50.0, 250.0]))
+      output.write_output()
+      written = pd.read_csv(output.summary_output_file.replace("simim_", "ensemble_"))
+      self.assertEqual(list(written.columns.values), ["GEOGRAPHY_CODE", "PEOPLE", "PEOPLE_P10", "PEOPLE_P50", "PEOPLE_P90", "PROJECTED_YEAR_NAME"])
+      self.assertEqual(len(written), 4)
+
+  def test_blocked(self):
+    dataset = Test.dataset.rename({"PEOPLE": "O_PEOPLE", "HOUSEHOLDS": "D_HOUSEHOLDS"}, axis=1)
+    dense = DenseDataset.from_dataframe(dataset, ["PEOPLE", "HOUSEHOLDS"], ["MIGRATIONS", "DISTANCE"])
+    observed = dense["MIGRATIONS"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+      filename = os.path.join(tmpdir, "migrations.npy")
+      # blocks that don't divide N
+      blocked.save_blocked(filename, len(observed), lambda start, stop: observed[start:stop], block_size=50)
+      matrix = blocked.BlockedMatrix(filename, block_size=37, threads=4)
+      self.assertEqual(len(matrix.blocks()), int(np.ceil(len(observed) / 37)))
+      self.assertTrue(np.allclose(matrix.sum(axis=0), observed.sum(axis=0)))
+      self.assertTrue(np.allclose(matrix.sum(axis=1), observed.sum(axis=1)))
+      x = np.random.RandomState(0).uniform(size=(len(observed), 2))
+      self.assertTrue(np.allclose(matrix.matvec(x), observed @ x))
+      self.assertTrue(np.allclose(matrix.rmatvec(x[:, 0]), observed.T @ x[:, 0]))
+      zones = np.array([3, 100, 7])
+      self.assertTrue(np.array_equal(matrix[zones, :], observed[zones, :]))
+      self.assertTrue(np.array_equal(matrix[:, zones], observed[:, zones]))
+      self.assertTrue(np.array_equal(matrix[zones, zones[::-1]], observed[zones, zones[::-1]]))
+
+      # scenario impact with the observed matrix out of core
+      model = models.Model("gravity", "pow", Test.dataset, "MIGRATIONS", "PEOPLE", "HOUSEHOLDS", "DISTANCE")
+      households = dense["HOUSEHOLDS"].copy()
+      households[zones] += 10000
+      cost_cells = (zones, zones[::-1], dense["DISTANCE"][zones, zones[::-1]], dense["DISTANCE"][zones, zones[::-1]] * 0.5)
+      impact = model.impact(dense["PEOPLE"], dense["PEOPLE"], dense["HOUSEHOLDS"], households, cost_cells)
+      expected = impact.changed_flows(observed)
+      actual = impact.changed_flows(matrix)
+      self.assertTrue(np.allclose(actual[0], expected[0]))
+      self.assertTrue(np.allclose(actual[1], expected[1]))
+
+      # flow totals with the cost function applied block by block
+      filename = os.path.join(tmpdir, "distance.npy")
+      blocked.save_blocked(filename, len(observed), lambda start, stop: dense["DISTANCE"][start:stop])
+      flows = model.factorised(dense["PEOPLE"], dense["HOUSEHOLDS"])
+      inflows, outflows = blocked.flow_totals(flows.origin, flows.destination, blocked.BlockedMatrix(filename, 100), model.cost_matrix)
+      self.assertTrue(np.allclose(inflows, flows.inflows()))
+      self.assertTrue(np.allclose(outflows, flows.outflows()))
+
+      # accessibility out of core
+      access = AccessibilityOperator(matrix)
+      self.assertTrue(np.allclose(access(x), observed.T @ x))
+      self.assertRaises(NotImplementedError, access.update, zones, zones, np.zeros(3))
+
+      # distances computed block by block
+      filename = os.path.join(tmpdir, "distances.npy")
+      easting, northing = np.random.RandomState(1).uniform(0, 100000, size=(2, 30))
+      calc_distance_matrix(easting, northing, filename, block_size=7)
+      distances = np.load(filename)
+      self.assertTrue(np.allclose(distances, np.hypot(easting[:, np.newaxis] - easting, northing[:, np.newaxis] - northing) / 1000.0))
+      self.assertFalse(os.path.exists(filename + ".tmp.npy"))
+
+  def test_matrix_store(self):
+    data = Test.dataset[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "DISTANCE"]]
+    dense = DenseDataset.from_dataframe(Test.dataset, [], ["DISTANCE"])
+    with tempfile.TemporaryDirectory() as tmpdir:
+      # CSV converted once into the cache, then memory-mapped
+      csv_file = os.path.join(tmpdir, "distance.csv")
+      data.to_csv(csv_file, index=False)
+      matrix = matrix_store.open_cached(csv_file, "DISTANCE", tmpdir)
+      self.assertIsInstance(matrix.values, np.memmap)
+      self.assertTrue(np.array_equal(matrix.zones, dense.zones.codes))
+      self.assertTrue(np.allclose(matrix.reindex(dense.zones.codes), dense["DISTANCE"]))
+      self.assertTrue(np.allclose(matrix.cells(data.O_GEOGRAPHY_CODE, data.D_GEOGRAPHY_CODE), data.DISTANCE.values))
+      self.assertTrue(np.isnan(matrix.cells(["E06000001"], ["X"])[0]))
+      self.assertEqual(len(os.listdir(tmpdir)), 2)
+      self.assertTrue(np.array_equal(matrix_store.open_cached(csv_file, "DISTANCE", tmpdir).values, matrix.values))
+      # a store file is opened directly
+      cached = [f for f in os.listdir(tmpdir) if f.endswith(".mat")][0]
+      self.assertTrue(np.array_equal(matrix_store.open_cached(os.path.join(tmpdir, cached), "DISTANCE", tmpdir).values, matrix.values))
+
+      # reordered zones, single precision
+      filename = os.path.join(tmpdir, "reversed.mat")
+      codes = dense.zones.codes[::-1]
+      matrix_store.write_matrix(filename, codes, dense["DISTANCE"][::-1, ::-1], np.float32, block_size=50)
+      matrix = matrix_store.open_matrix(filename)
+      self.assertEqual(matrix.values.dtype, np.float32)
+      self.assertTrue(np.allclose(matrix.reindex(dense.zones.codes), dense["DISTANCE"]))
+      long = matrix.to_dataframe("DISTANCE").merge(data, on=["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE"])
+      self.assertTrue(np.allclose(long.DISTANCE_x, long.DISTANCE_y))
+      self.assertTrue(np.allclose(matrix.blocked(37).rmatvec(np.ones(len(matrix))), dense["DISTANCE"][::-1, ::-1].sum(axis=0)))
+      self.assertRaises(ValueError, matrix_store.write_matrix, filename, codes, dense["DISTANCE"], np.int32)
+
+      # distances between centroids, in shapefile order
+      filename = os.path.join(tmpdir, "centroids.mat")
+      rng = np.random.RandomState(1)
+      gdf = pd.DataFrame({"lad16cd": ["Z%02d" % i for i in range(30)][::-1], "bng_e": rng.uniform(0, 100000, 30), "bng_n": rng.uniform(0, 100000, 30)})
+      matrix_store.from_shapefile(gdf, filename, block_size=7)
+      matrix = matrix_store.open_matrix(filename)
+      self.assertTrue(np.array_equal(matrix.zones, gdf.lad16cd.values))
+      self.assertTrue(np.allclose(matrix.values, np.hypot(gdf.bng_e.values[:, np.newaxis] - gdf.bng_e.values, gdf.bng_n.values[:, np.newaxis] - gdf.bng_n.values) / 1000.0))
+
+  def test_geography(self):
+    lookup = pd.DataFrame({"OA": ["o1", "o2", "o3", "o4", "o5"], "LSOA": ["l2", "l1", "l2", "l3", "l3"],
+                           "MSOA": ["m1", "m1", "m1", "m2", "m2"], "LAD": ["a2", "a2", "a2", "a1", "a1"], "LAD_CM": ["c1", "c1", "c1", "c1", "c1"]})
+    with tempfile.TemporaryDirectory() as tmpdir:
+      filename = os.path.join(tmpdir, "test.geo")
+      geography.write_hierarchy(filename, lookup)
+      self.assertTrue(geography.is_hierarchy_file(filename))
+      geog = geography.open_hierarchy(filename)
+      self.assertEqual([geog.size(level) for level in geography.LEVELS], [5, 3, 2, 2, 1])
+      oas = geog.index("OA", lookup.OA)
+      self.assertTrue(np.array_equal(geog.codes("LSOA")[geog.parent("OA", oas)], lookup.LSOA))
+      self.assertTrue(np.array_equal(geog.codes("LAD")[geog.parent("OA", oas, "LAD")], lookup.LAD))
+      self.assertEqual(geog.index("LSOA", "l9"), -1)
+      self.assertEqual(sorted(geog.codes("OA")[geog.children("LSOA", geog.index("LSOA", "l2"))]), ["o1", "o3"])
+      self.assertEqual(sorted(geog.codes("LSOA")[geog.children("MSOA", geog.index("MSOA", "m1"))]), ["l1", "l2"])
+      self.assertRaises(ValueError, geog.children, "OA", 0)
+      self.assertRaises(ValueError, geog.parent, "LAD", [0], "MSOA")
+      self.assertRaises(ValueError, geog.size, "WARD")
+      values = np.arange(5.0)
+      totals = geog.aggregate("OA", "LAD", values)
+      self.assertTrue(np.allclose(geog.aggregation("OA", "LAD") @ values, totals))
+      self.assertEqual(totals[geog.index("LAD", "a2")], values[oas[lookup.LAD == "a2"]].sum())
+      self.assertRaises(ValueError, geography.write_hierarchy, filename, lookup.assign(LAD_CM=["c1", "c1", "c2", "c1", "c1"]))
+
+      # as the original lookup of census merged LADs from the OA-level table
+      source = Instance.__new__(Instance)
+      source.lad_lookup_file = "./data/gb_geog_lookup.csv.gz"
+      source.cache_dir = tmpdir
+      source._Instance__geography = None
+      expected = pd.read_csv(source.lad_lookup_file, usecols=["LAD_CM", "LAD"])[["LAD_CM", "LAD"]].drop_duplicates()
+      result = source.get_lad_lookup()
+      self.assertEqual(list(result.columns), ["LAD_CM", "LAD"])
+      self.assertEqual(len(result), len(expected))
+      self.assertEqual(len(result.merge(expected)), len(expected))
+
+  def test_profiler(self):
+    profiler = profiling.Profiler()
+    for year in [2020, 2021]:
+      with profiler.span("year", rows=10, year=year):
+        with profiler.span("year.evaluate") as span:
+          span["rows"] = 5
+    self.assertEqual([record["name"] for record in profiler.events], ["year.evaluate", "year", "year.evaluate", "year"])
+    self.assertEqual(profiler.events[0]["parent"], "year")
+    self.assertEqual(profiler.events[3]["year"], 2021)
+    summary = profiler.summary()
+    self.assertEqual(list(summary.keys()), ["year", "year.evaluate"])
+    self.assertEqual(summary["year"]["count"], 2)
+    self.assertEqual(summary["year"]["rows"], 20)
+    self.assertEqual(summary["year.evaluate"]["rows"], 10)
+    self.assertTrue(summary["year"]["seconds"] >= summary["year.evaluate"]["seconds"])
+
+    # methods timed by their object's profiler, if any
+    class Source():
+      @profiling.timed("fetch.data")
+      def get(self, n):
+        return pd.DataFrame({"x": range(n)})
+    source = Source()
+    self.assertEqual(len(source.get(3)), 3)
+    source.profiler = profiler
+    source.get(4)
+    self.assertEqual(profiler.summary()["fetch.data"]["rows"], 4)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+      profiler.write(os.path.join(tmpdir, "profile.json"))
+      with open(os.path.join(tmpdir, "profile.json")) as fd:
+        self.assertEqual(json.load(fd)["spans"]["year"]["count"], 2)
+      with open(os.path.join(tmpdir, "profile.jsonl")) as fd:
+        self.assertEqual([json.loads(line)["name"] for line in fd], ["year", "year.evaluate", "year", "year.evaluate", "fetch.data"])
+
+    # memory tracking: transient allocations within (nested) spans, and the size of data structures
+    profiler = profiling.Profiler(memory=True)
+    try:
+      with profiler.span("year"):
+        with profiler.span("year.evaluate"):
+          transient = np.ones(1 << 20)
+          del transient
+        with profiler.span("year.deltas"):
+          pass
+      outer, inner, other = [profiler.summary()[name] for name in ["year", "year.evaluate", "year.deltas"]]
+      self.assertTrue(inner["max_traced_transient_mb"] >= 8.0)
+      self.assertTrue(other["max_traced_transient_mb"] < 1.0)
+      self.assertTrue(outer["max_traced_transient_mb"] >= inner["max_traced_transient_mb"])
+      self.assertTrue(profiler.events[0]["rss_mb"] > 0)
+      panel = Panel([2020, 2021], ["A", "B", "C"])
+      panel["PEOPLE"] = np.zeros((2, 3))
+      sample = profiler.sample_sizes("sizes", {"dataset": Test.dataset, "output": panel}, year=2020)
+      self.assertEqual(sample["output_mb"] * profiling.MB, 48)
+      self.assertEqual(sample["dataset_mb"] * profiling.MB, Test.dataset.memory_usage(deep=True).sum())
+      self.assertEqual(profiler.report()["samples"], [sample])
+      # without tracemalloc.reset_peak (Python < 3.9), the span's peak is bounded by the peak since tracing started
+      reset_peak = tracemalloc.reset_peak
+      del tracemalloc.reset_peak
+      try:
+        with profiler.span("fallback"):
+          transient = np.ones(1 << 20)
+          del transient
+      finally:
+        tracemalloc.reset_peak = reset_peak
+      self.assertTrue(profiler.summary()["fallback"]["max_traced_transient_mb"] >= 8.0)
+    finally:
+      tracemalloc.stop()
+
+  def test_benchmark(self):
+    suite = benchmark.benchmarks()
+    self.assertEqual(len([b for b in suite if b.name.startswith("fit.")]), len(models._valid_types) * len(models._valid_subtypes))
+    results = benchmark.run(suite, 2, "call.gravity")
+    self.assertEqual(list(results.keys()), ["call.gravity.pow", "call.gravity.exp"])
+    self.assertEqual(results["call.gravity.pow"]["repeat"], 2)
+    results.update(benchmark.run(suite, 1, "project_year.dense"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+      history = os.path.join(tmpdir, "benchmarks", "history.jsonl")
+      benchmark.append_history(history, results)
+      benchmark.append_history(history, results)
+      with open(history) as fd:
+        records = [json.loads(line) for line in fd]
+      self.assertEqual(len(records), 2)
+      self.assertEqual(records[0]["metadata"]["cpus"], os.cpu_count())
+      baseline = os.path.join(tmpdir, "baseline.json")
+      benchmark.save_baseline(baseline, {"call.gravity.pow": {"min": results["call.gravity.pow"]["min"] / 2}, "call.gravity.exp": results["call.gravity.exp"]})
+      comparison = benchmark.compare(results, benchmark.load_baseline(baseline))
+    self.assertEqual(list(comparison.BENCHMARK), ["call.gravity.pow", "call.gravity.exp"])
+    self.assertEqual(list(comparison.STATUS), ["slower", "same"])
+    self.assertAlmostEqual(comparison.RATIO[0], 2.0)
+
+  def test_data_cache(self):
+    cache = LRUCache(2 * 800)
+    for key in ["a", "b"]:
+      cache.put(key, np.zeros(100))
+    self.assertIsNotNone(cache.get("a"))
+    # evicts the least recently used entry, b
+    cache.put("c", np.zeros(100))
+    self.assertIsNone(cache.get("b"))
+    self.assertIsNotNone(cache.get("a"))
+    cache.put("d", np.zeros(1000))
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(cache.stats()["hits"], 2)
+    self.assertEqual(cache.stats()["misses"], 1)
+    self.assertEqual(cache.stats()["evictions"], 1)
+
+    class Source(Instance):
+      def __init__(self):
+        self.data_cache = LRUCache(1 << 20)
+        self.calls = 0
+      @memoised
+      def get_people(self, year, geogs):
+        self.calls += 1
+        return pd.DataFrame({"GEOGRAPHY_CODE": sorted(geogs), "PEOPLE": float(year)})
+    source = Source()
+    first = source.get_people(2011, ["E06000001", "E06000002"])
+    first.PEOPLE += 1.0
+    # the same set of geographies, in a different order
+    second = source.get_people(2011, ["E06000002", "E06000001"])
+    self.assertEqual(source.calls, 1)
+    self.assertTrue(np.array_equal(second.PEOPLE.values, [2011.0, 2011.0]))
+    source.get_people(2012, ["E06000001", "E06000002"])
+    source.get_people(2011, "E06000001")
+    self.assertEqual(source.calls, 3)
+    self.assertEqual(source.data_cache.stats()["hit_rate"], 0.25)
+    profiler = profiling.Profiler()
+    profiler.counters["data_cache"] = source.data_cache.stats
+    self.assertEqual(profiler.report()["counters"]["data_cache"]["misses"], 3)
+
+  def test_prefetch(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      # local stand-ins for the remote sources
+      od_file = os.path.join(tmpdir, "od.csv")
+      Test.dataset[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "MIGRATIONS"]].to_csv(od_file, index=False)
+      lookup_file = os.path.join(tmpdir, "lookup.csv")
+      pd.DataFrame({"LAD_CM": Test.dataset.O_GEOGRAPHY_CODE.unique(), "LAD": Test.dataset.O_GEOGRAPHY_CODE.unique()}).to_csv(lookup_file, index=False)
+      # the independent stages can only both complete if they run at the same time
+      barrier = threading.Barrier(2, timeout=10)
+      def fetch(filename):
+        barrier.wait()
+        return pd.read_csv(filename)
+      profiler = profiling.Profiler()
+      pipeline = prefetch.Pipeline("prefetch", 2, profiler)
+      pipeline.add("od", lambda: fetch(od_file))
+      pipeline.add("lad_lookup", lambda: fetch(lookup_file))
+      pipeline.add("merged", lambda od, lookup: od.merge(lookup, left_on="O_GEOGRAPHY_CODE", right_on="LAD_CM"), after=["od", "lad_lookup"])
+      results = pipeline.run()
+      self.assertEqual(len(results["merged"]), len(Test.dataset))
+      spans = profiler.summary()
+      self.assertEqual(sorted(spans), ["prefetch.lad_lookup", "prefetch.merged", "prefetch.od"])
+
+    pipeline = prefetch.Pipeline("prefetch", 1)
+    pipeline.add("a", lambda: 1)
+    self.assertRaises(ValueError, pipeline.add, "a", lambda: 2)
+    pipeline.add("b", lambda a: a + 1, after=["a"])
+    pipeline.add("c", lambda a, b: a + b, after=["a", "b"])
+    self.assertEqual(pipeline.run(), {"a": 1, "b": 2, "c": 3})
+    pipeline.add("d", lambda x: x, after=["x"])
+    self.assertRaises(ValueError, pipeline.run)
+    pipeline = prefetch.Pipeline("prefetch", 2)
+    pipeline.add("a", lambda b: b, after=["b"])
+    pipeline.add("b", lambda a: a, after=["a"])
+    self.assertRaises(ValueError, pipeline.run)
+    pipeline = prefetch.Pipeline("prefetch", 2)
+    pipeline.add("a", lambda: 1 / 0)
+    pipeline.add("b", lambda a: a, after=["a"])
+    self.assertRaises(ZeroDivisionError, pipeline.run)
+
+  def test_batch_groups(self):
+    base = { "model_type": "gravity", "emitters": ["PEOPLE"], "attractors": ["HOUSEHOLDS"], "scenario": "a.csv" }
+    configs = [("a", base),
+               ("b", dict(base, scenario="b.csv", migration_scale_factor=0.05)),
+               ("c", dict(base, attractors=["JOBS"])),
+               ("d", dict(base, od_scenario="od.csv"))]
+    groups = batch.group_configs(configs)
+    self.assertEqual([[f for f, _ in group] for group in groups], [["a", "b", "d"], ["c"]])
+    # settings of the input data Instance are not scenario settings
+    self.assertEqual(len(batch.group_configs([("a", base), ("b", dict(base, data_cache_mb=64))])), 2)
+
+    # the years of every config are checked against its scenario before anything is prepared
+    base = dict(base, scenario="test.csv", scenario_dir="data/scenarios", emitters=["PEOPLE"], attractors=["HOUSEHOLDS"])
+    self.assertRaises(RuntimeError, batch.run, [("a", base), ("b", dict(base, start_year=2021))])
+    self.assertRaises(RuntimeError, batch.run, [("a", base), ("b", dict(base, end_year=2019))])
+
 if __name__ == "__main__":
   unittest.main()
\ No newline at end of file